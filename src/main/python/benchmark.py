@@ -0,0 +1,511 @@
+"""
+Benchmarks hot paths of the preprocessing with synthetic data and checks that
+optimized implementations match their reference implementations. Benchmarks the
+whole pipeline on synthetic CSV-files of growing size and writes the results
+together with the current commit into a JSON-file.
+
+Example calls:
+python -m benchmark emos -n 10000 -s 50
+python -m benchmark bag -n 10000 -t 500
+python -m benchmark imports
+python -m benchmark generate '../../../input_data/synth_tweets.csv' -n 100000
+python -m benchmark pipeline 1000 10000 100000 1000000 -d '/tmp/pld_bench'
+python -m benchmark dump -n 10000 -f 2 -d '/tmp/pld_bench'
+"""
+
+import csv
+import json
+import multiprocessing
+import numpy as np
+import os
+import platform
+import subprocess
+import sys
+from argparse import ArgumentParser
+from collections import Counter
+
+from data_file_handler import read_tweets_from_csv
+from dump_indexer import ONYX, RDF_TYPE, RDFS_LABEL, SCHEMA, SIOC, SIOC_T, \
+                         WNA, build_dump_index
+from data_preprocessor import build_vocab, collapse_tag_ids, preprocess_emos, \
+                              preprocess_tags
+from helpers import get_peak_rss_mb, print_log, time_call
+
+ENTRY_POINTS = ('data_retriever', 'feature_store', 'pld_classifier_trainer',
+                'evaluation', 'scoring_server', 'scoring_client')
+HEAVY_MODULES = ('matplotlib', 'torch', 'torchtext')
+
+# Reference Implementations
+
+def preprocess_emos_loop(emos_pos_str_ls, emos_neg_str_ls):
+    """ Reference implementation of 'preprocess_emos', which parses and reduces
+    each list of emotion scores separately. """
+    parse_emos_str = lambda emos_str: list(map(float, emos_str.split('+')))
+
+    emos_pos_ls_ls = [parse_emos_str(emos_str) for emos_str in emos_pos_str_ls]
+    emos_neg_ls_ls = [parse_emos_str(emos_str) for emos_str in emos_neg_str_ls]
+
+    emos_pos_avg_ls = [np.mean(emos_ls) for emos_ls in emos_pos_ls_ls]
+    emos_neg_avg_ls = [np.mean(emos_ls) for emos_ls in emos_neg_ls_ls]
+    emos_pos_std_ls = [np.std(emos_ls) for emos_ls in emos_pos_ls_ls]
+    emos_neg_std_ls = [np.std(emos_ls) for emos_ls in emos_neg_ls_ls]
+
+    return np.array([emos_pos_avg_ls, emos_neg_avg_ls, emos_pos_std_ls,
+                     emos_neg_std_ls]).T
+
+# Synthetic Data
+
+def generate_emos_strs(num, scores, rng):
+    """ Generates 'num' '+'-separated strings with a random number of emotion
+    scores between 1 and 2*'scores' each, like they are fetched from the
+    SPARQL-endpoint. Uses the np.random.Generator 'rng'. """
+    lens = rng.integers(1, 2 * scores + 1, size=num)
+    return ['+'.join(f"{emo:.6f}" for emo in rng.random(length))
+            for length in lens]
+
+def generate_tweets_rows(start, num, tweets, vocab_size, rng):
+    """ Generates 'num' rows for the PLDs 'start' to 'start'+'num' in the
+    schema of 'data_retriever.py'. Each PLD gets between 1 and 2*'tweets'
+    tweets with one positive and one negative emotion score and up to three
+    hashtags each. Hashtags are drawn Zipf-distributed from 'vocab_size'
+    tokens. Uses the np.random.Generator 'rng'. """
+    for pld_idx in range(start, start + num):
+        tweet_cnt = int(rng.integers(1, 2 * tweets + 1))
+        emos_pos = rng.random(tweet_cnt)
+        emos_neg = -rng.random(tweet_cnt)
+        tag_cnts = rng.integers(0, 4, size=tweet_cnt)
+        tag_ids = (rng.zipf(1.3, size=int(np.sum(tag_cnts))) - 1) % vocab_size
+        tag_strs = [f"Tag{tag_id}" for tag_id in tag_ids]
+        tag_starts = np.cumsum(tag_cnts) - tag_cnts
+
+        yield [f"pld{pld_idx}.com", tweet_cnt,
+               '+'.join(f"{emo:.4f}" for emo in emos_pos),
+               '+'.join(f"{emo:.4f}" for emo in emos_neg),
+               '+'.join('+'.join(tag_strs[s:s+c])
+                        for s, c in zip(tag_starts, tag_cnts)),
+               '+'.join(f"http://data.gesis.org/tweetscov19/tweet_{pld_idx}_{i}"
+                        for i in range(tweet_cnt))]
+
+def generate_tweets_csv(rel_path, num, tweets=10, vocab_size=10000, seed=0,
+                        start=0):
+    """ Writes 'num' synthetic PLDs from 'generate_tweets_rows' into a new
+    CSV-file at 'rel_path' in the format of 'write_tweets_to_csv'. PLD names
+    start at index 'start'. The content only depends on the arguments. """
+    rng = np.random.default_rng(seed)
+    with open(rel_path, 'w', encoding='utf-8', newline='') as file:
+        fw = csv.writer(file, delimiter=',', quotechar='|',
+                        quoting=csv.QUOTE_MINIMAL)
+        fw.writerow(['pld', 'tweet_count', 'emos_pos', 'emos_neg', 'tags',
+                     'tweet_ids'])
+        fw.writerows(generate_tweets_rows(start, num, tweets, vocab_size, rng))
+
+def generate_dump_triples(start, num, tweets, vocab_size, rng):
+    """ Generates N-Triples for the tweets of the PLDs 'start' to 'start'+'num'
+    like 'generate_tweets_rows' with distinct hashtags per tweet and one triple
+    which the query ignores per tweet. Yields tuples (lines, row) per PLD with
+    its triples and its expected row in the schema of 'data_retriever.py'. """
+    base = 'http://data.gesis.org/tweetscov19'
+    for pld_idx in range(start, start + num):
+        tweet_cnt = int(rng.integers(1, 2 * tweets + 1))
+        emos_pos = [f"{emo:.4f}" for emo in rng.random(tweet_cnt)]
+        emos_neg = [f"{emo:.4f}" for emo in -rng.random(tweet_cnt)]
+        lines, tags_ls, tweet_ids = [], [], []
+        for i in range(tweet_cnt):
+            tweet = f"{base}/tweet_{pld_idx}_{i}"
+            tag_ids = (rng.zipf(1.3, size=int(rng.integers(0, 4))) - 1) \
+                % vocab_size
+            tags = [f"Tag{tag_id}" for tag_id in dict.fromkeys(tag_ids)]
+            lines += [f"<{tweet}> <{RDF_TYPE}> <{SIOC}Post> .",
+                      f"<{tweet}> <{SCHEMA}citation> "
+                      f"<https://www.pld{pld_idx}.com/news/{i}.html> .",
+                      f"<{tweet}> <{SCHEMA}dateCreated> \"2020-04-01\" .",
+                      f"<{tweet}> <{ONYX}hasEmotionSet> _:es{i} .",
+                      f"_:es{i} <{RDF_TYPE}> <{ONYX}EmotionSet> ."]
+            for cat, emo in (('positive', emos_pos[i]),
+                             ('negative', emos_neg[i])):
+                lines += [f"_:es{i} <{ONYX}hasEmotion> _:{cat}{i} .",
+                          f"_:{cat}{i} <{ONYX}hasEmotionCategory> "
+                          f"<{WNA}{cat}-emotion> .",
+                          f"_:{cat}{i} <{ONYX}hasEmotionIntensity> \"{emo}\"^^"
+                          f"<http://www.w3.org/2001/XMLSchema#double> ."]
+            for tag in tags:
+                lines += [f"<{tweet}> <{SCHEMA}mentions> <{base}/{tag}> .",
+                          f"<{base}/{tag}> <{RDF_TYPE}> <{SIOC_T}Tag> .",
+                          f"<{base}/{tag}> <{RDFS_LABEL}> \"{tag}\" ."]
+            tags_ls.append('+'.join(tags))
+            tweet_ids.append(tweet)
+        yield lines, [f"pld{pld_idx}.com", str(tweet_cnt), '+'.join(emos_pos),
+                      '+'.join(emos_neg), '+'.join(tags_ls),
+                      '+'.join(tweet_ids)]
+
+def generate_dump_files(work_dir, num, files, tweets, vocab_size, seed):
+    """ Writes N-Triples for 'num' synthetic PLDs from 'generate_dump_triples'
+    into 'files' dumps in 'work_dir', where the blank nodes of PLD i are labeled
+    per PLD. Writes their names into a CSV-file as read by 'read_pld_list'.
+    Returns the paths of the dumps and the CSV-file and the expected rows. """
+    os.makedirs(work_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    dump_paths = [os.path.join(work_dir, f"synth_dump_{num}_{i}.nt")
+                  for i in range(files)]
+    pld_path = os.path.join(work_dir, f"synth_dump_{num}_plds.csv")
+    rows = []
+    dump_files = [open(rel_path, 'w', encoding='utf-8')
+                  for rel_path in dump_paths]
+    for pld_idx, (lines, row) in enumerate(generate_dump_triples(0, num,
+                                           tweets, vocab_size, rng)):
+        dump_files[pld_idx % files].write(
+            '\n'.join(lines).replace('_:', f'_:p{pld_idx}_') + '\n')
+        rows.append(row)
+    for file in dump_files:
+        file.close()
+    with open(pld_path, 'w', encoding='utf-8') as file:
+        file.writelines(f"{row[0]}\n" for row in rows)
+    return dump_paths, pld_path, rows
+
+def generate_pipeline_csvs(work_dir, num, tweets, vocab_size, seed):
+    """ Generates CSV-files for 'num' left and 'num' right PLDs in 'work_dir',
+    unless they exist already. Returns both relative paths. """
+    os.makedirs(work_dir, exist_ok=True)
+    paths = []
+    for side, side_seed in (('left', seed), ('right', seed + 1)):
+        rel_path = os.path.join(work_dir, f"synth_{side}_{num}_{tweets}_"
+                                          f"{vocab_size}_{seed}_tweets.csv")
+        if not os.path.exists(rel_path):
+            generate_tweets_csv(rel_path, num, tweets, vocab_size, side_seed,
+                                start=(0 if side == 'left' else num))
+        paths.append(rel_path)
+    return paths
+
+# Benchmarks
+
+def benchmark_emos(num, scores, repeat=3, seed=0):
+    """ Times 'preprocess_emos' and its reference implementation on 'num'
+    synthetic PLDs with about 'scores' emotion scores each. Checks that both
+    results are numerically equivalent. Returns the best times in s. """
+    rng = np.random.default_rng(seed)
+    emos_pos_str_ls = generate_emos_strs(num, scores, rng)
+    emos_neg_str_ls = generate_emos_strs(num, scores, rng)
+
+    t_vec, emos_arr = time_call(preprocess_emos, emos_pos_str_ls,
+                                emos_neg_str_ls, repeat=repeat)
+    t_ref, emos_arr_ref = time_call(preprocess_emos_loop, emos_pos_str_ls,
+                                    emos_neg_str_ls, repeat=repeat)
+    assert emos_arr.shape == emos_arr_ref.shape
+    assert np.allclose(emos_arr, emos_arr_ref, rtol=1e-12, atol=1e-12)
+    return t_vec, t_ref
+
+def benchmark_bag(num, tags, vocab_size=10000, repeat=3, seed=0):
+    """ Times the embedding of 'num' synthetic PLDs with about 'tags' Zipf-
+    distributed Hashtags each as mean over all occurrences and as weighted sum
+    over their distinct token ids, which are collapsed beforehand. Checks that
+    both results are numerically equivalent. Returns the best times in s and
+    the numbers of embedded token ids. """
+    import torch
+    from pld_dataset import normalize_counts
+    from torch.nn import EmbeddingBag
+
+    rng = np.random.default_rng(seed)
+    tag_ids_ls = [(rng.zipf(1.3, size=int(rng.integers(0, 2 * tags + 1))) - 1)
+                  % vocab_size for _ in range(num)]
+    weight = torch.as_tensor(rng.standard_normal((vocab_size, 300)),
+                             dtype=torch.float32)
+    emb_mean = EmbeddingBag.from_pretrained(weight, mode='mean')
+    emb_sum = EmbeddingBag.from_pretrained(weight, mode='sum')
+
+    raw_ids = torch.as_tensor(np.concatenate(tag_ids_ls), dtype=torch.int64)
+    raw_offsets = torch.as_tensor(np.cumsum([0] + [len(tag_ids)
+                                  for tag_ids in tag_ids_ls[:-1]]))
+    tag_ids, tag_counts, tag_offsets = collapse_tag_ids(tag_ids_ls)
+    tag_offsets = torch.as_tensor(tag_offsets)
+    weights = normalize_counts(torch.as_tensor(tag_counts, dtype=torch.float32),
+                               tag_offsets)
+    tag_ids = torch.as_tensor(tag_ids)
+
+    with torch.no_grad():
+        t_bag, feats = time_call(emb_sum, tag_ids, tag_offsets[:-1], weights,
+                                 repeat=repeat)
+        t_ref, feats_ref = time_call(emb_mean, raw_ids, raw_offsets,
+                                     repeat=repeat)
+    assert torch.allclose(feats, feats_ref, rtol=1e-4, atol=1e-5)
+    return t_bag, t_ref, len(tag_ids), len(raw_ids)
+
+def benchmark_import(module, repeat=3):
+    """ Imports 'module' 'repeat' times in a fresh interpreter each. Returns the
+    best import time in s and the heavy dependencies which have been loaded. """
+    script = (f"import json, sys, time\n"
+              f"start = time.perf_counter()\n"
+              f"import {module}\n"
+              f"print(json.dumps([time.perf_counter() - start, "
+              f"[m for m in {HEAVY_MODULES} if m in sys.modules]]))")
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    best, heavy_modules = float('inf'), []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', script], cwd=cwd,
+                                check=True, capture_output=True, text=True)
+        import_time, heavy_modules = json.loads(output.stdout.splitlines()[-1])
+        best = min(best, import_time)
+    return best, heavy_modules
+
+def benchmark_pipeline(work_dir, num, tweets=10, vocab_size=10000, ba=43,
+                       seed=0):
+    """ Runs the pipeline once on 'num' synthetic PLDs, i.e., half of them left
+    and half of them right, and times reading, emotion preprocessing, vocab
+    building, one training epoch and scoring all PLDs. Returns one dict per
+    stage with its time, throughput in PLDs/s and the peak RSS after it. """
+    import torch
+    from evaluation import apply_classifier
+    from pld_classifier import build_classifier
+    from pld_classifier_trainer import train_classifier
+    from pld_dataset import PLDDataset, build_dataloader, build_emos_arr, \
+                            build_label_arr, split_dataset
+    from torchtext.data.utils import get_tokenizer
+
+    torch.manual_seed(seed)
+    l_path, r_path = generate_pipeline_csvs(work_dir, num // 2, tweets,
+                                            vocab_size, seed)
+    results = {}
+
+    def measure(stage, fct, *args):
+        """ Times 'fct' called with 'args' as 'stage'. """
+        seconds, result = time_call(fct, *args, repeat=1)
+        results[stage] = {'seconds': seconds, 'plds_per_s': num / seconds,
+                          'peak_rss_mb': get_peak_rss_mb()}
+        return result
+
+    def read_both():
+        return read_tweets_from_csv(l_path), read_tweets_from_csv(r_path)
+    l_tweets, r_tweets = measure('read_tweets_from_csv', read_both)
+    (_, l_cnts, l_pos, l_neg, l_tags, _), (_, r_cnts, r_pos, r_neg, r_tags, _) \
+        = l_tweets, r_tweets
+
+    def preprocess_both():
+        return preprocess_emos(l_pos, l_neg), preprocess_emos(r_pos, r_neg)
+    l_emos_arr, r_emos_arr = measure('preprocess_emos', preprocess_both)
+
+    tokenizer = get_tokenizer('basic_english')
+    tags_tokens_ls = [tokenizer(tags_str)
+                      for tags_str in preprocess_tags(l_tags + r_tags)]
+    counter = Counter(token for tokens in tags_tokens_ls for token in tokens)
+    vocab = measure('build_vocab', build_vocab, counter)
+
+    tags_ids, tags_counts, tags_offsets = collapse_tag_ids(
+        [vocab.stoi.get(token, 0) for token in tokens]
+        for tokens in tags_tokens_ls)
+    pld_dataset = PLDDataset(build_label_arr(len(l_cnts), len(r_cnts)),
+                             build_emos_arr(l_emos_arr, r_emos_arr, l_cnts,
+                                            r_cnts),
+                             tags_ids, tags_offsets, tags_counts)
+    trn_set, val_set = split_dataset(pld_dataset, ba)
+    classifier = build_classifier(vocab.vectors)
+    measure('train_epoch', train_classifier, classifier,
+            build_dataloader(trn_set, ba), build_dataloader(val_set, ba), 1,
+            0.01, False)
+
+    measure('apply_classifier', apply_classifier, classifier,
+            build_dataloader(pld_dataset, 1024))
+    return results
+
+def benchmark_dump(work_dir, num, files=1, tweets=10, vocab_size=10000, seed=0,
+                   jobs=1):
+    """ Writes 'num' synthetic PLDs into 'files' N-Triples dumps, indexes them
+    with 'jobs' processes and retrieves all PLDs from the index. Checks that
+    the written CSV-file matches the generated PLDs. Returns the times of both
+    steps in s and the number of triples. """
+    from data_retriever import retrieve_from_index
+
+    dump_paths, pld_path, rows = generate_dump_files(work_dir, num, files,
+                                                     tweets, vocab_size, seed)
+    index_path = os.path.join(work_dir, f"synth_dump_{num}_index.sqlite")
+    tweets_path = pld_path.replace('.csv', '_tweets.csv')
+    t_index, _ = time_call(build_dump_index, index_path, dump_paths, jobs,
+                           repeat=1)
+    t_retrieve, _ = time_call(retrieve_from_index, [row[0] for row in rows],
+                              index_path, pld_path, repeat=1)
+
+    with open(tweets_path, 'r', encoding='utf-8') as file:
+        reader = csv.reader(file, delimiter=',', quotechar='|')
+        assert next(reader) == ['pld', 'tweet_count', 'emos_pos', 'emos_neg',
+                                'tags', 'tweet_ids']
+        assert list(reader) == rows
+    num_triples = 0
+    for rel_path in dump_paths:
+        with open(rel_path, 'r', encoding='utf-8') as file:
+            num_triples += sum(1 for _ in file)
+    return t_index, t_retrieve, num_triples
+
+def get_commit():
+    """ Returns the current commit hash of the repository or None, and whether
+    the working tree has uncommitted changes. """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=cwd,
+                                check=True, capture_output=True, text=True)
+        status = subprocess.run(['git', 'status', '--porcelain'], cwd=cwd,
+                                check=True, capture_output=True, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit.stdout.strip(), len(status.stdout.strip()) > 0
+
+# Main
+
+def parse_arguments(args):
+    """ Creates an ArgumentParser with help messages. """
+    info =  """ Benchmarks for the PLD media bias classification. Uses
+            synthetic data with a fixed seed to make runs comparable. """
+    parser = ArgumentParser(description=info)
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    emos_parser = subparsers.add_parser('emos',
+                                        help="benchmark 'preprocess_emos'")
+    emos_parser.add_argument('-n', '--num', type=int, default=10000,
+                             metavar='N', help="specify number of PLDs")
+    emos_parser.add_argument('-r', '--repeat', type=int, default=3,
+                             metavar='N', help="specify number of runs")
+    emos_parser.add_argument('-s', '--scores', type=int, default=50,
+                             metavar='N', help="specify scores per PLD")
+
+    bag_parser = subparsers.add_parser('bag',
+                                       help="benchmark the weighted bag")
+    bag_parser.add_argument('-k', '--vocab', type=int, default=10000,
+                            metavar='N', help="specify number of hashtags")
+    bag_parser.add_argument('-n', '--num', type=int, default=10000,
+                            metavar='N', help="specify number of PLDs")
+    bag_parser.add_argument('-r', '--repeat', type=int, default=3,
+                            metavar='N', help="specify number of runs")
+    bag_parser.add_argument('-t', '--tags', type=int, default=500,
+                            metavar='N', help="specify hashtags per PLD")
+
+    imports_parser = subparsers.add_parser('imports',
+                                           help="benchmark startup costs")
+    imports_parser.add_argument('modules', nargs='*', default=ENTRY_POINTS,
+                                help="specify modules, default: entry points")
+    imports_parser.add_argument('-r', '--repeat', type=int, default=3,
+                                metavar='N', help="specify number of runs")
+
+    generate_parser = subparsers.add_parser('generate',
+                                            help="generate synthetic tweets")
+    generate_parser.add_argument('data',
+                                 help="specify relative path to new CSV-file")
+    generate_parser.add_argument('-k', '--vocab', type=int, default=10000,
+                                 metavar='N', help="specify number of hashtags")
+    generate_parser.add_argument('-n', '--num', type=int, default=1000,
+                                 metavar='N', help="specify number of PLDs")
+    generate_parser.add_argument('-s', '--seed', type=int, default=0,
+                                 metavar='N', help="specify random seed")
+    generate_parser.add_argument('-t', '--tweets', type=int, default=10,
+                                 metavar='N', help="specify tweets per PLD")
+
+    pipeline_parser = subparsers.add_parser('pipeline',
+                                            help="benchmark the whole pipeline")
+    pipeline_parser.add_argument('sizes', type=int, nargs='*',
+                                 default=[1000, 10000, 100000, 1000000],
+                                 help="specify numbers of PLDs")
+    pipeline_parser.add_argument('-b', '--ba', type=int, default=43,
+                                 metavar='N', help="specify samples per batch")
+    pipeline_parser.add_argument('-d', '--dir', default='benchmark_data',
+                                 metavar='PATH',
+                                 help="specify directory for synthetic data")
+    pipeline_parser.add_argument('-k', '--vocab', type=int, default=10000,
+                                 metavar='N', help="specify number of hashtags")
+    pipeline_parser.add_argument('-o', '--out', default=None, metavar='PATH',
+                                 help="specify JSON-file for results")
+    pipeline_parser.add_argument('-s', '--seed', type=int, default=0,
+                                 metavar='N', help="specify random seed")
+    pipeline_parser.add_argument('-t', '--tweets', type=int, default=10,
+                                 metavar='N', help="specify tweets per PLD")
+    pipeline_parser.add_argument('-v', '--verbose', action='store_true',
+                                 default=False, help="activate output")
+
+    dump_parser = subparsers.add_parser('dump',
+                                        help="benchmark the index of dumps")
+    dump_parser.add_argument('-d', '--dir', default='benchmark_data',
+                             metavar='PATH',
+                             help="specify directory for synthetic data")
+    dump_parser.add_argument('-f', '--files', type=int, default=1,
+                             metavar='N', help="specify number of dumps")
+    dump_parser.add_argument('-j', '--jobs', type=int, default=1,
+                             metavar='N', help="specify number of processes")
+    dump_parser.add_argument('-k', '--vocab', type=int, default=10000,
+                             metavar='N', help="specify number of hashtags")
+    dump_parser.add_argument('-n', '--num', type=int, default=1000,
+                             metavar='N', help="specify number of PLDs")
+    dump_parser.add_argument('-s', '--seed', type=int, default=0,
+                             metavar='N', help="specify random seed")
+    dump_parser.add_argument('-t', '--tweets', type=int, default=10,
+                             metavar='N', help="specify tweets per PLD")
+
+    if len(args) < 1:  # show help, if no arguments are given
+        parser.print_help(sys.stderr)
+        sys.exit()
+    return parser.parse_args(args)
+
+def main(args):
+    parsed_args = parse_arguments(args)
+
+    if parsed_args.benchmark == 'emos':
+        t_vec, t_ref = benchmark_emos(parsed_args.num, parsed_args.scores,
+                                      parsed_args.repeat)
+        print(f"preprocess_emos: {t_vec:.4f}s, reference: {t_ref:.4f}s, "
+              f"speedup: {t_ref / t_vec:.1f}x, results are equivalent")
+    elif parsed_args.benchmark == 'bag':
+        t_bag, t_ref, num_ids, num_raw = benchmark_bag(parsed_args.num,
+            parsed_args.tags, parsed_args.vocab, parsed_args.repeat)
+        print(f"weighted bag: {t_bag:.4f}s ({num_ids} ids), mean over "
+              f"occurrences: {t_ref:.4f}s ({num_raw} ids), "
+              f"speedup: {t_ref / t_bag:.1f}x, results are equivalent")
+    elif parsed_args.benchmark == 'imports':
+        for module in parsed_args.modules:
+            t_import, heavy_modules = benchmark_import(module,
+                                                       parsed_args.repeat)
+            print(f"{module:24s} {t_import:7.3f}s  loads: "
+                  f"{', '.join(heavy_modules) or '-'}")
+    elif parsed_args.benchmark == 'generate':
+        assert parsed_args.data.endswith('_tweets.csv')
+        generate_tweets_csv(parsed_args.data, parsed_args.num,
+                            parsed_args.tweets, parsed_args.vocab,
+                            parsed_args.seed)
+    elif parsed_args.benchmark == 'dump':
+        assert parsed_args.files > 0 and parsed_args.jobs > 0
+        t_index, t_retrieve, num_triples = benchmark_dump(parsed_args.dir,
+            parsed_args.num, parsed_args.files, parsed_args.tweets,
+            parsed_args.vocab, parsed_args.seed, parsed_args.jobs)
+        print(f"build_dump_index: {t_index:.3f}s "
+              f"({num_triples / t_index:.0f} triples/s), "
+              f"retrieve_from_index: {t_retrieve:.3f}s "
+              f"({parsed_args.num / t_retrieve:.0f} PLDs/s), "
+              f"results match the generated PLDs")
+    elif parsed_args.benchmark == 'pipeline':
+        assert parsed_args.ba > 0
+        assert all(num > 4 * parsed_args.ba for num in parsed_args.sizes)
+        commit, dirty = get_commit()
+        report = {'commit': commit, 'dirty': dirty,
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'params': {'tweets': parsed_args.tweets,
+                             'vocab': parsed_args.vocab,
+                             'ba': parsed_args.ba, 'seed': parsed_args.seed},
+                  'results': {}}
+
+        # one fresh process per size, so that peak RSS refers to one size only
+        ctx = multiprocessing.get_context('spawn')
+        for num in parsed_args.sizes:
+            with ctx.Pool(1) as pool:
+                results = pool.apply(benchmark_pipeline, (parsed_args.dir,
+                                     num, parsed_args.tweets, parsed_args.vocab,
+                                     parsed_args.ba, parsed_args.seed))
+            report['results'][str(num)] = results
+            for stage, result in results.items():
+                print_log(f"{num:8d} PLDs {stage:22s} "
+                          f"{result['seconds']:9.3f}s "
+                          f"{result['plds_per_s']:12.0f} PLDs/s "
+                          f"{result['peak_rss_mb']:9.1f} MB",
+                          parsed_args.verbose)
+
+        out_path = parsed_args.out \
+            or f"benchmark_{(commit or 'unknown')[:8]}.json"
+        with open(out_path, 'w') as file:
+            json.dump(report, file, indent=2)
+        print_log(f"Results saved to '{out_path}'.", parsed_args.verbose)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,33 +1,291 @@
 import csv
+import itertools
+import json
 import os
-import torch
+import sqlite3
 import numpy as np
 
 from helpers import print_log
-from pld_classifier import build_classifier
 
 # Helper
 
+def generate_cache_path(rel_path):
+    """ Generates a relative path for a SQLite-file with cached responses.
+    'rel_path' refers to a CSV-file with names of PLDs. """
+    assert is_valid_pld_path(rel_path)
+    return rel_path.replace('.csv', '_cache.sqlite')
+
+def generate_progress_file_name(rel_path_l):
+    """ Generates the JSON-file name for the progress of a streaming evaluation
+    from the relative path 'rel_path_l' of its left results. """
+    return f"{os.path.splitext(rel_path_l)[0]}_progress.json"
+
+def generate_store_path(rel_path):
+    """ Generates a relative path for the directory with the feature store of
+    a CSV-file with fetched tweets referred to by 'rel_path'. """
+    assert rel_path.endswith('.csv')
+    return rel_path.replace('.csv', '_feats')
+
+def generate_trace_file_name(model_name, stage):
+    """ Generates the file name for a cProfile-trace of 'stage' from
+    'model_name'. """
+    return f"{model_name}_{stage}.prof"
+
 def generate_tweets_path(rel_path):
     """ Generates a relative path for a CSV-file with fetched tweets.
     'rel_path' refers to a CSV-file with names of PLDs. """
     assert is_valid_pld_path(rel_path)
     return rel_path.replace('.csv', '_tweets.csv')
 
+def generate_index_path(rel_path_l):
+    """ Generates the relative path for a SQLite-file with indexed predictions
+    from the relative path 'rel_path_l' of the left results. """
+    return f"{os.path.splitext(rel_path_l)[0]}_index.sqlite"
+
+def generate_metrics_file_name(model_name, stage):
+    """ Generates the JSON-file name for instrumentation metrics of 'stage',
+    e.g., 'train' or 'eval', from 'model_name'. """
+    return f"{model_name}_{stage}_metrics.json"
+
+def generate_leaderboard_file_name(sweep_name):
+    """ Generates the CSV-file name for the leaderboard of 'sweep_name'. """
+    return f"{sweep_name}_leaderboard.csv"
+
 def generate_model_file_names(model_name):
-    """ Generates the PT-file names for the state_dict and vocab from
-    'model_name'. """
-    return f"{model_name}.pt", f"{model_name}_vocab.pt"
+    """ Generates the PT-file name for the state_dict and tokens and the
+    NPY-file name for the embedding from 'model_name'. """
+    return f"{model_name}.pt", f"{model_name}_emb.npy"
+
+def generate_export_file_name(model_name):
+    """ Generates the PT-file name for the TorchScript export of a classifier
+    from 'model_name'. """
+    return f"{model_name}_script.pt"
 
 def generate_hists_file_name(model_name):
     """ Generates the NPZ-file name for the train-metrics from 'model_name'. """
     return f"{model_name}_hists.npz"
 
+def trim_embedding(itos, embedding_weight):
+    """ Drops all tokens from 'itos' whose rows in 'embedding_weight' are zero,
+    i.e., which have no pretrained vector and embed like '<unk>'. Returns the
+    remaining tokens starting with '<unk>' and their rows as np.array. """
+    weight = embedding_weight.detach().cpu().numpy()
+    keep = np.any(weight != 0, axis=1)
+    keep[itos.index('<unk>')] = False
+    unk_row = np.zeros((1, weight.shape[1]), dtype=weight.dtype)
+    return ['<unk>'] + [token for token, k in zip(itos, keep) if k], \
+        np.concatenate((unk_row, weight[keep]))
+
 def is_valid_pld_path(rel_path):
     """ Checks if 'rel_path' exists and if its suffix is '.csv'. """
     abs_path = os.path.join(os.getcwd(), rel_path)
     return os.path.exists(abs_path) and abs_path.endswith('.csv')
 
+# Cache
+
+class ResponseCache(object):
+    """ Persistent cache for SPARQL-responses per PLD in a SQLite-file. Entries
+    are keyed by PLD and the hash of the applied query. """
+
+    def __init__(self, rel_path, query_hash):
+        """ Opens or creates the SQLite-file referred to by 'rel_path'. Only
+        entries for 'query_hash' are visible. """
+        self.query_hash = query_hash
+        self.connection = sqlite3.connect(rel_path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                                "pld TEXT, query_hash TEXT, response TEXT, "
+                                "PRIMARY KEY (pld, query_hash))")
+
+    def __contains__(self, pld):
+        row = self.connection.execute("SELECT 1 FROM responses WHERE pld=? AND "
+                                      "query_hash=?",
+                                      (pld, self.query_hash)).fetchone()
+        return row is not None
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, pld):
+        """ Returns the cached response for 'pld' as dict or None. """
+        row = self.connection.execute("SELECT response FROM responses WHERE "
+                                      "pld=? AND query_hash=?",
+                                      (pld, self.query_hash)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, pld, tweets):
+        """ Stores the response 'tweets' for 'pld' and commits it at once. """
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES "
+                                    "(?, ?, ?)", (pld, self.query_hash,
+                                                  json.dumps(tweets)))
+
+class DumpIndex(object):
+    """ Read-only index of tweets per PLD in a SQLite-file, which has been
+    built from dumps of TweetsCOV19 by 'dump_indexer.py'. Answers aggregates
+    per PLD in the same form as the SPARQL-endpoint. """
+
+    VARS = ['pld', 'tweet_count', 'emos_pos', 'emos_neg', 'tags', 'tweet_ids']
+
+    def __init__(self, rel_path):
+        """ Opens the SQLite-file referred to by 'rel_path'. """
+        assert os.path.exists(rel_path)
+        self.connection = sqlite3.connect(f"file:{rel_path}?mode=ro",
+                                          uri=True)
+
+    def close(self):
+        self.connection.close()
+
+    def aggregate(self, pld, rows):
+        """ Aggregates the tuples (tweet, emo_pos, emo_neg, tags) 'rows' of
+        'pld' into a dict like a response of the SPARQL-endpoint. The dict
+        contains no bindings, if there are no 'rows'. """
+        bindings = []
+        if rows:
+            tweets = list(dict.fromkeys(row[0] for row in rows))
+            values = [pld, str(len(tweets)),
+                      '+'.join(row[1] for row in rows),
+                      '+'.join(row[2] for row in rows),
+                      '+'.join(row[3] for row in rows), '+'.join(tweets)]
+            bindings.append({var: {'type': 'literal', 'value': value}
+                             for var, value in zip(self.VARS, values)})
+        return {'head': {'vars': self.VARS}, 'results': {'bindings': bindings}}
+
+    def iter_tweets(self, plds, block_size=500):
+        """ Yields tuples (pld, tweets) for all PLDs from 'plds' in their
+        order, where 'tweets' is the aggregate of 'aggregate'. Queries
+        'block_size' PLDs at once. Sorts the tweets of a PLD and the Hashtags
+        of a tweet by their first occurrence in the dumps, and ties by value,
+        so that the aggregates do not depend on the query plan. """
+        plds = list(plds)
+        for start in range(0, len(plds), block_size):
+            block = plds[start:start+block_size]
+            placeholders = ','.join('?' * len(block))
+            rows = {pld: [] for pld in block}
+            for pld, *row in self.connection.execute(
+                    "SELECT pld, position, emo_pos, emo_neg, tweet FROM "
+                    f"pld_tweets WHERE pld IN ({placeholders})", block):
+                rows[pld].append(row)
+            tags = {}
+            for tweet, *tag_row in self.connection.execute(
+                    "SELECT tweet, position, tag FROM tweet_tags WHERE tweet "
+                    "IN (SELECT tweet FROM pld_tweets WHERE pld IN "
+                    f"({placeholders}))", block):
+                tags.setdefault(tweet, []).append(tag_row)
+            for pld in block:
+                yield pld, self.aggregate(pld, [
+                    (tweet, emo_pos, emo_neg,
+                     '+'.join(tag for _, tag in sorted(tags.get(tweet, []))))
+                    for _, emo_pos, emo_neg, tweet in sorted(rows[pld])])
+
+class PredictionIndex(object):
+    """ Persistent index of predictions per PLD in a SQLite-file. Entries are
+    keyed by PLD and the hash of the classifier, and hold the fingerprint of
+    the PLD's tweets, for which the prediction has been made. """
+
+    def __init__(self, rel_path, model_hash):
+        """ Opens or creates the SQLite-file referred to by 'rel_path'. Only
+        entries for 'model_hash' are visible. """
+        self.model_hash = model_hash
+        self.connection = sqlite3.connect(rel_path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS predictions ("
+                                "pld TEXT, model_hash TEXT, fingerprint TEXT, "
+                                "class INTEGER, confidence REAL, "
+                                "PRIMARY KEY (pld, model_hash))")
+
+    def close(self):
+        self.connection.close()
+
+    def get_many(self, plds, block_size=500):
+        """ Returns a list with one tuple (fingerprint, class, confidence) or
+        None per PLD from 'plds'. Queries 'block_size' PLDs at once. """
+        entries = {}
+        plds = list(plds)
+        for start in range(0, len(plds), block_size):
+            block = plds[start:start+block_size]
+            rows = self.connection.execute(
+                "SELECT pld, fingerprint, class, confidence FROM predictions "
+                f"WHERE model_hash=? AND pld IN ({','.join('?' * len(block))})",
+                [self.model_hash] + block)
+            entries.update((pld, entry) for pld, *entry in rows)
+        return [entries.get(pld) for pld in plds]
+
+    def put_many(self, plds, fingerprints, class_ls, confidence_ls):
+        """ Stores the predictions for 'plds' with their 'fingerprints' and
+        commits them at once. """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)",
+                zip(plds, itertools.repeat(self.model_hash), fingerprints,
+                    map(int, class_ls), map(float, confidence_ls)))
+
+# Streaming
+
+class ResultWriter(object):
+    """ Appends results of a streaming evaluation chunk by chunk to the
+    CSV-files for left and right PLDs. After each chunk, both files are flushed
+    and the byte offset of the next unread row is saved in a progress file, so
+    that a killed run can resume after the last flushed chunk. """
+
+    def __init__(self, rel_path_l, rel_path_r, source, buffer_size=1<<20):
+        """ Opens the CSV-files 'rel_path_l' and 'rel_path_r' with write
+        buffers of 'buffer_size' bytes. Resumes from an existing progress file,
+        if it belongs to the same dict 'source', and starts over otherwise. """
+        self.progress_path = generate_progress_file_name(rel_path_l)
+        self.progress = {'source': source, 'offset': None, 'rows': 0,
+                         'sizes': [0, 0]}
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path, 'r') as f:
+                progress = json.load(f)
+            if progress['source'] == source and os.path.exists(rel_path_l) \
+                    and os.path.exists(rel_path_r):
+                self.progress = progress
+
+        mode = 'w' if self.offset is None else 'r+'
+        self.files = [open(rel_path, mode, encoding='utf-8',
+                           buffering=buffer_size, newline='')
+                      for rel_path in (rel_path_l, rel_path_r)]
+        for file, size in zip(self.files, self.progress['sizes']):
+            file.truncate(size) # drop rows written after the last progress
+            file.seek(size)
+        self.writers = [csv.writer(file, delimiter=',', quotechar='|',
+                                   quoting=csv.QUOTE_MINIMAL)
+                        for file in self.files]
+
+    @property
+    def offset(self):
+        """ Byte offset of the first unscored row or None for a new run. """
+        return self.progress['offset']
+
+    @property
+    def rows(self):
+        """ Number of rows which have been scored and flushed. """
+        return self.progress['rows']
+
+    def close(self, done=True):
+        """ Closes both CSV-files and removes the progress file, if 'done'. """
+        for file in self.files:
+            file.close()
+        if done and os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+
+    def write_chunk(self, plds, class_ls, confidence_ls, offset):
+        """ Writes the names from 'plds' with their confidences to the file for
+        their class from 'class_ls', flushes both files and saves 'offset' as
+        the position of the next unread row. """
+        for cls, writer in enumerate(self.writers):
+            writer.writerows([pld, cnf] for pld, c, cnf
+                             in zip(plds, class_ls, confidence_ls) if c == cls)
+        for file in self.files:
+            file.flush()
+
+        self.progress.update({'offset': offset,
+                              'rows': self.rows + len(plds),
+                              'sizes': [file.tell() for file in self.files]})
+        tmp_path = f"{self.progress_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.progress, f)
+        os.replace(tmp_path, self.progress_path) # atomic
+
 # Reader
 
 def read_hists_from_file(model_name):
@@ -38,13 +296,46 @@ def read_hists_from_file(model_name):
     return hists_file['trn_hist'], hists_file['val_hist']
 
 def read_model_from_files(model_name):
-    """ Reads state_dict for 'classifier' and 'vocab' from PT-files. Returns
-    the built classifier and vocab. """
-    model_file_name, vocab_file_name = generate_model_file_names(model_name)
-    vocab = torch.load(vocab_file_name)
-    classifier = build_classifier(vocab)
-    classifier.load_state_dict(torch.load(model_file_name))
-    return classifier, vocab
+    """ Reads the classifier from a PT-file and its embedding from a NPY-file,
+    which is memory mapped instead of being copied. Returns the built
+    classifier, a dict which maps tokens to embedding rows and the tuple (min,
+    max) for the normalization of counters from training. Unknown tokens belong
+    to row 0. The tuple is None for models which have been saved without it.
+    Models with hashed tokens come with a HashingStoi instead of the dict.
+    """
+    import torch
+    from data_preprocessor import HashingStoi
+    from pld_classifier import build_classifier
+
+    model_file_name, emb_file_name = generate_model_file_names(model_name)
+    model = torch.load(model_file_name)
+    embedding_weight = torch.from_numpy(np.load(emb_file_name, mmap_mode='c'))
+    classifier = build_classifier(embedding_weight, model['params'])
+
+    missing_keys, unexpected_keys = classifier.load_state_dict(
+        model['state_dict'], strict=False)
+    assert missing_keys == ['emb.weight'] and len(unexpected_keys) == 0
+    cnts_range = model.get('cnts_range')
+    stoi = HashingStoi(model['buckets']) if 'buckets' in model \
+        else {token: i for i, token in enumerate(model['itos'])}
+    return classifier, stoi, None if cnts_range is None else tuple(cnts_range)
+
+def read_exported_model(model_name):
+    """ Reads the TorchScript export of a classifier written by
+    'write_exported_model'. Returns the loaded module, which is called like a
+    PLDClassifier, and the dict or HashingStoi and tuple (min, max) like
+    'read_model_from_files', without building a classifier or vocab. """
+    import torch
+    from data_preprocessor import HashingStoi
+
+    extra_files = {'model.json': ''}
+    exported = torch.jit.load(generate_export_file_name(model_name),
+                              map_location='cpu', _extra_files=extra_files)
+    model = json.loads(extra_files['model.json'])
+    stoi = HashingStoi(model['buckets']) if 'buckets' in model \
+        else {token: i for i, token in enumerate(model['itos'])}
+    cnts_range = model['cnts_range']
+    return exported, stoi, None if cnts_range is None else tuple(cnts_range)
 
 def read_pld_list(rel_path, verbose=False):
     """ Reads PLDs from a CSV-file referred to by 'rel_path'. Assumes that the
@@ -64,28 +355,81 @@ def read_pld_list(rel_path, verbose=False):
     print_log(f"Read {pld_counter} PLDs from '{rel_path}'.", verbose)
     return pld_list
 
-def read_tweets_from_csv(rel_path, verbose=False):
-    """ Reads data from a CSV-file referred to by 'rel_path'. Returns lists of
-    strings as fetched from SPARQL-endpoint. """
-    pld_ls, tweet_cnt_ls = [], []
-    emos_pos_ls, emos_neg_ls, tags_ls, tweet_ids_ls = [], [], [], []
+def read_results_from_csv(rel_path):
+    """ Reads PLDs and confidences from a CSV-file with results written by
+    'write_results_to_csv' or with gold PLDs referred to by 'rel_path'. Like
+    'Eval.java', takes everything before the first comma of a line as PLD and
+    strips Unix and Windows line breaks. Returns the PLDs as list and the
+    confidences as np.array, which are NaN for lines without one. """
+    pld_ls, confidence_ls = [], []
+    with open(rel_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            pld, _, confidence = line.rstrip('\r\n').partition(',')
+            pld_ls.append(pld)
+            confidence_ls.append(float(confidence) if confidence else np.nan)
+    return pld_ls, np.array(confidence_ls, dtype=np.float64)
+
+def iter_tweets_from_csv(rel_path, chunk_size=1000, verbose=False,
+                         byte_range=None):
+    """ Reads data from a CSV-file referred to by 'rel_path' in chunks of up to
+    'chunk_size' rows. Yields tuples (chunk, n_bytes), where 'chunk' holds
+    lists of strings like 'read_tweets_from_csv' and 'n_bytes' is the number of
+    bytes which have been processed so far. If 'byte_range' is a tuple (start,
+    stop) of line starts, only the rows within these bytes are read. """
+    assert chunk_size > 0
+    n_bytes, n_rows = 0, 0
+
+    def decode_lines(file, stop=None):
+        """ Decodes lines from binary 'file' until position 'stop' and counts
+        their bytes. """
+        nonlocal n_bytes
+        for line in file:
+            n_bytes += len(line)
+            yield line.decode('utf-8')
+            if stop is not None and file.tell() >= stop:
+                return
 
     csv.register_dialect('skip_space', skipinitialspace=True)
     csv.field_size_limit(600000)
-    with open(rel_path, 'r') as f:
-        reader = csv.DictReader(f , delimiter=',', dialect='skip_space')
+    with open(rel_path, 'rb') as f:
+        if byte_range is None:
+            lines = decode_lines(f)
+        else:
+            header = f.readline().decode('utf-8')
+            f.seek(byte_range[0])
+            lines = itertools.chain([header], decode_lines(f, byte_range[1]))
+        reader = csv.DictReader(lines, delimiter=',', dialect='skip_space')
 
+        chunk = ([], [], [], [], [], [])
         for row in reader:
-            d_row = dict(row)
-            pld_ls.append(d_row['pld'])
-            tweet_cnt_ls.append(d_row['tweet_count'])
-            emos_pos_ls.append(d_row['emos_pos'])
-            emos_neg_ls.append(d_row['emos_neg'])
-            tags_ls.append(d_row['tags'])
-            #tweet_ids_ls.append(d_row['tweet_ids'])
+            pld_ls, tweet_cnt_ls, emos_pos_ls, emos_neg_ls, tags_ls, \
+                tweet_ids_ls = chunk
+            pld_ls.append(row['pld'])
+            tweet_cnt_ls.append(row['tweet_count'])
+            emos_pos_ls.append(row['emos_pos'])
+            emos_neg_ls.append(row['emos_neg'])
+            tags_ls.append(row['tags'])
+            tweet_ids_ls.append(row['tweet_ids'])
+
+            if len(pld_ls) == chunk_size:
+                n_rows += len(pld_ls)
+                yield chunk, n_bytes
+                chunk = ([], [], [], [], [], [])
+        if len(chunk[0]) > 0:
+            n_rows += len(chunk[0])
+            yield chunk, n_bytes
 
-    print_log(f"Read {len(pld_ls)} rows from '{rel_path}'.", verbose)
-    return pld_ls, tweet_cnt_ls, emos_pos_ls, emos_neg_ls, tags_ls, tweet_ids_ls
+    print_log(f"Read {n_rows} rows ({n_bytes} bytes) from '{rel_path}'.",
+              verbose)
+
+def read_tweets_from_csv(rel_path, verbose=False):
+    """ Reads data from a CSV-file referred to by 'rel_path'. Returns lists of
+    strings as fetched from SPARQL-endpoint. """
+    tweets = ([], [], [], [], [], [])
+    for chunk, _ in iter_tweets_from_csv(rel_path, verbose=verbose):
+        for column_ls, chunk_ls in zip(tweets, chunk):
+            column_ls.extend(chunk_ls)
+    return tweets
 
 # Writer
 
@@ -94,11 +438,61 @@ def write_hists_to_file(model_name, trn_hist, val_hist):
     hists_file_name = generate_hists_file_name(model_name)
     np.savez(hists_file_name, trn_hist=trn_hist, val_hist=val_hist)
 
-def write_model_to_files(model_name, classifier, vocab):
-    """ Writes state_dict for 'classifier' and 'vocab' into PT-files. """
-    model_file_name, vocab_file_name = generate_model_file_names(model_name)
-    torch.save(classifier.state_dict(), model_file_name)
-    torch.save(vocab, vocab_file_name)
+def write_leaderboard_to_csv(sweep_name, rows, keys):
+    """ Writes the dicts 'rows' with one trial each into the leaderboard of
+    'sweep_name'. Writes a header with 'keys' and their values in this order.
+    """
+    with open(generate_leaderboard_file_name(sweep_name), 'w',
+              encoding='utf-8') as file:
+        fw = csv.writer(file, delimiter=',', quotechar='|',
+                        quoting=csv.QUOTE_MINIMAL)
+        fw.writerow(keys)
+        for row in rows:
+            fw.writerow([row[key] for key in keys])
+
+def write_metrics_to_file(model_name, stage, metrics):
+    """ Writes the dict 'metrics' of 'stage' for 'model_name' into a JSON-file.
+    """
+    with open(generate_metrics_file_name(model_name, stage), 'w') as file:
+        json.dump(metrics, file, indent=2)
+
+def write_exported_model(model_name, exported, stoi, cnts_range):
+    """ Writes the TorchScript module 'exported' into a PT-file together with
+    its tokens from the dict or HashingStoi 'stoi' and the tuple (min, max)
+    'cnts_range' as JSON, so that loading it needs neither pickled objects nor
+    the classes of the classifier. """
+    import torch
+
+    model = {'cnts_range': None if cnts_range is None else
+             [int(cnt) for cnt in cnts_range]}
+    if hasattr(stoi, 'buckets'):
+        model['buckets'] = stoi.buckets
+    else:
+        model['itos'] = sorted(stoi, key=stoi.get)
+    torch.jit.save(exported, generate_export_file_name(model_name),
+                   _extra_files={'model.json': json.dumps(model)})
+
+def write_model_to_files(model_name, classifier, vocab, cnts_range):
+    """ Writes state_dict, parameters and tokens from 'vocab' for 'classifier'
+    and the tuple (min, max) 'cnts_range', which normalizes counters, into a
+    PT-file and its embedding into a NPY-file. The embedding is stored only
+    once and without rows for tokens without pretrained vectors. A HashingVocab
+    is saved by its number of buckets and keeps all rows. """
+    import torch
+
+    model_file_name, emb_file_name = generate_model_file_names(model_name)
+    state_dict = {key: value for key, value in classifier.state_dict().items()
+                  if key != 'emb.weight'}
+    model = {'state_dict': state_dict, 'params': vars(classifier.params),
+             'cnts_range': list(cnts_range)}
+    if hasattr(vocab, 'buckets'):
+        model['buckets'] = vocab.buckets
+        embedding_weight = classifier.emb.weight.detach().cpu().numpy()
+    else:
+        model['itos'], embedding_weight = trim_embedding(vocab.itos,
+                                                         classifier.emb.weight)
+    torch.save(model, model_file_name)
+    np.save(emb_file_name, embedding_weight)
 
 def write_results_to_csv(plds, class_ls, confidenc_ls, rel_path_l, rel_path_r):
     """ Writes names from 'plds' and the corresponding confidences from
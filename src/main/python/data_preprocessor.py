@@ -1,83 +1,283 @@
+import hashlib
+import heapq
 import numpy as np
-import torch
+import zlib
 from collections import Counter
-from torchtext.data.utils import get_tokenizer
-from torch.utils.data import DataLoader
-from torchtext.vocab import Vocab
+
+class CountMinSketch(object):
+    """ Approximate counter for tokens with fixed memory of 'depth' rows with
+    'width' counters each. Estimates never undercount. """
+
+    def __init__(self, width=1<<20, depth=4, seed=0):
+        rng = np.random.default_rng(seed)
+        self.width = width
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.coeffs = rng.integers(1, (1<<31) - 1, size=(depth, 2))
+
+    def add(self, token_hashes, cnts):
+        """ Adds 'cnts' to the tokens with the crc32-hashes 'token_hashes'. """
+        for row, cols in zip(self.table, self.columns(token_hashes)):
+            np.add.at(row, cols, cnts)
+
+    def columns(self, token_hashes):
+        """ Maps 'token_hashes' to one column per row of the table. """
+        token_hashes = np.asarray(token_hashes, dtype=np.int64)
+        return [(a * token_hashes + b) % ((1<<31) - 1) % self.width
+                for a, b in self.coeffs]
+
+    def query(self, token_hashes):
+        """ Returns estimated counts for the tokens with 'token_hashes'. """
+        return np.min([row[cols] for row, cols
+                       in zip(self.table, self.columns(token_hashes))], axis=0)
+
+class HashingStoi(object):
+    """ Maps each token to one of 'buckets' embedding rows via its crc32-hash.
+    Row 0 is reserved for '<unk>'. Can replace the dict 'stoi' of a vocab. """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    def __getitem__(self, token):
+        return 1 + zlib.crc32(token.encode('utf-8')) % self.buckets
+
+    def get(self, token, default=0):
+        return self[token]
+
+class HashingVocab(object):
+    """ Vocab with a fixed number of embedding rows, see 'build_hashing_vocab'.
+    """
+
+    def __init__(self, buckets, vectors):
+        self.buckets = buckets
+        self.stoi = HashingStoi(buckets)
+        self.vectors = vectors
 
 def append_cnts_to_emos(emos_arr, cnts_arr):
     """ Appends 'cnts_arr' as new column to 'emos_arr'. """
     return np.hstack((emos_arr, cnts_arr.reshape(-1, 1))) # concat rows
 
-def build_vocab(tags_str_arr):
-    """ Builds vocab for all tokens in 'tags_str_arr'. """
-    tokenizer = get_tokenizer('basic_english')
-    counter = Counter()
-
-    for tags_str in tags_str_arr:
-        counter.update(tokenizer(tags_str))
+def build_hashing_vocab(counter, buckets, min_freq=1, max_size=None,
+                        vectors_path=None):
+    """ Builds a HashingVocab with 'buckets' rows plus one row for '<unk>'.
+    Each row holds the mean of the pretrained vectors of the tokens from
+    'counter' in its bucket, weighted by their counts. Only the tokens from
+    'select_tokens' with 'min_freq' and 'max_size' contribute vectors, which
+    are looked up via 'load_vectors' without building a vocab, but all tokens
+    map to a bucket during training and evaluation. """
+    import torch
+    tokens = select_tokens(counter, min_freq, max_size)
+    vectors = load_vectors(tokens, vectors_path)
+    rows = torch.tensor([HashingStoi(buckets)[token] for token in tokens],
+                        dtype=torch.int64)
+    weights = torch.tensor([counter[token] for token in tokens],
+                           dtype=vectors.dtype)
+    weights[vectors.abs().sum(dim=1) == 0] = 0 # no pretrained vector
 
-    return Vocab(counter, min_freq=1, vectors='fasttext.simple.300d'), tokenizer
+    bucket_vectors = torch.zeros(buckets + 1, vectors.shape[1],
+                                 dtype=vectors.dtype)
+    bucket_weights = torch.zeros(buckets + 1, dtype=vectors.dtype)
+    bucket_vectors.index_add_(0, rows, vectors * weights.unsqueeze(1))
+    bucket_weights.index_add_(0, rows, weights)
+    bucket_vectors /= bucket_weights.clamp(min=1).unsqueeze(1)
+    return HashingVocab(buckets, bucket_vectors)
 
-def build_dataloader(pld_dataset, batch_size, vocab, tokenizer):
-    """ Builds dataloader for 'pld_dataset' and transforms 'tags_str' into word
-    vectors as tensors. Each batch contains 'batch_size' samples. """
-    tags_pipeline = lambda x: [vocab[token] for token in tokenizer(x)]
+def build_tags_vocab(token_streams, min_freq=1, max_size=None, buckets=None,
+                     sketch_width=None, vectors_path=None):
+    """ Counts tokens from 'token_streams', a list of tuples (tokens, tag_ids,
+    tag_counts) like 'count_tokens' expects, exactly or in two passes with a
+    CountMinSketch with 'sketch_width' counters per row, if it is given, see
+    'count_tokens_pruned'. Builds a vocab with 'min_freq' and 'max_size' or a
+    HashingVocab with 'buckets' rows, if it is given. Takes vectors from the
+    embedding store at 'vectors_path', if it is given. """
+    if sketch_width is None:
+        counter = sum((count_tokens(tokens, tag_ids, tag_counts)
+                       for tokens, tag_ids, tag_counts in token_streams),
+                      Counter())
+    else:
+        counter = count_tokens_pruned(token_streams, min_freq, sketch_width)
+    if buckets is None:
+        return build_vocab(counter, min_freq, max_size, vectors_path)
+    return build_hashing_vocab(counter, buckets, min_freq, max_size,
+                               vectors_path)
 
-    def collate_batch(batch):
-        """ Transforms 'tags_str' into word vectors using 'tags_pipeline'. """
-        label_ls, emos_ls, tags_vec_ls, offsets = [], [], [], [0]
-        for sample in batch:
-            label, emos, tags_str = sample.values()
-            label_ls.append(label)
-            emos_ls.append(emos)
-            tags_vec = torch.tensor(tags_pipeline(tags_str), dtype=torch.int64)
-            tags_vec_ls.append(tags_vec)
-            offsets.append(tags_vec.size(0))
+def build_vocab(counter, min_freq=1, max_size=None, vectors_path=None):
+    """ Builds vocab for the tokens in the Counter 'counter', which occur at
+    least 'min_freq' times. Keeps only the 'max_size' most frequent tokens, if
+    it is given. Looks up the vectors of the kept tokens in the embedding
+    store at 'vectors_path', if it is given, and loads the fastText vectors
+    via torchtext otherwise. """
+    from torchtext.vocab import Vocab # slow import, only needed for training
+    if vectors_path is None:
+        return Vocab(counter, max_size=max_size, min_freq=min_freq,
+                     vectors='fasttext.simple.300d')
 
-        label_ts = torch.tensor(label_ls, dtype=torch.int64)
-        emos_ts = torch.tensor(emos_ls, dtype=torch.int64)
-        tags_ts = torch.cat(tags_vec_ls)
-        offsets = torch.tensor(offsets[:-1]).cumsum(dim=0)
-        return label_ts, emos_ts, tags_ts, offsets
+    vocab = Vocab(counter, max_size=max_size, min_freq=min_freq)
+    vocab.vectors = load_vectors(vocab.itos, vectors_path)
+    return vocab
 
-    return DataLoader(pld_dataset, batch_size=batch_size, num_workers=0,
-                      shuffle=False, drop_last=False, collate_fn=collate_batch)
+def collapse_tag_ids(tag_ids_ls):
+    """ Collapses the token ids of each sample from the iterable 'tag_ids_ls'
+    into distinct ids in the order of their first occurrence and their counts.
+    Returns flat np.arrays with ids and counts and the offsets of the samples.
+    """
+    tag_cnts_ls = [Counter(tag_ids) for tag_ids in tag_ids_ls]
+    tag_ids = np.fromiter((tag_id for tag_cnts in tag_cnts_ls
+                           for tag_id in tag_cnts), dtype=np.int64)
+    tag_counts = np.fromiter((cnt for tag_cnts in tag_cnts_ls
+                              for cnt in tag_cnts.values()), dtype=np.int64)
+    tag_offsets = np.cumsum([0] + [len(tag_cnts) for tag_cnts in tag_cnts_ls])
+    return tag_ids, tag_counts, tag_offsets
 
 def concatenate_colums(left_arr, right_arr):
     """ Concatenates 'left_arr' and 'right_arr' to get one feature array. """
     return np.concatenate((left_arr, right_arr), axis=0)
 
+def count_tokens(tokens, tag_ids, tag_counts=None):
+    """ Counts the occurrences of all 'tokens' in the stream 'tag_ids', which
+    refers to 'tokens' by index and occurs 'tag_counts' times per entry, if it
+    is given. Returns a Counter. """
+    cnts = np.bincount(tag_ids, weights=tag_counts,
+                       minlength=len(tokens)).astype(np.int64)
+    return Counter(dict(zip(tokens.tolist(), cnts.tolist())))
+
+def count_tokens_pruned(token_streams, min_freq=1, width=1<<20, depth=4,
+                        chunk_size=1<<16):
+    """ Counts tokens from 'token_streams', a list of tuples (tokens, tag_ids,
+    tag_counts) like 'count_tokens' expects, in two passes over chunks of
+    'chunk_size' entries, see 'iter_chunk_counts'. The first pass adds all
+    counts to a CountMinSketch of 'depth' rows with 'width' counters. The
+    second one counts exactly, but only the tokens whose estimate is at least
+    'min_freq'. As estimates never undercount, the result holds the exact
+    counts of all tokens which occur at least 'min_freq' times, while memory
+    is bounded by the sketch, one chunk and the kept tokens. Returns a Counter.
+    """
+    sketch = CountMinSketch(width, depth)
+    for _, token_hashes, cnts in iter_chunk_counts(token_streams, chunk_size):
+        sketch.add(token_hashes, cnts)
+
+    counter = Counter()
+    for tokens, token_hashes, cnts in iter_chunk_counts(token_streams,
+                                                        chunk_size):
+        kept = np.flatnonzero(sketch.query(token_hashes) >= min_freq)
+        counter.update(dict(zip(tokens[kept].tolist(), cnts[kept].tolist())))
+    return counter
+
+def concatenate_offsets(l_offsets, r_offsets):
+    """ Concatenates the offsets 'l_offsets' and 'r_offsets' of two token id
+    streams, such that they refer to the concatenation of both streams. """
+    return np.concatenate((l_offsets, r_offsets[1:] + l_offsets[-1]))
+
+def encode_tags(tokens, tag_ids, stoi):
+    """ Maps the stream 'tag_ids', which refers to 'tokens' by index, to token
+    ids from the dict 'stoi'. Unknown tokens get id 0, i.e., '<unk>'. Returns
+    a flat np.array. """
+    vocab_ids = np.array([stoi.get(token, 0) for token in tokens.tolist()],
+                         dtype=np.int64)
+    return vocab_ids[tag_ids]
+
+def fit_cnts_range(*cnts_str_lss):
+    """ Parses ints from strings in all lists from 'cnts_str_lss'. Returns
+    their (min, max) as tuple of ints, which normalizes counters in
+    'preprocess_cnts'. """
+    cnts_ls = np.concatenate([np.array([int(cnts_str) for cnts_str in cnts_ls])
+                              for cnts_ls in cnts_str_lss])
+    return int(np.min(cnts_ls)), int(np.max(cnts_ls))
+
+def generate_fingerprints(cnts_str_ls, tweet_ids_str_ls):
+    """ Hashes the counter from 'cnts_str_ls' and the sorted '+'-separated ids
+    from 'tweet_ids_str_ls' per PLD, so that a fingerprint only changes if the
+    PLD's tweets change. Returns a np.array with one hex string per PLD. """
+    def fingerprint(cnts_str, ids_str):
+        ids_str = '+'.join(sorted(ids_str.split('+'))) # order is arbitrary
+        return hashlib.blake2b(f"{int(cnts_str)}:{ids_str}".encode('utf-8'),
+                               digest_size=16).hexdigest()
+
+    return np.array([fingerprint(cnts_str, ids_str) for cnts_str, ids_str
+                     in zip(cnts_str_ls, tweet_ids_str_ls)], dtype=str)
+
 def generate_labels(num, left=True):
     """ Generates 'num' labels. If 'left' is True, each label is 0, else 1. """
     return np.zeros(num, dtype=int) if left else np.ones(num, dtype=int)
 
-def preprocess_cnts(cnts_str_ls):
-    """ Parses ints from strings in 'cnts_str_ls' and normalizes the whole list.
-    Returns a np.array with one normalized float per PLD. """
+def iter_chunk_counts(token_streams, chunk_size=1<<16):
+    """ Reads 'token_streams', a list of tuples (tokens, tag_ids, tag_counts)
+    like 'count_tokens' expects, in chunks of 'chunk_size' entries. Yields the
+    distinct tokens of each chunk as np.array with their crc32-hashes and
+    their counts within the chunk. """
+    for tokens, tag_ids, tag_counts in token_streams:
+        for start in range(0, len(tag_ids), chunk_size):
+            stop = start + chunk_size
+            ids, inverse = np.unique(tag_ids[start:stop], return_inverse=True)
+            cnts = np.bincount(inverse, weights=None if tag_counts is None
+                                                else tag_counts[start:stop],
+                               minlength=len(ids)).astype(np.int64)
+            chunk_tokens = tokens[ids]
+            token_hashes = np.array([zlib.crc32(token.encode('utf-8'))
+                                     for token in chunk_tokens.tolist()],
+                                    dtype=np.int64)
+            yield chunk_tokens, token_hashes, cnts
+
+def load_vectors(tokens, vectors_path=None):
+    """ Looks up the pretrained vectors of the list 'tokens' in the embedding
+    store at 'vectors_path', if it is given, and in the fastText vectors
+    loaded via torchtext otherwise. Unknown tokens get zero vectors. Returns
+    a tensor with one row per token. """
+    if vectors_path is None:
+        from torchtext.vocab import FastText # slow import, only for training
+        return FastText(language='simple').get_vecs_by_tokens(tokens)
+
+    from embedding_store import EmbeddingStore
+    return EmbeddingStore(vectors_path).get_vecs_by_tokens(tokens)
+
+def preprocess_cnts(cnts_str_ls, cnts_range=None):
+    """ Parses ints from strings in 'cnts_str_ls' and normalizes them with the
+    tuple (min, max) from 'cnts_range', which has been fitted on the training
+    data. Fits it on 'cnts_str_ls' itself, if it is None. Returns a np.array
+    with one normalized float per PLD, which is 0 if min and max are equal. """
     cnts_ls = np.array([int(cnts_str) for cnts_str in cnts_str_ls])
-    max = np.max(cnts_ls)
-    min = np.min(cnts_ls)
-    return (cnts_ls - min) / (max - min) # normalization using broadcasting
+    min, max = fit_cnts_range(cnts_ls) if cnts_range is None else cnts_range
+    span = (max - min) if max > min else 1
+    return (cnts_ls - min) / span # normalization using broadcasting
+
+def parse_emos_strs(emos_str_ls):
+    """ Parses all floats from the '+'-separated strings in 'emos_str_ls' at
+    once. Returns a flat np.array with all floats and a np.array with the
+    number of floats per string. """
+    lens = np.array([emos_str.count('+') + 1 for emos_str in emos_str_ls])
+    emos_arr = np.fromstring('+'.join(emos_str_ls), dtype=float, sep='+')
+    assert emos_arr.size == np.sum(lens), "Found empty emotion score."
+    return emos_arr, lens
 
 def preprocess_emos(emos_pos_str_ls, emos_neg_str_ls):
     """ Parses lists of floats from strings in 'emos_pos_str_ls' and
     'emos_neg_str_ls', calculates the arithmetic mean and standard deviation
-    per list and returns them as np.array. """
-    parse_emos_str = lambda emos_str: list(map(float, emos_str.split('+')))
-
-    emos_pos_ls_ls = [parse_emos_str(emos_str) for emos_str in emos_pos_str_ls]
-    emos_neg_ls_ls = [parse_emos_str(emos_str) for emos_str in emos_neg_str_ls]
+    per list and returns them as np.array. Positive and negative lists are
+    parsed into one flat array and reduced per segment at once. """
+    emos_arr, lens = parse_emos_strs(list(emos_pos_str_ls)
+                                     + list(emos_neg_str_ls))
+    starts = np.cumsum(lens) - lens # index of first float per segment
 
-    emos_pos_avg_ls = [np.mean(emos_ls) for emos_ls in emos_pos_ls_ls]
-    emos_neg_avg_ls = [np.mean(emos_ls) for emos_ls in emos_neg_ls_ls]
-    emos_pos_std_ls = [np.std(emos_ls) for emos_ls in emos_pos_ls_ls]
-    emos_neg_std_ls = [np.std(emos_ls) for emos_ls in emos_neg_ls_ls]
+    emos_avg = np.add.reduceat(emos_arr, starts) / lens
+    emos_dev = emos_arr - np.repeat(emos_avg, lens)
+    emos_std = np.sqrt(np.add.reduceat(emos_dev * emos_dev, starts) / lens)
 
-    return np.array([emos_pos_avg_ls, emos_neg_avg_ls, emos_pos_std_ls,
-                     emos_neg_std_ls]).T
+    num = len(emos_pos_str_ls) # first half positive, second half negative
+    return np.array([emos_avg[:num], emos_avg[num:], emos_std[:num],
+                     emos_std[num:]]).T
 
 def preprocess_tags(tags):
     """ Replaces separator '+' with spaces in and lower cases strings from
     'tags'. Returns a np.array with one string per PLD. """
     return np.array([tag_str.replace('+', ' ').lower() for tag_str in tags])
+
+def select_tokens(counter, min_freq=1, max_size=None):
+    """ Selects the tokens from the Counter 'counter', which occur at least
+    'min_freq' times, and only the 'max_size' most frequent ones, if it is
+    given, in the order of a vocab: by descending count, then alphabetically.
+    Uses a heap of 'max_size' tokens instead of sorting all. Returns a list.
+    """
+    items = [item for item in counter.items() if item[1] >= min_freq]
+    key = lambda item: (-item[1], item[0])
+    items = sorted(items, key=key) if max_size is None \
+        else heapq.nsmallest(max_size, items, key=key)
+    return [token for token, _ in items]
@@ -1,25 +1,90 @@
 """
-Retrieves training data from the SPARQL-endpoint of TweetsCOV19.
+Retrieves training data from the SPARQL-endpoint of TweetsCOV19 or from a local
+index of its dumps built by 'dump_indexer.py'.
 Example call: python -m data_retriever '../../../input_data/left_train.csv'
 """
 
+import hashlib
+import io
+import json
+import socket
 import sys
+import threading
+import time
 from argparse import ArgumentParser
-from SPARQLWrapper import SPARQLWrapper, JSON
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPSConnection
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode, urlsplit
 
-from data_file_handler import read_pld_list, write_tweets_to_csv
+from data_file_handler import DumpIndex, ResponseCache, generate_cache_path, \
+                              read_pld_list, write_tweets_to_csv
 from helpers import print_log
 
 SPARQL_URL = 'https://data.gesis.org/tweetscov19/sparql'
+TRANSIENT_CODES = (429, 502, 503, 504) # rate limit and unavailable endpoint
+SPLIT_CODES = (413, 414, 500) # too large batch and internal endpoint error
 
 # Data Retrieval
 
-def retrieve_tweets(pld):
-    """ Retrieves aggregated training data from the TweetsCOV19 SPARQL-endpoint
-    and returnes a dict. All tweets related to 'pld' are taken into account. """
-    sparql = SPARQLWrapper(SPARQL_URL)
-    sparql.setReturnFormat(JSON)
-    sparql.setQuery(f"""
+class SPARQLClient(object):
+    """ Client for the SPARQL-endpoint at 'url', which sends queries via POST,
+    as long VALUES-blocks do not fit into URLs, and returns JSON results. All
+    queries share one persistent HTTP(S) connection, so that TCP and TLS
+    handshakes are paid once. Not thread-safe, each thread needs its own
+    client. """
+
+    HEADERS = {'Accept': 'application/sparql-results+json',
+               'Content-Type': 'application/x-www-form-urlencoded'}
+
+    def __init__(self, url=SPARQL_URL, timeout=None):
+        """ Prepares the connection to 'url', which is opened by the first
+        query. Each request is aborted after 'timeout' seconds, if it is
+        given. """
+        parts = urlsplit(url)
+        self.url = url
+        self.path = (parts.path or '/') + \
+            (f"?{parts.query}" if parts.query else '')
+        connection_class = HTTPSConnection if parts.scheme == 'https' \
+            else HTTPConnection
+        self.connection = connection_class(parts.netloc, timeout=timeout)
+
+    def close(self):
+        self.connection.close()
+
+    def query(self, query):
+        """ Sends 'query' and returns the parsed JSON response. Reopens a kept
+        alive connection once, if the endpoint closed it in the meantime.
+        Raises an HTTPError for error responses. Closes the connection after
+        any other error, e.g., a timeout, so that the next query starts on a
+        fresh one. """
+        body = urlencode({'query': query}).encode('utf-8')
+        for may_reopen in (True, False):
+            reused = self.connection.sock is not None
+            try:
+                self.connection.request('POST', self.path, body, self.HEADERS)
+                response = self.connection.getresponse()
+                data = response.read()
+            except (BrokenPipeError, ConnectionResetError):
+                self.connection.close()
+                if reused and may_reopen:
+                    continue # closed by the endpoint while idle
+                raise
+            except BaseException:
+                self.connection.close()
+                raise
+            break
+        if response.status >= 400:
+            raise HTTPError(self.url, response.status, response.reason,
+                            response.headers, io.BytesIO(data))
+        return json.loads(data.decode('utf-8'))
+
+def build_query(plds):
+    """ Builds the query which aggregates all tweets related to each PLD from
+    'plds'. The endpoint returns one row per PLD with at least one tweet. """
+    pld_values = ' '.join(f'"{pld}"' for pld in plds)
+    return f"""
         PREFIX onyx: <http://www.gsi.dit.upm.es/ontologies/onyx/ns#>
         PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
         PREFIX schema: <http://schema.org/>
@@ -42,7 +107,7 @@ def retrieve_tweets(pld):
                     onyx:hasEmotionSet ?emotion_set .
                 BIND(REPLACE( REPLACE(STR(?url), "https?://(www.)?", ""),
                     "/.*", "") as ?pld) .
-                FILTER(?pld=\"{pld}\") .
+                VALUES ?pld {{ {pld_values} }} .
 
                 OPTIONAL {{
                     ?tweet schema:mentions ?mention .
@@ -61,8 +126,126 @@ def retrieve_tweets(pld):
         }}
         GROUP BY ?pld
         ORDER BY ?pld
-    """)
-    return sparql.queryAndConvert()
+    """
+
+def is_split_error(error):
+    """ Checks if 'error' might be caused by the size of a batch, i.e., if the
+    endpoint rejected the batch as too large, failed internally or timed out.
+    Other errors, e.g., from rate limiting or lost connections, would also
+    hit the halves of the batch. """
+    if isinstance(error, HTTPError):
+        return error.code in SPLIT_CODES
+    return is_timeout(error)
+
+def is_timeout(error):
+    """ Checks if 'error' stems from a request which timed out. """
+    timeout_errors = (socket.timeout, TimeoutError)
+    return isinstance(error, timeout_errors) or \
+        (isinstance(error, URLError) and isinstance(error.reason,
+                                                    timeout_errors))
+
+def is_transient(error):
+    """ Checks if 'error' is worth a retry of the same query, i.e., it stems
+    from rate limiting or a lost connection rather than from a timeout. """
+    if isinstance(error, HTTPError):
+        return error.code in TRANSIENT_CODES
+    if isinstance(error, URLError):
+        return not is_timeout(error)
+    return isinstance(error, ConnectionError)
+
+def query_hash(url=SPARQL_URL):
+    """ Returns a hash of the endpoint 'url' and the query template, which
+    identifies cached responses of this endpoint for the current version of
+    the query. """
+    return hashlib.sha1(f"{url}\n{build_query([])}".encode('utf-8')).hexdigest()
+
+def retrieve_tweets(plds, client=None):
+    """ Retrieves aggregated training data from the TweetsCOV19 SPARQL-endpoint
+    and returnes a dict. All tweets related to PLDs from 'plds' are taken into
+    account. Reuses the SPARQLClient 'client' if it is given, otherwise a new
+    one is built. """
+    client = SPARQLClient() if client is None else client
+    return client.query(build_query(plds))
+
+def retrieve_tweets_with_retries(plds, client=None, retries=3, delay=1.0):
+    """ Calls 'retrieve_tweets' for 'plds' and repeats it up to 'retries' times
+    on transient errors. Waits 'delay' seconds before the first repetition and
+    doubles the waiting time for each further one. """
+    for attempt in range(retries + 1):
+        try:
+            return retrieve_tweets(plds, client)
+        except (URLError, ConnectionError) as error:
+            if attempt == retries or not is_transient(error):
+                raise
+            time.sleep(delay * 2**attempt)
+
+def retrieve_batch(plds, client=None, retries=3):
+    """ Retrieves aggregated data for the batch 'plds' and returns one dict per
+    PLD. If the endpoint fails due to the size of the batch or a timeout, the
+    batch is split into halves which are retrieved separately. Other errors
+    are raised after the retries of 'retrieve_tweets_with_retries'. """
+    try:
+        return split_tweets(plds,
+                            retrieve_tweets_with_retries(plds, client, retries))
+    except Exception as error:
+        if len(plds) == 1 or not is_split_error(error):
+            raise
+        half = len(plds) // 2
+        return retrieve_batch(plds[:half], client, retries) \
+            + retrieve_batch(plds[half:], client, retries)
+
+def retrieve_tweets_concurrently(pld_list, workers=4, batch_size=20,
+                                 url=SPARQL_URL, timeout=None, retries=3):
+    """ Retrieves aggregated data for all PLDs from 'pld_list' in batches of
+    'batch_size' PLDs with up to 'workers' parallel requests against the
+    endpoint at 'url'. Each thread reuses its own SPARQLClient. Yields tuples
+    (pld, tweets) in the order of 'pld_list', while at most '2*workers' batches
+    are pending at once. """
+    local = threading.local()
+    clients = [] # of all threads, closed when the pool is done
+
+    def fetch(plds):
+        """ Retrieves data for 'plds' with the SPARQLClient of this thread. """
+        if not hasattr(local, 'client'):
+            local.client = SPARQLClient(url, timeout)
+            clients.append(local.client)
+        return retrieve_batch(plds, local.client, retries)
+
+    pending = deque()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for start in range(0, len(pld_list), batch_size):
+                plds = pld_list[start:start+batch_size]
+                pending.append((plds, executor.submit(fetch, plds)))
+                if len(pending) >= 2 * workers:
+                    plds_done, future = pending.popleft()
+                    yield from zip(plds_done, future.result())
+            while pending:
+                plds_done, future = pending.popleft()
+                yield from zip(plds_done, future.result())
+    finally:
+        for client in clients:
+            client.close()
+
+def split_tweets(plds, tweets):
+    """ Splits the grouped result 'tweets' for a batch into one dict per PLD
+    from 'plds'. Each dict has the same structure as 'tweets' and contains no
+    bindings, if there are no tweets related to the corresponding PLD. """
+    bindings = {pld: [] for pld in plds}
+    for tweet in tweets["results"]["bindings"]:
+        bindings[tweet["pld"]["value"]].append(tweet)
+    return [{"head": tweets["head"], "results": {"bindings": bindings[pld]}}
+            for pld in plds]
+
+def retrieve_from_index(pld_list, index_path, rel_path, verbose=False):
+    """ Aggregates tweets for all PLDs from 'pld_list' from the index of dumps
+    at 'index_path' and writes them like 'write_tweets_to_csv' for 'rel_path'.
+    """
+    index = DumpIndex(index_path)
+    for n, (pld, tweets) in enumerate(index.iter_tweets(pld_list), start=1):
+        print_log(f"{n:3d} Retrieved data for '{pld}' from index.", verbose)
+        write_tweets_to_csv(rel_path, tweets, (n==1))
+    index.close()
 
 # Main
 
@@ -73,8 +256,23 @@ def parse_arguments(args):
                 is referenced by 'rel_path'. It writes aggregated results per
                 PLD into a JSON-file in the same directory. """
     parser = ArgumentParser(description=info)
+    parser.add_argument('-b', '--batch', type=int, default=20, metavar='N',
+                        help="specify number of PLDs per query")
+    parser.add_argument('-c', '--cache', default=None, metavar='PATH',
+                        help="specify relative path to the response cache")
+    parser.add_argument('-d', '--dump-index', default=None, metavar='PATH',
+                        help="specify relative path to an index of dumps, "
+                             "which is queried instead of the endpoint")
+    parser.add_argument('-r', '--retries', type=int, default=3, metavar='N',
+                        help="specify number of retries per failed query")
+    parser.add_argument('-t', '--timeout', type=float, default=None,
+                        metavar='S', help="specify timeout per request in s")
+    parser.add_argument('-u', '--url', default=SPARQL_URL,
+                        help="specify URL of the SPARQL-endpoint")
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
                         help="activate output")
+    parser.add_argument('-w', '--workers', type=int, default=4, metavar='N',
+                        help="specify number of parallel requests")
     parser.add_argument('rel_path',
                         help="relative path to CSV-file with PLD names")
 
@@ -85,12 +283,33 @@ def parse_arguments(args):
 
 def main(args):
     parsed_args = parse_arguments(args)
+    assert parsed_args.batch > 0
+    assert parsed_args.retries >= 0
+    assert parsed_args.workers > 0
 
     pld_list = read_pld_list(parsed_args.rel_path, parsed_args.verbose)
+    if parsed_args.dump_index is not None:
+        retrieve_from_index(pld_list, parsed_args.dump_index,
+                            parsed_args.rel_path, parsed_args.verbose)
+        return
+
+    cache_path = parsed_args.cache or generate_cache_path(parsed_args.rel_path)
+    cache = ResponseCache(cache_path, query_hash(parsed_args.url))
+    missing_plds = [pld for pld in pld_list if pld not in cache]
+    print_log(f"{len(pld_list) - len(missing_plds)} PLDs are cached in "
+              f"'{cache_path}'.", parsed_args.verbose)
+
+    results = retrieve_tweets_concurrently(missing_plds, parsed_args.workers,
+                                           parsed_args.batch, parsed_args.url,
+                                           parsed_args.timeout,
+                                           parsed_args.retries)
+    for n, (pld, tweets) in enumerate(results, start=1):
+        print_log(f"{n:3d} Retrieved data for '{pld}'.", parsed_args.verbose)
+        cache.put(pld, tweets)
+
     for n, pld in enumerate(pld_list, start=1):
-        print_log(f"{n:3d} Retrieve data for '{pld}'.", parsed_args.verbose)
-        tweets = retrieve_tweets(pld)
-        write_tweets_to_csv(parsed_args.rel_path, tweets, (n==1))
+        write_tweets_to_csv(parsed_args.rel_path, cache.get(pld), (n==1))
+    cache.close()
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -0,0 +1,286 @@
+"""
+Builds a local index of tweets per PLD from N-Triples dumps of TweetsCOV19, so
+that 'data_retriever.py' can aggregate tweets without the SPARQL-endpoint. The
+dumps are streamed once and may be compressed with gzip or bzip2.
+
+Example call:
+python -m dump_indexer '../../../input_data/tweetscov19_index.sqlite' '../../../input_data/month_2020_04.nt.gz' '../../../input_data/month_2020_05.nt.gz' -j 2 -v
+"""
+
+import bz2
+import gzip
+import json
+import os
+import re
+import sqlite3
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+from helpers import print_log
+
+INDEX_VERSION = 2
+
+ONYX = 'http://www.gsi.dit.upm.es/ontologies/onyx/ns#'
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+RDFS_LABEL = 'http://www.w3.org/2000/01/rdf-schema#label'
+SCHEMA = 'http://schema.org/'
+SIOC = 'http://rdfs.org/sioc/ns#'
+SIOC_T = 'http://rdfs.org/sioc/types#'
+WNA = 'http://www.gsi.dit.upm.es/ontologies/wnaffect/ns#'
+
+# relations of the query in 'data_retriever.py', i.e., one table per class of
+# 'rdf:type' with the column 'node' and one per predicate with columns 's', 'o'
+TYPE_TABLES = {f'<{SIOC}Post>': 'posts',
+               f'<{ONYX}EmotionSet>': 'emotion_sets',
+               f'<{SIOC_T}Tag>': 'tags'}
+PREDICATE_TABLES = {f'<{SCHEMA}citation>': 'citations',
+                    f'<{ONYX}hasEmotionSet>': 'has_emotion_sets',
+                    f'<{ONYX}hasEmotion>': 'has_emotions',
+                    f'<{ONYX}hasEmotionCategory>': 'categories',
+                    f'<{ONYX}hasEmotionIntensity>': 'intensities',
+                    f'<{SCHEMA}mentions>': 'mentions',
+                    f'<{RDFS_LABEL}>': 'labels'}
+ESCAPE_RE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+ESCAPES = {'t': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f'}
+
+# Parsing
+
+def open_dump(rel_path):
+    """ Opens the dump referred to by 'rel_path' as text file. Decompresses it
+    on the fly, if its suffix is '.gz' or '.bz2'. """
+    opener = {'.gz': gzip.open, '.bz2': bz2.open}.get(
+        os.path.splitext(rel_path)[1], open)
+    return opener(rel_path, 'rt', encoding='utf-8')
+
+def parse_pld(url):
+    """ Extracts the PLD from 'url' like the query in 'data_retriever.py'. """
+    return re.sub('/.*', '', re.sub('https?://(www.)?', '', url))
+
+def parse_term(term, bnode_prefix=''):
+    """ Returns the IRI, the blank node label prefixed with 'bnode_prefix' or
+    the lexical form of the literal 'term' in N-Triples syntax. """
+    if term[0] == '<':
+        return term[1:-1]
+    if term[0] == '_':
+        return f'_:{bnode_prefix}{term[2:]}'
+    lexical = term[1:term.rindex('"')]
+    if '\\' not in lexical:
+        return lexical
+    return ESCAPE_RE.sub(lambda m: chr(int(m.group(1)[1:], 16))
+                         if m.group(1)[0] in 'uU'
+                         else ESCAPES.get(m.group(1), m.group(1)), lexical)
+
+def iter_relations(lines, bnode_prefix=''):
+    """ Parses N-Triples from 'lines' and yields tuples (table, row) for all
+    triples which belong to a table from 'TYPE_TABLES' or 'PREDICATE_TABLES'.
+    Other triples are skipped without parsing their objects. Prefixes labels
+    of blank nodes with 'bnode_prefix', as they are local to their file. """
+    for line in lines:
+        parts = line.split(None, 2)
+        if len(parts) < 3 or parts[0][0] == '#':
+            continue
+        s, p, o = parts
+        if p == f'<{RDF_TYPE}>':
+            table = TYPE_TABLES.get(o.rstrip()[:-1].rstrip())
+            if table is not None:
+                yield table, (parse_term(s, bnode_prefix),)
+        elif p in PREDICATE_TABLES:
+            table = PREDICATE_TABLES[p]
+            o = parse_term(o.rstrip()[:-1].rstrip(), bnode_prefix)
+            if table == 'citations':
+                o = parse_pld(o)
+            yield table, (parse_term(s, bnode_prefix), o)
+
+# Index
+
+def create_relation_tables(connection):
+    """ Creates the empty tables for all relations in 'connection'. Each table
+    holds distinct rows, as repeated triples, e.g., the label of a Hashtag per
+    tweet, would multiply the rows of joins. """
+    for table in TYPE_TABLES.values():
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                           "(node TEXT, UNIQUE (node))")
+    for table in PREDICATE_TABLES.values():
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                           "(s TEXT, o TEXT, UNIQUE (s, o))")
+
+def stage_dump(rel_path, stage_path, bnode_prefix='', block_size=100000):
+    """ Streams the dump referred to by 'rel_path' and inserts its relevant
+    triples into the tables of a new SQLite-file at 'stage_path'. Inserts
+    'block_size' rows per table at once. Returns the number of rows. """
+    if os.path.exists(stage_path):
+        os.remove(stage_path)
+    connection = sqlite3.connect(stage_path)
+    connection.execute("PRAGMA journal_mode=OFF")
+    connection.execute("PRAGMA synchronous=OFF")
+    create_relation_tables(connection)
+
+    blocks = {table: [] for table in (*TYPE_TABLES.values(),
+                                      *PREDICATE_TABLES.values())}
+    def insert(table):
+        """ Inserts and clears the block of rows for 'table'. """
+        placeholders = '?' if table in TYPE_TABLES.values() else '?, ?'
+        connection.executemany(f"INSERT OR IGNORE INTO {table} "
+                               f"VALUES ({placeholders})", blocks[table])
+        blocks[table].clear()
+
+    num_rows = 0
+    with open_dump(rel_path) as lines, connection:
+        for table, row in iter_relations(lines, bnode_prefix):
+            blocks[table].append(row)
+            num_rows += 1
+            if len(blocks[table]) >= block_size:
+                insert(table)
+        for table in blocks:
+            insert(table)
+    connection.close()
+    return num_rows
+
+def merge_stages(connection, stage_paths):
+    """ Appends the relations of the SQLite-files from 'stage_paths' to those
+    in 'connection'. """
+    for stage_path in stage_paths:
+        connection.execute("ATTACH DATABASE ? AS stage", (stage_path,))
+        with connection:
+            for table in (*TYPE_TABLES.values(), *PREDICATE_TABLES.values()):
+                connection.execute(f"INSERT OR IGNORE INTO {table} "
+                                   f"SELECT * FROM stage.{table} "
+                                   "ORDER BY rowid")
+        connection.execute("DETACH DATABASE stage")
+
+def join_relations(connection):
+    """ Joins the relations in 'connection' like the query in
+    'data_retriever.py' into the table 'pld_tweets' with one row per PLD,
+    tweet and pair of emotion intensities and the table 'tweet_tags' with one
+    row per tweet and distinct Hashtag, and drops the relations. Both keep the
+    position of the first occurrence in the dumps, by which 'DumpIndex' orders
+    the aggregates, as SQLite does not guarantee the order of 'group_concat'.
+    """
+    with connection:
+        connection.execute("""
+            CREATE TABLE tweet_tags AS
+            SELECT m.s AS tweet, l.o AS tag, MIN(m.rowid) AS position
+            FROM mentions m
+            JOIN tags t ON t.node = m.o
+            JOIN labels l ON l.s = m.o
+            GROUP BY m.s, l.o""")
+        connection.execute("CREATE INDEX tweet_tags_tweet ON tweet_tags "
+                           "(tweet)")
+        connection.execute("""
+            CREATE TABLE pld_tweets AS
+            SELECT c.o AS pld, p.node AS tweet, ip.o AS emo_pos,
+                ineg.o AS emo_neg, MIN(p.rowid) AS position
+            FROM posts p
+            JOIN citations c ON c.s = p.node
+            JOIN has_emotion_sets hes ON hes.s = p.node
+            JOIN emotion_sets es ON es.node = hes.o
+            JOIN has_emotions hneg ON hneg.s = hes.o
+            JOIN categories cneg ON cneg.s = hneg.o AND cneg.o = ?
+            JOIN intensities ineg ON ineg.s = hneg.o
+            JOIN has_emotions hpos ON hpos.s = hes.o
+            JOIN categories cpos ON cpos.s = hpos.o AND cpos.o = ?
+            JOIN intensities ip ON ip.s = hpos.o
+            GROUP BY c.o, p.node, ip.o, ineg.o""",
+            (f'{WNA}negative-emotion', f'{WNA}positive-emotion'))
+        connection.execute("CREATE INDEX pld_tweets_pld ON pld_tweets (pld)")
+        for table in (*TYPE_TABLES.values(), *PREDICATE_TABLES.values()):
+            connection.execute(f"DROP TABLE {table}")
+    connection.execute("VACUUM")
+
+def gen_sources_meta(dump_paths):
+    """ Generates the meta data which identifies the dumps 'dump_paths'. """
+    return {'version': INDEX_VERSION,
+            'dumps': [[os.path.abspath(rel_path), os.stat(rel_path).st_size,
+                       os.stat(rel_path).st_mtime_ns]
+                      for rel_path in dump_paths]}
+
+def is_index_valid(index_path, dump_paths):
+    """ Checks if the index at 'index_path' has been built from the current
+    versions of 'dump_paths'. """
+    if not os.path.exists(index_path):
+        return False
+    connection = sqlite3.connect(index_path)
+    try:
+        row = connection.execute("SELECT value FROM meta WHERE key='sources'"
+                                 ).fetchone()
+    except sqlite3.OperationalError: # no index
+        row = None
+    connection.close()
+    return row is not None \
+        and json.loads(row[0]) == gen_sources_meta(dump_paths)
+
+def build_dump_index(index_path, dump_paths, jobs=1, verbose=False):
+    """ Builds the index at 'index_path' from the N-Triples dumps 'dump_paths'.
+    Stages each dump in its own SQLite-file, in 'jobs' processes if 'jobs' is
+    greater than 1, merges them and joins their relations into the table
+    'pld_tweets'. Replaces an existing index only when it is complete. """
+    stage_paths = [f"{index_path}.{i}.tmp" for i in range(len(dump_paths))]
+    bnode_prefixes = [f"{i}_" for i in range(len(dump_paths))]
+    if jobs > 1 and len(dump_paths) > 1:
+        with ProcessPoolExecutor(min(jobs, len(dump_paths))) as executor:
+            row_counts = list(executor.map(stage_dump, dump_paths,
+                                           stage_paths, bnode_prefixes))
+    else:
+        row_counts = list(map(stage_dump, dump_paths, stage_paths,
+                              bnode_prefixes))
+    for rel_path, row_count in zip(dump_paths, row_counts):
+        print_log(f"Staged {row_count} triples from '{rel_path}'.", verbose)
+
+    connection = sqlite3.connect(stage_paths[0])
+    merge_stages(connection, stage_paths[1:])
+    join_relations(connection)
+    with connection:
+        connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, "
+                           "value TEXT)")
+        connection.execute("INSERT INTO meta VALUES ('sources', ?)",
+                           (json.dumps(gen_sources_meta(dump_paths)),))
+    plds, rows = connection.execute("SELECT COUNT(DISTINCT pld), COUNT(*) "
+                                    "FROM pld_tweets").fetchone()
+    connection.close()
+
+    os.replace(stage_paths[0], index_path)
+    for stage_path in stage_paths[1:]:
+        os.remove(stage_path)
+    print_log(f"Indexed {rows} tweets for {plds} PLDs in '{index_path}'.",
+              verbose)
+
+# Main
+
+def parse_arguments(args):
+    """ Creates an ArgumentParser with help messages. """
+    info =  """ Indexer for N-Triples dumps of the TweetsCOV19 dataset. Builds
+            an index of tweets per PLD, which 'data_retriever.py' can query
+            instead of the SPARQL-endpoint, if it is missing or outdated. """
+    parser = ArgumentParser(description=info)
+    parser.add_argument('index',
+                        help="specify relative path to the SQLite-index")
+    parser.add_argument('dumps', nargs='+',
+                        help="specify relative paths to N-Triples dumps")
+    parser.add_argument('-f', '--force', action='store_true', default=False,
+                        help="rebuild the index even if it is up to date")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help="specify number of processes for parsing dumps")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help="activate output")
+
+    if len(args) < 1:  # show help, if no arguments are given
+        parser.print_help(sys.stderr)
+        sys.exit()
+    return parser.parse_args(args)
+
+def main(args):
+    parsed_args = parse_arguments(args)
+    assert parsed_args.jobs > 0
+    assert all(os.path.exists(rel_path) for rel_path in parsed_args.dumps)
+
+    if not parsed_args.force and is_index_valid(parsed_args.index,
+                                                parsed_args.dumps):
+        print_log(f"Index '{parsed_args.index}' is up to date.",
+                  parsed_args.verbose)
+        return
+    build_dump_index(parsed_args.index, parsed_args.dumps, parsed_args.jobs,
+                     parsed_args.verbose)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
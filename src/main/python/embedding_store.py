@@ -0,0 +1,151 @@
+"""
+Converts a file with pretrained word vectors in the text format of fastText,
+e.g., 'wiki.simple.vec', once into a local store, whose vectors are memory
+mapped. 'build_vocab' looks up the vectors of its tokens in the store instead
+of downloading and loading all vectors, so that training works offline.
+
+Example call:
+python -m embedding_store '../../../input_data/wiki.simple.vec' '../../../input_data/fasttext_simple_300d' -v
+"""
+
+import json
+import numpy as np
+import os
+import sys
+from argparse import ArgumentParser
+
+from helpers import print_log
+
+META_FILE_NAME = 'meta.json'
+
+# Conversion
+
+def read_vec_header(rel_path):
+    """ Returns the number of vectors and their dimension from the header of
+    the vector file referred to by 'rel_path'. Counts them, if the file has no
+    header line. Returns a tuple (count, dim, has_header). """
+    with open(rel_path, 'r', encoding='utf-8', errors='replace') as f:
+        first = f.readline().rstrip().split(' ')
+        if len(first) == 2:
+            return int(first[0]), int(first[1]), True
+        return 1 + sum(1 for _ in f), len(first) - 1, False
+
+def convert_vectors(rel_path, store_path, verbose=False):
+    """ Streams the vector file referred to by 'rel_path' into a store at
+    'store_path'. The store holds a float32 matrix 'vectors.npy' with one row
+    per token, the UTF-8 encoded tokens in sorted order 'tokens.npy' and the
+    row of each sorted token 'rows.npy'. Skips malformed lines and repeated
+    tokens. Returns the number of stored vectors. """
+    count, dim, has_header = read_vec_header(rel_path)
+    os.makedirs(store_path, exist_ok=True)
+    meta_path = os.path.join(store_path, META_FILE_NAME)
+    if os.path.exists(meta_path):
+        os.remove(meta_path) # invalidate the store while it is written
+
+    vectors = np.lib.format.open_memmap(os.path.join(store_path,
+                                                     'vectors.npy'),
+                                        mode='w+', dtype=np.float32,
+                                        shape=(count, dim))
+    token_rows = {}
+    with open(rel_path, 'rb') as f:
+        if has_header:
+            f.readline()
+        for line in f:
+            parts = line.rstrip().split(b' ')
+            if len(parts) != dim + 1 or parts[0] in token_rows:
+                continue
+            vectors[len(token_rows)] = np.array(parts[1:], dtype=np.float32)
+            token_rows[parts[0]] = len(token_rows)
+            if len(token_rows) % 100000 == 0:
+                print_log(f"Converted {len(token_rows)} vectors.", verbose)
+    vectors.flush()
+    del vectors
+
+    tokens = np.array(list(token_rows), dtype=bytes)
+    order = np.argsort(tokens, kind='stable')
+    np.save(os.path.join(store_path, 'tokens.npy'), tokens[order])
+    np.save(os.path.join(store_path, 'rows.npy'),
+            np.array(list(token_rows.values()), dtype=np.int64)[order])
+    with open(meta_path, 'w') as f:
+        json.dump({'source': os.path.basename(rel_path), 'dim': dim,
+                   'count': len(token_rows)}, f)
+    return len(token_rows)
+
+# Store
+
+class EmbeddingStore(object):
+    """ Read-only store of pretrained word vectors built by 'convert_vectors'.
+    Vectors are memory mapped, so that only the rows of looked up tokens are
+    read from disk. """
+
+    def __init__(self, store_path):
+        """ Opens the store at 'store_path'. """
+        meta_path = os.path.join(store_path, META_FILE_NAME)
+        assert os.path.exists(meta_path), f"no embedding store '{store_path}'"
+        with open(meta_path, 'r') as f:
+            self.meta = json.load(f)
+        self.vectors = np.load(os.path.join(store_path, 'vectors.npy'),
+                               mmap_mode='r')
+        self.tokens = np.load(os.path.join(store_path, 'tokens.npy'),
+                              mmap_mode='r')
+        self.rows = np.load(os.path.join(store_path, 'rows.npy'),
+                            mmap_mode='r')
+
+    @property
+    def dim(self):
+        return self.meta['dim']
+
+    def lookup(self, tokens):
+        """ Returns the row of each token from 'tokens' in 'vectors' or -1, if
+        the store has no vector for it. Uses binary search on the sorted
+        tokens. """
+        queries = np.array([token.encode('utf-8') for token in tokens],
+                           dtype=bytes)
+        if len(queries) == 0 or len(self.tokens) == 0:
+            return np.full(len(queries), -1, dtype=np.int64)
+        pos = np.searchsorted(self.tokens, queries)
+        pos_clipped = np.minimum(pos, len(self.tokens) - 1)
+        found = (pos < len(self.tokens)) & (self.tokens[pos_clipped] == queries)
+        return np.where(found, self.rows[pos_clipped], -1)
+
+    def get_vecs_by_tokens(self, tokens):
+        """ Returns a float tensor with the vector of each token from 'tokens'
+        and zeros for tokens without a vector. """
+        import torch
+        rows = self.lookup(tokens)
+        vectors = np.zeros((len(rows), self.dim), dtype=np.float32)
+        found = np.flatnonzero(rows >= 0)
+        order = np.argsort(rows[found]) # read the memory map sequentially
+        vectors[found[order]] = self.vectors[rows[found[order]]]
+        return torch.from_numpy(vectors)
+
+# Main
+
+def parse_arguments(args):
+    """ Creates an ArgumentParser with help messages. """
+    info =  """ Converts pretrained word vectors in the text format of
+            fastText into a local store for 'build_vocab'. """
+    parser = ArgumentParser(description=info)
+    parser.add_argument('vec_file',
+                        help="specify relative path to the vector file")
+    parser.add_argument('store',
+                        help="specify relative path to the new store")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help="activate output")
+
+    if len(args) < 1:  # show help, if no arguments are given
+        parser.print_help(sys.stderr)
+        sys.exit()
+    return parser.parse_args(args)
+
+def main(args):
+    parsed_args = parse_arguments(args)
+    assert os.path.exists(parsed_args.vec_file)
+
+    count = convert_vectors(parsed_args.vec_file, parsed_args.store,
+                            parsed_args.verbose)
+    print_log(f"Stored {count} vectors in '{parsed_args.store}'.",
+              parsed_args.verbose)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
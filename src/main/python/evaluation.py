@@ -2,39 +2,193 @@
 Evaluates a classifier for the PLDs of referenced URLs according to their
 political leaning, i.e., left or right.
 Writes results as tuples (PLD, confidence score) into two separate CSV-files.
+With '--stream', rows are read, scored and written chunk by chunk, and a killed
+run resumes after the last written chunk. With '--incremental', only PLDs whose
+tweets changed since the last run with the same classifier are scored again.
+With '--exported', the TorchScript export from 'model_exporter.py' is scored.
+With '--gold', the results are scored against gold PLDs via 'result_scorer.py'.
 
 Example call:
 python -m evaluation 'leaning_guesser' '../../../input_data/test_tweets.csv' '../../../output_data/left.csv' '../../../output_data/right.csv' -v
 """
 
 import numpy as np
+import os
 import sys
+import time
+import torch
 from argparse import ArgumentParser
-from torchtext.data.utils import get_tokenizer
 
-from data_file_handler import read_hists_from_file, read_tweets_from_csv, \
-                              read_model_from_files, write_results_to_csv
-from data_preprocessor import append_cnts_to_emos, build_dataloader, \
+from data_file_handler import PredictionIndex, ResultWriter, \
+                              generate_export_file_name, generate_index_path, \
+                              generate_model_file_names, \
+                              generate_trace_file_name, iter_tweets_from_csv, \
+                              read_exported_model, read_hists_from_file, \
+                              read_model_from_files, write_metrics_to_file, \
+                              write_results_to_csv
+from data_preprocessor import append_cnts_to_emos, collapse_tag_ids, \
+                              encode_tags, generate_fingerprints, \
                               preprocess_cnts, preprocess_emos, preprocess_tags
-from helpers import plot_acc_and_loss, print_log
-from pld_dataset import PLDDataset
+from feature_store import calc_file_hash, load_feature_store
+from helpers import NULL_TIMER, StageTimer, plot_acc_and_loss, print_log, \
+                    trace_to_file
+from pld_dataset import PLDDataset, build_dataloader
+from result_scorer import print_report, score_result_files
 
 # Evaluation
 
-def apply_classifier(classifier, test_ldr):
-    """ Performs a forward pass with 'classifier' per sample from 'test_ldr'.
-    Returns predictions as list of lists. """
-    predictions = []
+def apply_classifier(classifier, test_ldr, timer=NULL_TIMER):
+    """ Performs a forward pass with 'classifier' per batch from 'test_ldr'
+    without tracking gradients. Returns predictions as tensor with one row of
+    probabilities per sample. Times stages with 'timer'. """
+    predictions = torch.empty(len(test_ldr.dataset),
+                              classifier.out.out_features)
     classifier.eval()
-    for _, emos, tags, offsets in test_ldr:
-        predictions += classifier(emos, tags, offsets, probs=True).tolist()
+    start = 0
+    with torch.no_grad():
+        for _, emos, tags, offsets, weights in timer.iterate('collate',
+                                                             test_ldr):
+            stop = start + len(emos)
+            with timer.stage('forward'):
+                predictions[start:stop] = classifier(emos, tags, offsets,
+                                                     weights, probs=True)
+            start = stop
     return predictions
 
+def build_test_set(store, stoi, cnts_range):
+    """ Builds a PLDDataset from the feature 'store' of test data. Normalizes
+    counters with the tuple 'cnts_range' and maps tokens to ids from 'stoi'.
+    """
+    # labels are not present for testing, set them to -1
+    label_arr = np.full(len(store['plds']), fill_value=-1, dtype=int)
+    emos_arr = append_cnts_to_emos(store['emos'],
+                                   preprocess_cnts(store['cnts'], cnts_range))
+    tags_ids = encode_tags(store['tokens'], store['tag_ids'], stoi)
+    return PLDDataset(label_arr, emos_arr, tags_ids, store['tag_offsets'],
+                      store['tag_counts'])
+
+def encode_chunk(chunk, stoi, tokenizer, cnts_range):
+    """ Preprocesses the rows from 'chunk' as read by 'iter_tweets_from_csv'.
+    Normalizes counters with the tuple 'cnts_range' and maps tokens from
+    'tokenizer' to ids from 'stoi'. Collapses tokens with their counts like
+    'feature_store.py' before mapping them, so that the results equal those
+    from the feature store. Returns a PLDDataset. """
+    _, cnts_ls, emos_pos_ls, emos_neg_ls, tags_ls, _ = chunk
+    emos_arr = append_cnts_to_emos(preprocess_emos(emos_pos_ls, emos_neg_ls),
+                                   preprocess_cnts(cnts_ls, cnts_range))
+    token_id_dict = {} # token -> id in the order of first occurrence
+    tags_ids, tags_counts, tags_offsets = collapse_tag_ids(
+        [token_id_dict.setdefault(token, len(token_id_dict))
+         for token in tokenizer(tags_str)]
+        for tags_str in preprocess_tags(tags_ls))
+    tags_ids = encode_tags(np.array(list(token_id_dict), dtype=str), tags_ids,
+                           stoi)
+    label_arr = np.full(len(emos_arr), fill_value=-1, dtype=int)
+    return PLDDataset(label_arr, emos_arr, tags_ids, tags_offsets, tags_counts)
+
 def evaluate_predictions(predictions):
-    """ Calculates classes and confidences from 'predictions'. """
-    classes = np.argmax(predictions, axis=1)
-    confidences = np.amax(predictions, axis=1)
-    return classes, confidences
+    """ Calculates classes and confidences from the tensor 'predictions'.
+    Returns them as np.arrays. """
+    confidences, classes = torch.max(predictions, dim=1)
+    return classes.numpy(), confidences.double().numpy()
+
+def apply_classifier_incrementally(classifier, pld_dataset, plds,
+                                   fingerprints, index, batch_size,
+                                   timer=NULL_TIMER):
+    """ Looks up predictions for 'plds' in the PredictionIndex 'index' and
+    scores only the samples from 'pld_dataset', whose PLD is missing in the
+    index or whose fingerprint from 'fingerprints' changed, in batches of
+    'batch_size' samples. Stores the new predictions in 'index'. Returns
+    classes and confidences for all PLDs and the number of scored PLDs. """
+    entries = index.get_many(plds)
+    changed = [i for i, (fingerprint, entry)
+               in enumerate(zip(fingerprints, entries))
+               if entry is None or entry[0] != fingerprint]
+    class_arr = np.array([-1 if entry is None else entry[1]
+                          for entry in entries], dtype=np.int64)
+    confidence_arr = np.array([np.nan if entry is None else entry[2]
+                               for entry in entries], dtype=np.float64)
+
+    if len(changed) > 0:
+        changed_ldr = build_dataloader(pld_dataset.subset(changed), batch_size)
+        predictions = apply_classifier(classifier, changed_ldr, timer)
+        class_arr[changed], confidence_arr[changed] = \
+            evaluate_predictions(predictions)
+        index.put_many(np.asarray(plds)[changed],
+                       np.asarray(fingerprints)[changed], class_arr[changed],
+                       confidence_arr[changed])
+    return class_arr, confidence_arr, len(changed)
+
+def calc_model_hash(parsed_args):
+    """ Calculates the hash of the PT-file of the classifier (or of its export)
+    from 'parsed_args', which changes whenever the classifier is retrained. """
+    model_file_name = generate_export_file_name(parsed_args.cls) \
+        if parsed_args.exported \
+        else generate_model_file_names(parsed_args.cls)[0]
+    return calc_file_hash(model_file_name)
+
+def read_cnts_range(rel_path, chunk_size=1000):
+    """ Reads the counters of all rows from the CSV-file referred to by
+    'rel_path' in chunks of 'chunk_size' rows. Returns their (min, max). """
+    min_cnt, max_cnt = None, None
+    for chunk, _ in iter_tweets_from_csv(rel_path, chunk_size):
+        cnts_arr = np.array([int(cnts_str) for cnts_str in chunk[1]])
+        min_cnt = np.min(cnts_arr) if min_cnt is None \
+            else min(min_cnt, np.min(cnts_arr))
+        max_cnt = np.max(cnts_arr) if max_cnt is None \
+            else max(max_cnt, np.max(cnts_arr))
+    return min_cnt, max_cnt
+
+def stream_classifier(classifier, stoi, cnts_range, parsed_args, index=None,
+                      timer=NULL_TIMER):
+    """ Reads, scores and writes the test data from 'parsed_args' chunk by
+    chunk, so that memory usage does not grow with the test data. Resumes
+    after the last written chunk of a killed run with the same data and
+    classifier, whose PT-file must not have changed. Counters are normalized
+    with 'cnts_range' from training. Old models without it fall back to a
+    range over the whole test data. Scores only changed PLDs, if the
+    PredictionIndex 'index' is given. """
+    from torchtext.data.utils import get_tokenizer # slow import
+    tokenizer = get_tokenizer('basic_english')
+    stat = os.stat(parsed_args.data)
+    source = {'data': os.path.abspath(parsed_args.data), 'cls': parsed_args.cls,
+              'cls_hash': calc_model_hash(parsed_args),
+              'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    writer = ResultWriter(parsed_args.res_l, parsed_args.res_r, source)
+    start = 0 if writer.offset is None else writer.offset
+    if writer.offset is not None:
+        print_log(f"Resuming after {writer.rows} rows.", parsed_args.verbose)
+
+    if cnts_range is None:
+        with timer.stage('cnts_range'):
+            cnts_range = read_cnts_range(parsed_args.data, parsed_args.chunk)
+    chunks = iter_tweets_from_csv(parsed_args.data, parsed_args.chunk,
+                                  parsed_args.verbose,
+                                  None if start == 0 else (start, stat.st_size))
+    for chunk, n_bytes in timer.iterate('csv_read', chunks):
+        with timer.stage('preprocessing'):
+            chunk_set = encode_chunk(chunk, stoi, tokenizer, cnts_range)
+        epoch_start = time.perf_counter()
+        if index is None:
+            predictions = apply_classifier(classifier,
+                                           build_dataloader(chunk_set,
+                                                            parsed_args.ba),
+                                           timer)
+            class_ls, confidence_ls = evaluate_predictions(predictions)
+            num_scored = len(chunk_set)
+        else:
+            class_ls, confidence_ls, num_scored = \
+                apply_classifier_incrementally(
+                    classifier, chunk_set, chunk[0],
+                    generate_fingerprints(chunk[1], chunk[5]), index,
+                    parsed_args.ba, timer)
+        timer.record_epoch(len(timer.epochs) + 1, num_scored,
+                           time.perf_counter() - epoch_start)
+        with timer.stage('serialization'):
+            writer.write_chunk(chunk[0], class_ls, confidence_ls,
+                               start + n_bytes)
+        print_log(f"Scored and saved {writer.rows} rows.", parsed_args.verbose)
+    writer.close()
 
 # Main
 
@@ -47,10 +201,37 @@ def parse_arguments(args):
     parser.add_argument('data', help="specify relative path to test data")
     parser.add_argument('res_l', help="specify relative path to left results")
     parser.add_argument('res_r', help="specify relative path to right results")
+    parser.add_argument('-b', '--ba', type=int, default=1024, metavar='N',
+                        help="specify number of samples per batch")
+    parser.add_argument('-c', '--chunk', type=int, default=1000, metavar='N',
+                        help="specify number of rows read from CSV at once")
+    parser.add_argument('-g', '--gold', nargs=2, default=None,
+                        metavar=('GOLD_L', 'GOLD_R'),
+                        help="score results against left and right gold PLDs")
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        default=False,
+                        help="only score PLDs whose tweets changed")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help="specify number of processes for preprocessing")
     parser.add_argument('-p', '--plot', action='store_true', default=False,
                         help="plot evaluation metrics from training")
+    parser.add_argument('-s', '--stream', action='store_true', default=False,
+                        help="score and write results chunk by chunk")
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
                         help="activate output")
+    parser.add_argument('-w', '--workers', type=int, default=0, metavar='N',
+                        help="specify number of processes for data loading")
+    parser.add_argument('-x', '--exported', action='store_true',
+                        default=False,
+                        help="load the export from 'model_exporter.py'")
+    parser.add_argument('--pin-memory', action='store_true', default=False,
+                        help="copy batches into pinned memory")
+    parser.add_argument('--prefetch', type=int, default=2, metavar='N',
+                        help="specify number of batches loaded per worker")
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help="write per-stage timers and memory to JSON")
+    parser.add_argument('--trace', action='store_true', default=False,
+                        help="write a cProfile trace of the whole run")
 
     if len(args) < 1:  # show help, if no arguments are given
         parser.print_help(sys.stderr)
@@ -59,33 +240,89 @@ def parse_arguments(args):
 
 def main(args):
     parsed_args = parse_arguments(args)
+    assert parsed_args.ba > 0
+    assert parsed_args.chunk > 0
+    assert parsed_args.jobs > 0
+    assert parsed_args.workers >= 0
+    assert parsed_args.prefetch > 0
+    assert parsed_args.gold is None \
+        or all(os.path.exists(rel_path) for rel_path in parsed_args.gold)
 
-    tokenizer = get_tokenizer('basic_english')
-    classifier, vocab = read_model_from_files(parsed_args.cls)
-    print_log("Classifier and vocab loaded.", parsed_args.verbose)
+    timer = StageTimer(enabled=parsed_args.profile)
+    if parsed_args.trace:
+        trace_path = generate_trace_file_name(parsed_args.cls, 'eval')
+        with trace_to_file(trace_path):
+            run_evaluation(parsed_args, timer)
+    else:
+        run_evaluation(parsed_args, timer)
 
-    pld_ls, cnts_ls, emos_pos_ls, emos_neg_ls, tags_ls, _ \
-        = read_tweets_from_csv(parsed_args.data, parsed_args.verbose)
+    if parsed_args.profile:
+        write_metrics_to_file(parsed_args.cls, 'eval', timer.to_dict())
+    if parsed_args.gold is not None:
+        report = score_result_files(*parsed_args.gold, parsed_args.res_l,
+                                    parsed_args.res_r)
+        if parsed_args.verbose:
+            print_report(report)
+        write_metrics_to_file(parsed_args.cls, 'score', report)
+    if parsed_args.plot:
+        trn_hist, val_hist = read_hists_from_file(parsed_args.cls)
+        plot_acc_and_loss(trn_hist, val_hist)
 
-    # labels are not present for testing, set them to -1
-    label_arr = np.full_like(pld_ls, fill_value=-1, dtype=int).tolist()
-    emos_arr = append_cnts_to_emos(preprocess_emos(emos_pos_ls, emos_neg_ls),
-                                   preprocess_cnts(cnts_ls))
-    tags_str_arr = preprocess_tags(tags_ls)
+def run_evaluation(parsed_args, timer=NULL_TIMER):
+    """ Evaluates a classifier on test data as specified by 'parsed_args'. """
+    with timer.stage('deserialization'):
+        if parsed_args.exported:
+            classifier, stoi, cnts_range = read_exported_model(parsed_args.cls)
+        else:
+            classifier, stoi, cnts_range = read_model_from_files(
+                parsed_args.cls)
+    print_log("Classifier and tokens loaded.", parsed_args.verbose)
+
+    index = None
+    if parsed_args.incremental:
+        index = PredictionIndex(generate_index_path(parsed_args.res_l),
+                                calc_model_hash(parsed_args))
 
-    pld_testset = PLDDataset(label_arr, emos_arr, tags_str_arr)
-    pld_test_ldr = build_dataloader(pld_testset, 5, vocab, tokenizer)
+    if parsed_args.stream:
+        stream_classifier(classifier, stoi, cnts_range, parsed_args, index,
+                          timer)
+        print_log("Evaluation done and results saved.", parsed_args.verbose)
+    else:
+        evaluate_store(classifier, stoi, cnts_range, parsed_args, index, timer)
+    if index is not None:
+        index.close()
+
+def evaluate_store(classifier, stoi, cnts_range, parsed_args, index=None,
+                   timer=NULL_TIMER):
+    """ Scores the test data from 'parsed_args' via its feature store and
+    writes all results at once. Counters are normalized with 'cnts_range'.
+    Scores only changed PLDs, if the PredictionIndex 'index' is given. """
+    store = load_feature_store(parsed_args.data, parsed_args.chunk,
+                               parsed_args.verbose, timer, parsed_args.jobs)
+    pld_ls = store['plds']
+    pld_testset = build_test_set(store, stoi, cnts_range)
+    pld_test_ldr = build_dataloader(pld_testset, parsed_args.ba,
+                                    parsed_args.workers,
+                                    parsed_args.pin_memory,
+                                    parsed_args.prefetch)
     print_log("Test data loaded.", parsed_args.verbose)
 
-    predictions = apply_classifier(classifier, pld_test_ldr)
-    class_ls, confidence_ls = evaluate_predictions(predictions)
-    write_results_to_csv(pld_ls, class_ls, confidence_ls, parsed_args.res_l,
-                         parsed_args.res_r)
+    epoch_start = time.perf_counter()
+    if index is None:
+        predictions = apply_classifier(classifier, pld_test_ldr, timer)
+        class_ls, confidence_ls = evaluate_predictions(predictions)
+        num_scored = len(pld_testset)
+    else:
+        class_ls, confidence_ls, num_scored = apply_classifier_incrementally(
+            classifier, pld_testset, pld_ls, store['fingerprints'], index,
+            parsed_args.ba, timer)
+        print_log(f"Scored {num_scored} new or changed of {len(pld_ls)} PLDs.",
+                  parsed_args.verbose)
+    timer.record_epoch(1, num_scored, time.perf_counter() - epoch_start)
+    with timer.stage('serialization'):
+        write_results_to_csv(pld_ls, class_ls, confidence_ls,
+                             parsed_args.res_l, parsed_args.res_r)
     print_log("Evaluation done and results saved.", parsed_args.verbose)
 
-    if parsed_args.plot:
-        trn_hist, val_hist = read_hists_from_file(parsed_args.cls)
-        plot_acc_and_loss(trn_hist, val_hist)
-
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -0,0 +1,258 @@
+"""
+Materializes the preprocessed features of a CSV-file with tweets into a
+directory of NPY-files, which are loaded via memory mapping afterwards. A store
+is rebuilt automatically if its source CSV-file changes.
+
+Example call:
+python -m feature_store '../../../input_data/left_train_tweets.csv' -j 4 -v
+"""
+
+import hashlib
+import itertools
+import json
+import numpy as np
+import os
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+from data_file_handler import generate_store_path, iter_tweets_from_csv
+from data_preprocessor import collapse_tag_ids, generate_fingerprints, \
+                              preprocess_emos, preprocess_tags
+from helpers import NULL_TIMER, print_log
+
+STORE_VERSION = 3
+FEATURE_NAMES = ('plds', 'emos', 'cnts', 'tag_ids', 'tag_counts', 'tag_offsets',
+                 'tokens', 'fingerprints')
+META_FILE_NAME = 'meta.json'
+
+# Source Fingerprint
+
+def calc_file_hash(rel_path, block_size=1<<20):
+    """ Calculates the SHA1-hash of the file referred to by 'rel_path'. """
+    file_hash = hashlib.sha1()
+    with open(rel_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def gen_source_meta(rel_path, file_hash=None):
+    """ Generates the meta data which identifies the source 'rel_path'. """
+    stat = os.stat(rel_path)
+    return {'version': STORE_VERSION, 'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'hash': file_hash or calc_file_hash(rel_path)}
+
+def is_store_valid(store_path, rel_path):
+    """ Checks if the store at 'store_path' has been built from the current
+    version of 'rel_path'. Compares size and mtime first and only calculates
+    the hash of 'rel_path' if they differ. Updates the stored mtime if only
+    the mtime differs. """
+    meta_path = os.path.join(store_path, META_FILE_NAME)
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+
+    stat = os.stat(rel_path)
+    if meta['version'] != STORE_VERSION or meta['size'] != stat.st_size:
+        return False
+    if meta['mtime'] == stat.st_mtime_ns:
+        return True
+    if meta['hash'] != calc_file_hash(rel_path):
+        return False
+    write_meta(store_path, gen_source_meta(rel_path, meta['hash']))
+    return True
+
+def write_meta(store_path, meta):
+    """ Writes 'meta' into the store at 'store_path'. """
+    with open(os.path.join(store_path, META_FILE_NAME), 'w') as f:
+        json.dump(meta, f)
+
+# Shards
+
+def find_shard_ranges(rel_path, num_shards):
+    """ Splits the rows of the CSV-file referred to by 'rel_path' into up to
+    'num_shards' byte ranges of similar size, which start and stop at line
+    starts. Rows must not contain line breaks. Returns a list of tuples
+    (start, stop) in the order of the file. """
+    size = os.path.getsize(rel_path)
+    with open(rel_path, 'rb') as f:
+        bounds = [len(f.readline())] # skip header
+        for i in range(1, num_shards):
+            pos = bounds[0] + i * (size - bounds[0]) // num_shards
+            f.seek(max(pos - 1, bounds[-1])) # first line start from 'pos' on
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])
+            if stop > start]
+
+def merge_shards(shard_ls):
+    """ Concatenates the features from the dicts in 'shard_ls', which have been
+    preprocessed from consecutive parts of one file. Maps the shard's token ids
+    to global ids in the order of first occurrence, so that the result equals
+    the features preprocessed from the whole file at once. """
+    token_id_dict = {}
+    tag_ids_ls, tag_offsets_ls = [], []
+    tag_offset = 0
+    for shard in shard_ls:
+        global_ids = np.array([token_id_dict.setdefault(token,
+                                                        len(token_id_dict))
+                               for token in shard['tokens'].tolist()],
+                              dtype=np.int64)
+        tag_ids_ls.append(global_ids[shard['tag_ids']])
+        tag_offsets_ls.append(shard['tag_offsets'][1:] + tag_offset)
+        tag_offset += shard['tag_offsets'][-1]
+
+    return {
+        'plds': np.concatenate([shard['plds'] for shard in shard_ls]),
+        'emos': np.concatenate([shard['emos'] for shard in shard_ls]),
+        'cnts': np.concatenate([shard['cnts'] for shard in shard_ls]),
+        'tag_ids': np.concatenate(tag_ids_ls),
+        'tag_counts': np.concatenate([shard['tag_counts']
+                                      for shard in shard_ls]),
+        'tag_offsets': np.concatenate([[0]] + tag_offsets_ls),
+        'tokens': np.array(list(token_id_dict), dtype=str),
+        'fingerprints': np.concatenate([shard['fingerprints']
+                                        for shard in shard_ls]),}
+
+def preprocess_shard(rel_path, byte_range=None, chunk_size=1000,
+                     verbose=False, timer=NULL_TIMER):
+    """ Reads the rows within 'byte_range' of the CSV-file referred to by
+    'rel_path' (or all rows, if it is None) in chunks of 'chunk_size' rows.
+    Returns a dict with their features as described in 'build_feature_store'.
+    Times stages with 'timer'. """
+    from torchtext.data.utils import get_tokenizer # slow import
+    tokenizer = get_tokenizer('basic_english')
+    token_id_dict = {} # token -> id in the order of first occurrence
+    pld_ls, cnts_ls = [], []
+    # typed empty arrays, so that files and shards without rows concatenate
+    emos_arr_ls = [np.empty((0, 4), dtype=np.float64)]
+    tag_ids_ls = [np.empty(0, dtype=np.int64)]
+    tag_counts_ls = [np.empty(0, dtype=np.int64)]
+    tag_lens_ls = [np.empty(0, dtype=np.int64)]
+    fingerprints_ls = [np.empty(0, dtype=str)]
+
+    chunks = iter_tweets_from_csv(rel_path, chunk_size, verbose, byte_range)
+    for chunk, n_bytes in timer.iterate('csv_read', chunks):
+        c_pld_ls, c_cnts_ls, c_emos_pos_ls, c_emos_neg_ls, c_tags_ls, \
+            c_tweet_ids_ls = chunk
+        pld_ls.extend(c_pld_ls)
+        cnts_ls.extend(int(cnts_str) for cnts_str in c_cnts_ls)
+        fingerprints_ls.append(generate_fingerprints(c_cnts_ls,
+                                                     c_tweet_ids_ls))
+        with timer.stage('emos_preprocessing'):
+            emos_arr_ls.append(preprocess_emos(c_emos_pos_ls, c_emos_neg_ls))
+
+        with timer.stage('tags_tokenization'):
+            tag_ids, tag_counts, tag_offsets = collapse_tag_ids(
+                [token_id_dict.setdefault(token, len(token_id_dict))
+                 for token in tokenizer(tags_str)]
+                for tags_str in preprocess_tags(c_tags_ls))
+            tag_ids_ls.append(tag_ids)
+            tag_counts_ls.append(tag_counts)
+            tag_lens_ls.append(np.diff(tag_offsets))
+        print_log(f"Preprocessed {len(pld_ls)} rows ({n_bytes} bytes).",
+                  verbose)
+
+    return {
+        'plds': np.array(pld_ls, dtype=str),
+        'emos': np.concatenate(emos_arr_ls),
+        'cnts': np.array(cnts_ls, dtype=np.int64),
+        'tag_ids': np.concatenate(tag_ids_ls),
+        'tag_counts': np.concatenate(tag_counts_ls),
+        'tag_offsets': np.concatenate(([0],
+                                       np.cumsum(np.concatenate(tag_lens_ls)))),
+        'tokens': np.array(list(token_id_dict), dtype=str),
+        'fingerprints': np.concatenate(fingerprints_ls),}
+
+# Store
+
+def build_feature_store(rel_path, chunk_size=1000, verbose=False,
+                        timer=NULL_TIMER, jobs=1):
+    """ Reads the CSV-file referred to by 'rel_path' in chunks of 'chunk_size'
+    rows and writes its features into a store. The store contains PLD names,
+    emotion scores [pos_avg, neg_avg, pos_std, neg_std], raw tweet counters and
+    the tokenized Hashtags as one stream of distinct token ids with their
+    counts 'tag_counts' and offsets per PLD. Token ids refer to the store's own
+    token list 'tokens'. 'fingerprints' identify the tweets per PLD. Splits the
+    file into byte ranges, which are preprocessed by 'jobs' processes, if
+    'jobs' is greater than 1. Times stages with 'timer'. """
+    store_path = generate_store_path(rel_path)
+    os.makedirs(store_path, exist_ok=True)
+    meta_path = os.path.join(store_path, META_FILE_NAME)
+    if os.path.exists(meta_path):
+        os.remove(meta_path) # invalidate the store while it is written
+
+    byte_ranges = find_shard_ranges(rel_path, jobs) if jobs > 1 else []
+    if len(byte_ranges) > 1:
+        with timer.stage('sharded_preprocessing'), \
+             ProcessPoolExecutor(len(byte_ranges)) as executor:
+            shard_ls = list(executor.map(preprocess_shard,
+                                         itertools.repeat(rel_path),
+                                         byte_ranges,
+                                         itertools.repeat(chunk_size)))
+            features = merge_shards(shard_ls)
+        print_log(f"Preprocessed {len(features['plds'])} rows in "
+                  f"{len(byte_ranges)} shards.", verbose)
+    else:
+        features = preprocess_shard(rel_path, None, chunk_size, verbose, timer)
+
+    with timer.stage('store_serialization'):
+        for name in FEATURE_NAMES:
+            np.save(os.path.join(store_path, f"{name}.npy"), features[name])
+        write_meta(store_path, gen_source_meta(rel_path))
+    print_log(f"Wrote feature store '{store_path}'.", verbose)
+
+def load_feature_store(rel_path, chunk_size=1000, verbose=False,
+                       timer=NULL_TIMER, jobs=1):
+    """ Loads the feature store for the CSV-file referred to by 'rel_path' and
+    (re-)builds it first with 'jobs' processes, if it is missing or outdated.
+    Returns a dict with read-only memory mapped np.arrays, see
+    'build_feature_store'. The slice tag_ids[tag_offsets[i]:tag_offsets[i+1]]
+    holds the distinct token ids of PLD i, which occur as often as the same
+    slice of tag_counts says. """
+    store_path = generate_store_path(rel_path)
+    if not is_store_valid(store_path, rel_path):
+        build_feature_store(rel_path, chunk_size, verbose, timer, jobs)
+    else:
+        print_log(f"Feature store '{store_path}' is up to date.", verbose)
+
+    return {name: np.load(os.path.join(store_path, f"{name}.npy"),
+                          mmap_mode='r')
+            for name in FEATURE_NAMES}
+
+# Main
+
+def parse_arguments(args):
+    """ Creates an ArgumentParser with help messages. """
+    info =  """ Preprocessor for PLD media bias classification. Builds feature
+            stores for CSV-files generated by 'data_retriever.py', if they are
+            missing or outdated. """
+    parser = ArgumentParser(description=info)
+    parser.add_argument('data', nargs='+',
+                        help="specify relative paths to CSV-files with tweets")
+    parser.add_argument('-c', '--chunk', type=int, default=1000, metavar='N',
+                        help="specify number of rows read from CSV at once")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help="specify number of processes for preprocessing")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help="activate output")
+
+    if len(args) < 1:  # show help, if no arguments are given
+        parser.print_help(sys.stderr)
+        sys.exit()
+    return parser.parse_args(args)
+
+def main(args):
+    parsed_args = parse_arguments(args)
+    assert parsed_args.chunk > 0
+    assert parsed_args.jobs > 0
+
+    for rel_path in parsed_args.data:
+        load_feature_store(rel_path, parsed_args.chunk, parsed_args.verbose,
+                           jobs=parsed_args.jobs)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,5 +1,82 @@
-import matplotlib.pyplot as plt
 import numpy as np
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+class StageTimer(object):
+    """ Opt-in instrumentation, which accumulates wall times per named stage and
+    records throughput and peak memory per epoch. A disabled timer only hands
+    out empty contexts, so that instrumented hot paths stay cheap. """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = {} # name -> [total time in s, number of calls]
+        self.epochs = []
+
+    def add(self, name, seconds):
+        """ Adds 'seconds' to the total time of stage 'name'. """
+        total = self.stages.setdefault(name, [0.0, 0])
+        total[0] += seconds
+        total[1] += 1
+
+    def iterate(self, name, iterable):
+        """ Yields the elements from 'iterable' and times each call of 'next'
+        as stage 'name', e.g., the collation of batches by a DataLoader. """
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                element = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - start)
+            yield element
+
+    def record_epoch(self, epoch, num_samples, seconds):
+        """ Records samples per second and peak memory of 'epoch'. """
+        if self.enabled:
+            self.epochs.append({'epoch': epoch, 'samples': num_samples,
+                                'seconds': seconds,
+                                'samples_per_s': num_samples / seconds,
+                                'peak_rss_mb': get_peak_rss_mb()})
+
+    def stage(self, name):
+        """ Returns a context which times its body as stage 'name'. """
+        return _TimedStage(self, name) if self.enabled else nullcontext()
+
+    def to_dict(self):
+        """ Returns all stage times and epoch records as dict. """
+        return {'stages': {name: {'seconds': total, 'calls': calls}
+                           for name, (total, calls) in self.stages.items()},
+                'epochs': self.epochs, 'peak_rss_mb': get_peak_rss_mb()}
+
+class _TimedStage(object):
+    """ Context which adds the time of its body to a stage of a StageTimer. """
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+
+NULL_TIMER = StageTimer(enabled=False)
+
+def time_call(fct, *args, repeat=3):
+    """ Calls 'fct' with 'args' 'repeat' times. Returns the best time in s and
+    the result of the last call. """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fct(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
 
 def gen_stat_msg(epoch, trn_hist, val_hist):
     """ Builds a status message for int 'epoch' and lists 'trn_hist' and
@@ -8,8 +85,32 @@ def gen_stat_msg(epoch, trn_hist, val_hist):
             f"trn-loss={trn_hist[-1][1]:.3f}, trn-acc={trn_hist[-1][0]:.3f}, "
             f"val-loss={val_hist[-1][1]:.3f}, val-acc={val_hist[-1][0]:.3f}")
 
+def get_peak_rss_mb():
+    """ Returns the peak resident set size of this process in MB or None, if
+    the platform does not provide it. """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+@contextmanager
+def trace_to_file(path):
+    """ Profiles the body of this context with cProfile and dumps the stats to
+    'path', which can be inspected with 'pstats' or 'snakeviz'. """
+    import cProfile # only needed for tracing
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
 def plot_acc_and_loss(trn_hist, val_hist):
     """ Plots accuracies and losses per epoch from 'trn_hist' 'val_hist'. """
+    import matplotlib.pyplot as plt # slow import, only needed for plots
     assert isinstance(trn_hist, np.ndarray) and isinstance(val_hist, np.ndarray)
     fig, (ax_acc, ax_loss) = plt.subplots(1, 2, figsize=(10, 4))
     plot_on_ax(ax_acc, trn_hist[:,0], val_hist[:,0], "Accuracy")
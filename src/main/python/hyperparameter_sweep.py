@@ -0,0 +1,211 @@
+"""
+Searches hyperparameters of the classifier for the PLDs of referenced URLs.
+Preprocesses the training data once into shared memory and trains one trial
+per configuration in a pool of processes. Writes a leaderboard and saves the
+best classifier under the name of the sweep.
+
+Example call:
+python -m hyperparameter_sweep 'leaning_sweep' '../../../input_data/left_tweets.csv' '../../../input_data/right_tweets.csv' -b 32 64 -l 0.01 0.001 -e 20 --hid 30 60 -p 4 --patience 3 -v
+"""
+
+import itertools
+import numpy as np
+import os
+import sys
+import time
+import torch
+import torch.multiprocessing as mp
+from argparse import ArgumentParser
+
+from data_file_handler import write_hists_to_file, write_leaderboard_to_csv, \
+                              write_model_to_files
+from helpers import print_log
+from pld_classifier import build_classifier
+from pld_classifier_trainer import build_training_set, train_classifier
+from pld_dataset import build_dataloader, split_dataset
+
+LEADERBOARD_KEYS = ('trial', 'ba', 'lr', 'ep', 'hid_dim', 'epochs', 'best_ep',
+                    'val_acc', 'val_loss', 'trn_acc', 'trn_loss', 'seconds')
+
+# Trials
+
+_shared = {} # data of a worker process, set by 'init_worker'
+
+def generate_trials(ba_ls, lr_ls, ep_ls, hid_ls, num_random=None, seed=0):
+    """ Generates one dict per configuration from the grid of all values from
+    'ba_ls', 'lr_ls', 'ep_ls' and 'hid_ls'. Samples 'num_random' distinct
+    configurations from the grid, if it is given. """
+    grid = [{'ba': ba, 'lr': lr, 'ep': ep, 'hid_dim': hid_dim}
+            for ba, lr, ep, hid_dim in itertools.product(ba_ls, lr_ls, ep_ls,
+                                                         hid_ls)]
+    if num_random is not None and num_random < len(grid):
+        rng = np.random.default_rng(seed)
+        grid = [grid[i] for i in sorted(rng.choice(len(grid), num_random,
+                                                   replace=False))]
+    return [dict(config, trial=i) for i, config in enumerate(grid)]
+
+def init_worker(trn_set, val_set, embedding_weight, threads, patience, seed):
+    """ Keeps the shared datasets and embedding for all trials of this worker
+    and limits it to 'threads' threads. """
+    torch.set_num_threads(threads)
+    _shared.update({'trn_set': trn_set, 'val_set': val_set,
+                    'embedding_weight': embedding_weight,
+                    'patience': patience, 'seed': seed})
+
+def run_trial(config):
+    """ Trains a classifier with the hyperparameters from the dict 'config' on
+    the shared data. Returns a dict with its row for the leaderboard, its
+    evaluation metrics and its state_dict without the embedding. """
+    torch.manual_seed(_shared['seed'] + config['trial'])
+    start = time.perf_counter()
+    classifier = build_classifier(_shared['embedding_weight'],
+                                  {'hid_dim': config['hid_dim']})
+    trn_ldr = build_dataloader(_shared['trn_set'], config['ba'])
+    val_ldr = build_dataloader(_shared['val_set'], config['ba'])
+    classifier, trn_hist, val_hist = train_classifier(classifier, trn_ldr,
+                                        val_ldr, config['ep'], config['lr'],
+                                        verbose=False,
+                                        patience=_shared['patience'])
+
+    best_ep = int(np.argmin(val_hist[:, 1])) if _shared['patience'] \
+        else len(val_hist) - 1 # state of the returned classifier
+    row = dict(config, epochs=len(val_hist), best_ep=best_ep + 1,
+               val_acc=val_hist[best_ep, 0], val_loss=val_hist[best_ep, 1],
+               trn_acc=trn_hist[best_ep, 0], trn_loss=trn_hist[best_ep, 1],
+               seconds=time.perf_counter() - start)
+    state_dict = {key: value for key, value in classifier.state_dict().items()
+                  if key != 'emb.weight'}
+    return row, trn_hist, val_hist, state_dict
+
+def run_sweep(trials, trn_set, val_set, embedding_weight, processes=1,
+              threads=None, patience=None, seed=0, verbose=False):
+    """ Runs 'trials' in a pool of 'processes' processes with 'threads' torch
+    threads each, which share 'trn_set', 'val_set' and 'embedding_weight'.
+    Divides the cores among the processes, if 'threads' is None. Returns the
+    results of all trials, sorted by validation accuracy and loss. """
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // processes)
+    for tensor in (trn_set.labels, trn_set.emos_feat, trn_set.tags_ids,
+                   trn_set.tags_offsets, trn_set.tags_weights, val_set.labels,
+                   val_set.emos_feat, val_set.tags_ids, val_set.tags_offsets,
+                   val_set.tags_weights, embedding_weight):
+        tensor.share_memory_() # not copied into the worker processes
+
+    results = []
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(processes, initializer=init_worker,
+                  initargs=(trn_set, val_set, embedding_weight, threads,
+                            patience, seed)) as pool:
+        for result in pool.imap_unordered(run_trial, trials):
+            row = result[0]
+            print_log(f"Trial {row['trial']:3d} (ba={row['ba']}, "
+                      f"lr={row['lr']}, ep={row['ep']}, "
+                      f"hid_dim={row['hid_dim']}): "
+                      f"val-acc {row['val_acc']:.4f}, "
+                      f"val-loss {row['val_loss']:.4f} after {row['epochs']} "
+                      f"epochs in {row['seconds']:.1f}s", verbose)
+            results.append(result)
+    return sorted(results, key=lambda result: (-result[0]['val_acc'],
+                                               result[0]['val_loss']))
+
+# Main
+
+def parse_arguments(args):
+    """ Creates an ArgumentParser with help messages. """
+    info =  """ Hyperparameter search for a classifier for PLD media bias
+            classification. Uses tweets from CSV-files generated by
+            'data_retriever.py'. """
+    parser = ArgumentParser(description=info)
+    parser.add_argument('sweep_name', help="specify name of the sweep")
+    parser.add_argument('data_l',
+                        help="specify relative path to left training data")
+    parser.add_argument('data_r',
+                        help="specify relative path to right training data")
+    parser.add_argument('-b', '--ba', type=int, nargs='+', default=[43],
+                        metavar='N', help="specify batch sizes")
+    parser.add_argument('-c', '--chunk', type=int, default=1000, metavar='N',
+                        help="specify number of rows read from CSV at once")
+    parser.add_argument('-e', '--ep', type=int, nargs='+', default=[10],
+                        metavar='N', help="specify numbers of epochs")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help="specify number of processes for preprocessing")
+    parser.add_argument('-l', '--lr', type=float, nargs='+', default=[0.01],
+                        metavar='R', help="specify learning rates")
+    parser.add_argument('-p', '--processes', type=int, default=1, metavar='N',
+                        help="specify number of trials in parallel")
+    parser.add_argument('-r', '--random', type=int, default=None, metavar='N',
+                        help="sample N configurations from the grid")
+    parser.add_argument('-s', '--seed', type=int, default=0, metavar='N',
+                        help="specify random seed")
+    parser.add_argument('-t', '--threads', type=int, default=None, metavar='N',
+                        help="specify torch threads per trial")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help="activate output")
+    parser.add_argument('--buckets', type=int, default=None, metavar='N',
+                        help="hash Hashtags into N embedding rows")
+    parser.add_argument('--hid', type=int, nargs='+', default=[30],
+                        metavar='N', help="specify hidden layer sizes")
+    parser.add_argument('--max-size', type=int, default=None, metavar='N',
+                        help="specify maximum number of Hashtags in vocab")
+    parser.add_argument('--min-freq', type=int, default=1, metavar='N',
+                        help="specify minimum count of Hashtags in vocab")
+    parser.add_argument('--patience', type=int, default=None, metavar='N',
+                        help="stop after N epochs without better val-loss")
+    parser.add_argument('--sketch', type=int, default=None, metavar='N',
+                        help="prune rare Hashtags with a sketch of N counters")
+    parser.add_argument('--val', type=int, default=86, metavar='N',
+                        help="specify number of samples for validation")
+    parser.add_argument('--vectors', default=None, metavar='PATH',
+                        help="specify embedding store from 'embedding_store.py'"
+                             " instead of downloading fastText")
+
+    if len(args) < 1:  # show help, if no arguments are given
+        parser.print_help(sys.stderr)
+        sys.exit()
+    return parser.parse_args(args)
+
+def main(args):
+    parsed_args = parse_arguments(args)
+    assert all(ba > 0 for ba in parsed_args.ba)
+    assert all(ep > 0 for ep in parsed_args.ep)
+    assert all(lr > 0.0 for lr in parsed_args.lr)
+    assert all(hid_dim > 0 for hid_dim in parsed_args.hid)
+    assert parsed_args.chunk > 0
+    assert parsed_args.jobs > 0
+    assert parsed_args.processes > 0
+    assert parsed_args.val > 0
+    assert parsed_args.random is None or parsed_args.random > 0
+    assert parsed_args.threads is None or parsed_args.threads > 0
+    assert parsed_args.patience is None or parsed_args.patience > 0
+    assert parsed_args.vectors is None or os.path.isdir(parsed_args.vectors)
+    assert parsed_args.sketch is None or parsed_args.sketch > 0
+
+    torch.manual_seed(parsed_args.seed)
+    pld_dataset, vocab, cnts_range = build_training_set(parsed_args)
+    # one validation set for all trials, independent of their batch size
+    trn_set, val_set = split_dataset(pld_dataset, parsed_args.val, 1,
+                                     parsed_args.verbose)
+    trials = generate_trials(parsed_args.ba, parsed_args.lr, parsed_args.ep,
+                             parsed_args.hid, parsed_args.random,
+                             parsed_args.seed)
+    print_log(f"Running {len(trials)} trials.", parsed_args.verbose)
+
+    results = run_sweep(trials, trn_set, val_set, vocab.vectors,
+                        parsed_args.processes, parsed_args.threads,
+                        parsed_args.patience, parsed_args.seed,
+                        parsed_args.verbose)
+    write_leaderboard_to_csv(parsed_args.sweep_name,
+                             [result[0] for result in results],
+                             LEADERBOARD_KEYS)
+
+    best_row, trn_hist, val_hist, state_dict = results[0]
+    classifier = build_classifier(vocab.vectors,
+                                  {'hid_dim': best_row['hid_dim']})
+    classifier.load_state_dict(state_dict, strict=False)
+    write_model_to_files(parsed_args.sweep_name, classifier, vocab, cnts_range)
+    write_hists_to_file(parsed_args.sweep_name, trn_hist, val_hist)
+    print_log(f"Leaderboard saved. Best trial {best_row['trial']} saved as "
+              f"'{parsed_args.sweep_name}'.", parsed_args.verbose)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
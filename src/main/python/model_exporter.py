@@ -0,0 +1,167 @@
+"""
+Exports a trained classifier for the PLDs of referenced URLs into a TorchScript
+file for inference on CPUs, which 'evaluation.py' loads with '--exported'
+without building the classifier or its vocab. Optionally quantizes the hidden
+and output layer dynamically to int8 and stores the embedding in half
+precision or int8. Compares the predictions and the throughput of the export
+with those of the original classifier on test data.
+
+Example call:
+python -m model_exporter 'leaning_guesser' 'leaning_guesser_int8' -q -e int8 -d '../../../input_data/test_tweets.csv' -v
+"""
+
+import copy
+import sys
+import torch
+from argparse import ArgumentParser
+from typing import Optional
+from torch import Tensor
+from torch.nn import Linear, Module
+from torch.nn.functional import embedding_bag
+
+from data_file_handler import generate_export_file_name, \
+                              read_model_from_files, write_exported_model, \
+                              write_metrics_to_file
+from evaluation import apply_classifier, build_test_set
+from feature_store import load_feature_store
+from helpers import print_log, time_call
+from pld_dataset import build_dataloader
+
+EMB_DTYPES = ('float', 'half', 'int8')
+
+# Export
+
+class HalfEmbeddingBag(Module):
+    """ EmbeddingBag in 'sum' mode, whose weight is kept in half precision.
+    Returns the sums of a batch in single precision. """
+
+    def __init__(self, weight):
+        super().__init__()
+        self.register_buffer('weight', weight.detach().half())
+
+    def forward(self, input: Tensor, offsets: Tensor,
+                per_sample_weights: Optional[Tensor] = None):
+        if per_sample_weights is not None:
+            per_sample_weights = per_sample_weights.half()
+        return embedding_bag(input, self.weight, offsets, mode='sum',
+                             per_sample_weights=per_sample_weights).float()
+
+def convert_embedding(emb, emb_dtype):
+    """ Converts the EmbeddingBag 'emb' in 'sum' mode into one whose weight
+    has 'emb_dtype' from 'EMB_DTYPES'. int8 quantizes each row separately. """
+    if emb_dtype == 'half':
+        return HalfEmbeddingBag(emb.weight)
+    if emb_dtype == 'int8':
+        from torch.nn.quantized import EmbeddingBag as QuantizedEmbeddingBag
+        from torch.quantization import float_qparams_weight_only_qconfig
+        emb.qconfig = float_qparams_weight_only_qconfig
+        return QuantizedEmbeddingBag.from_float(emb)
+    return emb
+
+def export_classifier(classifier, quantize=False, emb_dtype='float'):
+    """ Compiles a copy of 'classifier' via 'torch.jit.script'. Quantizes the
+    weights of its linear layers dynamically to int8, if 'quantize' is True,
+    and converts its embedding into 'emb_dtype' from 'EMB_DTYPES'. Returns the
+    compiled module, which is called like the classifier. """
+    classifier = copy.deepcopy(classifier).eval()
+    if quantize:
+        from torch.quantization import quantize_dynamic
+        classifier = quantize_dynamic(classifier, {Linear}, dtype=torch.qint8)
+    classifier.emb = convert_embedding(classifier.emb, emb_dtype)
+    return torch.jit.script(classifier)
+
+# Comparison
+
+def compare_classifiers(classifier, exported, test_set, batch_size, repeat=3):
+    """ Scores 'test_set' in batches of 'batch_size' samples with
+    'classifier' and its export 'exported'. Returns a dict with the maximum
+    and mean absolute difference of their probabilities, the share of equal
+    classes and the best throughput of both in samples per second from
+    'repeat' runs. """
+    test_ldr = build_dataloader(test_set, batch_size)
+    eager_time, eager_preds = time_call(apply_classifier, classifier, test_ldr,
+                                        repeat=repeat)
+    export_time, export_preds = time_call(apply_classifier, exported,
+                                          test_ldr, repeat=repeat)
+    drift = (eager_preds - export_preds).abs()
+    agreement = (eager_preds.argmax(dim=1) == export_preds.argmax(dim=1))
+    return {'samples': len(test_set), 'batch_size': batch_size,
+            'max_drift': float(drift.max()), 'mean_drift': float(drift.mean()),
+            'agreement': float(agreement.double().mean()),
+            'eager_samples_per_s': len(test_set) / eager_time,
+            'export_samples_per_s': len(test_set) / export_time,
+            'speedup': eager_time / export_time}
+
+# Main
+
+def parse_arguments(args):
+    """ Creates an ArgumentParser with help messages. """
+    info =  """ Export of a classifier for PLD media bias classification into
+            TorchScript for 'evaluation.py'. """
+    parser = ArgumentParser(description=info)
+    parser.add_argument('cls', help="specify relative path to classifier")
+    parser.add_argument('export', help="specify relative path to the export")
+    parser.add_argument('-b', '--ba', type=int, default=1024, metavar='N',
+                        help="specify number of samples per batch")
+    parser.add_argument('-c', '--chunk', type=int, default=1000, metavar='N',
+                        help="specify number of rows read from CSV at once")
+    parser.add_argument('-d', '--data', default=None, metavar='PATH',
+                        help="specify relative path to test data to compare "
+                             "the export with the classifier")
+    parser.add_argument('-e', '--emb', default='float', choices=EMB_DTYPES,
+                        help="specify data type of the embedding")
+    parser.add_argument('-q', '--quantize', action='store_true',
+                        default=False,
+                        help="quantize the linear layers dynamically to int8")
+    parser.add_argument('-r', '--repeat', type=int, default=3, metavar='N',
+                        help="specify number of timed runs per classifier")
+    parser.add_argument('-t', '--tolerance', type=float, default=0.01,
+                        metavar='R',
+                        help="specify maximum drift of probabilities")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help="activate output")
+
+    if len(args) < 1:  # show help, if no arguments are given
+        parser.print_help(sys.stderr)
+        sys.exit()
+    return parser.parse_args(args)
+
+def main(args):
+    parsed_args = parse_arguments(args)
+    assert parsed_args.ba > 0
+    assert parsed_args.chunk > 0
+    assert parsed_args.repeat > 0
+    assert parsed_args.tolerance >= 0.0
+
+    classifier, stoi, cnts_range = read_model_from_files(parsed_args.cls)
+    exported = export_classifier(classifier, parsed_args.quantize,
+                                 parsed_args.emb)
+    if parsed_args.data is not None:
+        # compare before writing, so that no export beyond the tolerance remains
+        store = load_feature_store(parsed_args.data, parsed_args.chunk,
+                                   parsed_args.verbose)
+        report = compare_classifiers(classifier, exported,
+                                     build_test_set(store, stoi, cnts_range),
+                                     parsed_args.ba, parsed_args.repeat)
+        report.update({'quantize': parsed_args.quantize,
+                       'emb': parsed_args.emb,
+                       'tolerance': parsed_args.tolerance})
+        write_metrics_to_file(parsed_args.export, 'export', report)
+        print_log(f"Max drift {report['max_drift']:.2e}, mean drift "
+                  f"{report['mean_drift']:.2e}, equal classes "
+                  f"{report['agreement']:.4f}.", parsed_args.verbose)
+        print_log(f"Throughput {report['eager_samples_per_s']:.0f} samples/s "
+                  f"eager, {report['export_samples_per_s']:.0f} samples/s "
+                  f"exported ({report['speedup']:.2f}x).", parsed_args.verbose)
+        if report['max_drift'] > parsed_args.tolerance:
+            sys.exit(f"Drift {report['max_drift']:.2e} of the export exceeds "
+                     f"the tolerance {parsed_args.tolerance}, so it is not "
+                     f"written.")
+
+    write_exported_model(parsed_args.export, exported, stoi, cnts_range)
+    print_log(f"Classifier exported to "
+              f"'{generate_export_file_name(parsed_args.export)}'.",
+              parsed_args.verbose)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,11 +1,14 @@
-from torch import cat
+from typing import Optional
+
+from torch import Tensor, cat, repeat_interleave
 from torch.nn import CrossEntropyLoss, EmbeddingBag, Linear, Module
 from torch.nn.functional import leaky_relu, softmax
 
-def build_classifier(vocab):
-    """ Builds a PLDClassifier with pretrained embedding from 'vocab'. """
-    param = PLDClassifierParam() # standard parameter
-    return PLDClassifier(param, embedding_weight=vocab.vectors)
+def build_classifier(embedding_weight, param_dict: dict = dict()):
+    """ Builds a PLDClassifier with the pretrained 'embedding_weight'. Uses
+    standard parameters unless they are given in 'param_dict'. """
+    param = PLDClassifierParam(param_dict)
+    return PLDClassifier(param, embedding_weight=embedding_weight)
 
 class PLDClassifierParam(object):
     """ Defines parameters for the initialization of a PLDClassifier. """
@@ -18,18 +21,29 @@ class PLDClassifier(Module):
     """ Classifier which predicts the leaning of PLDs. """
     def __init__(self, params: PLDClassifierParam, embedding_weight):
         super().__init__()
+        self.params = params
 
-        self.emb = EmbeddingBag.from_pretrained(embedding_weight)
+        # mean via 'weights', which are normalized per sample
+        self.emb = EmbeddingBag.from_pretrained(embedding_weight, mode='sum')
         self.hid = Linear(params.emb_dim + 5, params.hid_dim) # +5 for emos
         self.out = Linear(params.hid_dim, params.num_classes)
 
         self.loss_fct = CrossEntropyLoss()
 
-    def forward(self, emos, tags_vec, offsets, probs=False):
-        """ Performs a forward pass through the classifier. Calculates
-        probabilities via Softmax function if 'probs' is True. """
+    def forward(self, emos: Tensor, tags_vec: Tensor, offsets: Tensor,
+                weights: Optional[Tensor] = None, probs: bool = False):
+        """ Performs a forward pass through the classifier. Weights the token
+        ids from 'tags_vec' with 'weights', which sum up to 1 per sample, or
+        equally, if it is None. Calculates probabilities via Softmax function
+        if 'probs' is True. Annotated, so that it can be compiled via
+        'torch.jit.script'. """
+        if weights is None:
+            lens = (cat((offsets[1:], offsets.new_full((1,), len(tags_vec))))
+                    - offsets)
+            weights = repeat_interleave(1.0 / lens.clamp(min=1), lens)
         # BS = batch size, ES = number of emotion scores
-        tags_feats = self.emb(tags_vec, offsets)    # (BS, emb_dim)
+        tags_feats = self.emb(tags_vec, offsets,
+                              per_sample_weights=weights)   # (BS, emb_dim)
         tags_feats = leaky_relu(tags_feats)         # (BS, emb_dim)
         concat_feats = cat((tags_feats, emos), 1)   # (BS, emb_dim + ES)
         concat_feats = self.hid(concat_feats)       # (BS, hid_dim)
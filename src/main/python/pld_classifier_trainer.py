@@ -6,42 +6,58 @@ Example call:
 python -m pld_classifier_trainer 'leaning_guesser' '../../../input_data/left_tweets.csv' '../../../input_data/right_tweets.csv' -b 30 -l 0.01 -e 12 -v
 """
 
+import copy
 import numpy as np
+import os
 import sys
+import time
 import torch
 from argparse import ArgumentParser
 from torch.optim import Adam
 
-from data_file_handler import read_tweets_from_csv, write_hists_to_file, \
-                              write_model_to_files
-from data_preprocessor import build_vocab, build_dataloader
-from helpers import print_log, gen_stat_msg, plot_acc_and_loss
+from data_file_handler import generate_trace_file_name, write_hists_to_file, \
+                              write_metrics_to_file, write_model_to_files
+from data_preprocessor import build_tags_vocab, concatenate_colums, \
+                              concatenate_offsets, encode_tags, fit_cnts_range
+from feature_store import load_feature_store
+from helpers import NULL_TIMER, StageTimer, gen_stat_msg, plot_acc_and_loss, \
+                    print_log, trace_to_file
 from pld_classifier import build_classifier
-from pld_dataset import PLDDataset, build_emos_arr, build_label_arr, \
-                        build_tags_str_arr, split_dataset
+from pld_dataset import PLDDataset, build_dataloader, build_emos_arr, \
+                        build_label_arr, split_dataset
 
 # Trainer
 
-def train_classifier(classifier, trn_ldr, val_ldr, ep=5, lr=0.01, verbose=True):
+def train_classifier(classifier, trn_ldr, val_ldr, ep=5, lr=0.01, verbose=True,
+                     timer=NULL_TIMER, patience=None):
     """ Trains 'classifier' for 'ep' epochs using Adam with learning rate 'lr'.
     Uses data from 'trn_ldr' for training and 'val_ldr' for validation. Returns
-    the trained 'classifier' and evaluation metrics from training. """
+    the trained 'classifier' and evaluation metrics from training. Times stages
+    and epochs with 'timer'. If 'patience' is given, training stops early after
+    'patience' epochs without a lower validation loss, and the state with the
+    lowest validation loss is restored. """
     opt = Adam(classifier.parameters(), lr=lr)
     trn_hist, val_hist = [], [] # save tuples (accuracy, loss)
+    best_epoch, best_state = 0, None
 
     for e in range(1, ep+1):
         total_ok, total_count = 0, 0
         epoch_losses = []
+        epoch_start = time.perf_counter()
         classifier.train()
-        for labels, emos, tags, offsets in trn_ldr:
+        for labels, emos, tags, offsets, weights in timer.iterate('collate',
+                                                                 trn_ldr):
             # forward pass
-            opt.zero_grad()
-            predicted_labels = classifier(emos, tags, offsets)
-            loss = classifier.loss_fct(predicted_labels, labels)
+            with timer.stage('forward'):
+                opt.zero_grad()
+                predicted_labels = classifier(emos, tags, offsets, weights)
+                loss = classifier.loss_fct(predicted_labels, labels)
 
             # backward pass
-            loss.backward()
-            opt.step()
+            with timer.stage('backward'):
+                loss.backward()
+            with timer.stage('optimizer'):
+                opt.step()
 
             # evaluation metrics
             epoch_losses.append(loss.item())
@@ -49,9 +65,21 @@ def train_classifier(classifier, trn_ldr, val_ldr, ep=5, lr=0.01, verbose=True):
             total_count += labels.size(0)
 
         trn_hist.append((total_ok / total_count, np.mean(epoch_losses)))
-        val_hist.append(calc_acc_and_loss(classifier, val_ldr))
+        timer.record_epoch(e, total_count, time.perf_counter() - epoch_start)
+        with timer.stage('validation'):
+            val_hist.append(calc_acc_and_loss(classifier, val_ldr))
         print_log(gen_stat_msg(e, trn_hist, val_hist), verbose)
 
+        if patience is not None:
+            if best_epoch == 0 or val_hist[-1][1] < val_hist[best_epoch-1][1]:
+                best_epoch = e
+                best_state = copy.deepcopy(classifier.state_dict())
+            elif e - best_epoch >= patience:
+                print_log(f"Stopped early, best epoch: {best_epoch}", verbose)
+                break
+
+    if best_state is not None:
+        classifier.load_state_dict(best_state)
     return classifier, np.array(trn_hist), np.array(val_hist)
 
 def calc_acc_and_loss(classifier, ldr):
@@ -61,8 +89,8 @@ def calc_acc_and_loss(classifier, ldr):
     losses = []
 
     with torch.no_grad():
-        for labels, emos, tags, offsets in ldr:
-            predicted_labels = classifier(emos, tags, offsets)
+        for labels, emos, tags, offsets, weights in ldr:
+            predicted_labels = classifier(emos, tags, offsets, weights)
             losses.append(classifier.loss_fct(predicted_labels, labels))
             # count correct classifications and samples
             total_ok += (predicted_labels.argmax(1) == labels).sum().item()
@@ -84,12 +112,39 @@ def parse_arguments(args):
                         help="specify relative path to right training data")
     parser.add_argument('-b', '--ba', type=int, default=43, metavar='N',
                         help="specify number of samples per batch")
+    parser.add_argument('-c', '--chunk', type=int, default=1000, metavar='N',
+                        help="specify number of rows read from CSV at once")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help="specify number of processes for preprocessing")
     parser.add_argument('-e', '--ep', type=int, default=10, metavar='N',
                         help="specify number of epochs for training")
     parser.add_argument('-l', '--lr', type=float, default=0.01, metavar='R',
                         help="specify learning rate")
     parser.add_argument('-v', '--verbose', action='store_true', default=False,
                         help="activate output")
+    parser.add_argument('-w', '--workers', type=int, default=0, metavar='N',
+                        help="specify number of processes for data loading")
+    parser.add_argument('--buckets', type=int, default=None, metavar='N',
+                        help="hash Hashtags into N embedding rows")
+    parser.add_argument('--max-size', type=int, default=None, metavar='N',
+                        help="specify maximum number of Hashtags in vocab")
+    parser.add_argument('--min-freq', type=int, default=1, metavar='N',
+                        help="specify minimum count of Hashtags in vocab")
+    parser.add_argument('--patience', type=int, default=None, metavar='N',
+                        help="stop after N epochs without better val-loss")
+    parser.add_argument('--pin-memory', action='store_true', default=False,
+                        help="copy batches into pinned memory")
+    parser.add_argument('--prefetch', type=int, default=2, metavar='N',
+                        help="specify number of batches loaded per worker")
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help="write per-stage timers and memory to JSON")
+    parser.add_argument('--sketch', type=int, default=None, metavar='N',
+                        help="prune rare Hashtags with a sketch of N counters")
+    parser.add_argument('--trace', action='store_true', default=False,
+                        help="write a cProfile trace of the whole run")
+    parser.add_argument('--vectors', default=None, metavar='PATH',
+                        help="specify embedding store from 'embedding_store.py'"
+                             " instead of downloading fastText")
 
     if len(args) < 1:  # show help, if no arguments are given
         parser.print_help(sys.stderr)
@@ -101,35 +156,88 @@ def main(args):
     assert parsed_args.ba > 0
     assert parsed_args.ep > 0
     assert parsed_args.lr > 0.0
+    assert parsed_args.chunk > 0
+    assert parsed_args.jobs > 0
+    assert parsed_args.workers >= 0
+    assert parsed_args.prefetch > 0
+    assert parsed_args.min_freq > 0
+    assert parsed_args.max_size is None or parsed_args.max_size > 0
+    assert parsed_args.buckets is None or parsed_args.buckets > 0
+    assert parsed_args.sketch is None or parsed_args.sketch > 0
+    assert parsed_args.vectors is None or os.path.isdir(parsed_args.vectors)
+    assert parsed_args.patience is None or parsed_args.patience > 0
+
+    timer = StageTimer(enabled=parsed_args.profile)
+    if parsed_args.trace:
+        trace_path = generate_trace_file_name(parsed_args.model_name, 'train')
+        with trace_to_file(trace_path):
+            trn_hist, val_hist = run_training(parsed_args, timer)
+    else:
+        trn_hist, val_hist = run_training(parsed_args, timer)
+
+    if parsed_args.profile:
+        write_metrics_to_file(parsed_args.model_name, 'train', timer.to_dict())
+    if parsed_args.verbose:
+        plot_acc_and_loss(trn_hist, val_hist)
 
-    l_pld_ls, l_cnts, l_emos_pos_ls, l_emos_neg_ls, l_tags_ls, _ \
-        = read_tweets_from_csv(parsed_args.data_l, parsed_args.verbose)
-    r_pld_ls, r_cnts, r_emos_pos_ls, r_emos_neg_ls, r_tags_ls, _ \
-        = read_tweets_from_csv(parsed_args.data_r, parsed_args.verbose)
-
-    label_arr = build_label_arr(len(l_pld_ls), len(r_pld_ls))
-    emos_arr = build_emos_arr(l_emos_pos_ls, l_emos_neg_ls,
-                              r_emos_pos_ls, r_emos_neg_ls, l_cnts, r_cnts)
-    tags_str_arr = build_tags_str_arr(l_tags_ls, r_tags_ls)
-
-    pld_dataset = PLDDataset(label_arr, emos_arr, tags_str_arr)
-    vocab, tokenizer = build_vocab(tags_str_arr)
+def build_training_set(parsed_args, timer=NULL_TIMER):
+    """ Loads the feature stores for the left and right training data from
+    'parsed_args' and builds one dataset with all PLDs. Returns the PLDDataset,
+    the vocab and the tuple (min, max) which normalizes counters. """
+    l_store = load_feature_store(parsed_args.data_l, parsed_args.chunk,
+                                 parsed_args.verbose, timer,
+                                 parsed_args.jobs)
+    r_store = load_feature_store(parsed_args.data_r, parsed_args.chunk,
+                                 parsed_args.verbose, timer,
+                                 parsed_args.jobs)
+
+    label_arr = build_label_arr(len(l_store['plds']), len(r_store['plds']))
+    cnts_range = fit_cnts_range(l_store['cnts'], r_store['cnts'])
+    emos_arr = build_emos_arr(l_store['emos'], r_store['emos'],
+                              l_store['cnts'], r_store['cnts'], cnts_range)
+    with timer.stage('vocab_build'):
+        vocab = build_tags_vocab([(store['tokens'], store['tag_ids'],
+                                   store['tag_counts'])
+                                  for store in (l_store, r_store)],
+                                 parsed_args.min_freq, parsed_args.max_size,
+                                 parsed_args.buckets, parsed_args.sketch,
+                                 parsed_args.vectors)
+    tags_ids = concatenate_colums(
+        encode_tags(l_store['tokens'], l_store['tag_ids'], vocab.stoi),
+        encode_tags(r_store['tokens'], r_store['tag_ids'], vocab.stoi))
+    tags_offsets = concatenate_offsets(l_store['tag_offsets'],
+                                       r_store['tag_offsets'])
+    tags_counts = concatenate_colums(l_store['tag_counts'],
+                                     r_store['tag_counts'])
+
+    pld_dataset = PLDDataset(label_arr, emos_arr, tags_ids, tags_offsets,
+                             tags_counts)
     print_log("Pre-processing done.", parsed_args.verbose)
+    return pld_dataset, vocab, cnts_range
+
+def run_training(parsed_args, timer=NULL_TIMER):
+    """ Trains and saves a classifier as specified by 'parsed_args'. Returns
+    the evaluation metrics from training. """
+    pld_dataset, vocab, cnts_range = build_training_set(parsed_args, timer)
 
     trn_set, val_set = split_dataset(pld_dataset, parsed_args.ba,
                                      verbose=parsed_args.verbose)
-    trn_ldr = build_dataloader(trn_set, parsed_args.ba, vocab, tokenizer)
-    val_ldr = build_dataloader(val_set, parsed_args.ba, vocab, tokenizer)
+    trn_ldr = build_dataloader(trn_set, parsed_args.ba, parsed_args.workers,
+                               parsed_args.pin_memory, parsed_args.prefetch)
+    val_ldr = build_dataloader(val_set, parsed_args.ba, parsed_args.workers,
+                               parsed_args.pin_memory, parsed_args.prefetch)
 
-    classifier = build_classifier(vocab)
+    classifier = build_classifier(vocab.vectors)
     classifier, trn_hist, val_hist = train_classifier(classifier, trn_ldr,
                                         val_ldr, parsed_args.ep,
-                                        parsed_args.lr, parsed_args.verbose)
-    write_model_to_files(parsed_args.model_name, classifier, vocab)
-    write_hists_to_file(parsed_args.model_name, trn_hist, val_hist)
+                                        parsed_args.lr, parsed_args.verbose,
+                                        timer, parsed_args.patience)
+    with timer.stage('serialization'):
+        write_model_to_files(parsed_args.model_name, classifier, vocab,
+                             cnts_range)
+        write_hists_to_file(parsed_args.model_name, trn_hist, val_hist)
     print_log("Classifier trained. State and vocab saved.", parsed_args.verbose)
-    if parsed_args.verbose:
-        plot_acc_and_loss(trn_hist, val_hist)
+    return trn_hist, val_hist
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -1,44 +1,112 @@
-from torch import is_tensor
-from torch.utils.data import Dataset, random_split
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
 
 from data_preprocessor import append_cnts_to_emos, concatenate_colums, \
-                              generate_labels, preprocess_cnts, \
-                              preprocess_emos, preprocess_tags
+                              fit_cnts_range, generate_labels, preprocess_cnts
 from helpers import print_log
 
+class BatchSlicer(Sampler):
+    """ Sampler which yields slices of 'batch_size' contiguous indices. """
+
+    def __init__(self, length, batch_size):
+        """ Slices indices from 0 to 'length' into batches. """
+        self.length = length
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        for start in range(0, self.length, self.batch_size):
+            yield slice(start, min(start + self.batch_size, self.length))
+
+    def __len__(self):
+        return (self.length + self.batch_size - 1) // self.batch_size
+
 class PLDDataset(Dataset):
-    """ PLD dataset. """
+    """ PLD dataset. Holds the token ids of all samples as one flat tensor with
+    offsets, so that a batch of contiguous samples is a slice of each tensor.
+    """
 
-    def __init__(self, labels, emos_feat, tags_feat):
-        """ Expects preprocessed 'labels', 'emos_feat' and 'tags_feat'. """
-        self.labels = labels
-        self.emos_feat = emos_feat
-        self.tags_feat = tags_feat
+    def __init__(self, labels, emos_feat, tags_ids, tags_offsets,
+                 tags_counts=None):
+        """ Expects preprocessed 'labels' and 'emos_feat', the flat token ids
+        'tags_ids' and 'tags_offsets', whose entries i and i+1 enclose the
+        token ids of sample i. 'tags_counts' holds how often each token id
+        occurs in its sample, or 1 per token id, if it is None. """
+        assert len(tags_offsets) == len(labels) + 1
+        self.labels = torch.as_tensor(labels, dtype=torch.int64)
+        self.emos_feat = torch.tensor(np.asarray(emos_feat), dtype=torch.int64)
+        self.tags_ids = torch.as_tensor(tags_ids, dtype=torch.int64)
+        self.tags_offsets = torch.tensor(np.asarray(tags_offsets),
+                                         dtype=torch.int64)
+        tags_counts = torch.ones(len(self.tags_ids)) if tags_counts is None \
+            else torch.tensor(np.asarray(tags_counts), dtype=torch.float32)
+        self.tags_weights = normalize_counts(tags_counts, self.tags_offsets)
 
     def __len__(self):
         return len(self.labels)
 
     def __getitem__(self, idx):
-        if is_tensor(idx):
+        """ Returns the batch (labels, emos, tags, offsets, weights) for the
+        samples in slice 'idx' or for the single sample 'idx'. """
+        if torch.is_tensor(idx):
             idx = idx.tolist()
+        if isinstance(idx, int):
+            idx = slice(idx, idx+1)
+        start, stop, step = idx.indices(len(self))
+        assert step == 1
+
+        tags_start = self.tags_offsets[start]
+        tags_stop = self.tags_offsets[stop]
+        return (self.labels[start:stop], self.emos_feat[start:stop],
+                self.tags_ids[tags_start:tags_stop],
+                self.tags_offsets[start:stop] - tags_start,
+                self.tags_weights[tags_start:tags_stop])
+
+    def subset(self, indices):
+        """ Gathers the samples at 'indices' into a new PLDDataset, whose token
+        ids are contiguous again. """
+        indices = torch.as_tensor(indices, dtype=torch.int64)
+        starts = self.tags_offsets[:-1][indices]
+        lens = self.tags_offsets[1:][indices] - starts
+        sub_offsets = torch.cat((torch.zeros(1, dtype=torch.int64),
+                                 lens.cumsum(dim=0)))
+        # position of each token of the subset in 'tags_ids'
+        positions = torch.arange(int(sub_offsets[-1])) \
+            + torch.repeat_interleave(starts - sub_offsets[:-1], lens)
+
+        subset = PLDDataset.__new__(PLDDataset)
+        subset.labels = self.labels[indices]
+        subset.emos_feat = self.emos_feat[indices]
+        subset.tags_ids = self.tags_ids[positions]
+        subset.tags_offsets = sub_offsets
+        subset.tags_weights = self.tags_weights[positions]
+        return subset
+
+def build_dataloader(pld_dataset, batch_size, workers=0, pin_memory=False,
+                     prefetch=2):
+    """ Builds dataloader for 'pld_dataset', whose Hashtags are encoded as
+    token ids already. Each batch contains 'batch_size' contiguous samples and
+    is sliced from the dataset's tensors without any further collation. Uses
+    'workers' subprocesses, which load 'prefetch' batches in advance each, and
+    copies batches into pinned memory if 'pin_memory' is True. """
+    worker_kwargs = {'prefetch_factor': prefetch, 'persistent_workers': True} \
+        if workers > 0 else {}
+    return DataLoader(pld_dataset, batch_size=None, num_workers=workers,
+                      sampler=BatchSlicer(len(pld_dataset), batch_size),
+                      pin_memory=pin_memory, **worker_kwargs)
 
-        return {'label': self.labels[idx],
-                'emos': self.emos_feat[idx],
-                'tags': self.tags_feat[idx],}
-
-def build_emos_arr(l_emos_pos_ls, l_emos_neg_ls, r_emos_pos_ls, r_emos_neg_ls,
-                   l_cnts_ls, r_cnts_ls):
-    """ Preprocesses the input lists from a CSV-file and builds one array
-    [pos_avg, neg_avg, pos_std, neg_std, cnt] with one arithmetic mean and
-    standard deviation for all left and right emotion scores per PLD. 'cnt'
-    holds normalized counters of aggregated tweets. """
-    l_emos_arr = preprocess_emos(l_emos_pos_ls, l_emos_neg_ls)
-    r_emos_arr = preprocess_emos(r_emos_pos_ls, r_emos_neg_ls)
-    l_cnts_arr = preprocess_cnts(l_cnts_ls)
-    r_cnts_arr = preprocess_cnts(r_cnts_ls)
+def build_emos_arr(l_emos_arr, r_emos_arr, l_cnts_ls, r_cnts_ls,
+                   cnts_range=None):
+    """ Builds one array [pos_avg, neg_avg, pos_std, neg_std, cnt] from the
+    preprocessed emotion scores 'l_emos_arr' and 'r_emos_arr' for all left and
+    right PLDs. 'cnt' holds counters of aggregated tweets, which are normalized
+    with the tuple (min, max) 'cnts_range' or over all left and right PLDs. """
+    if cnts_range is None:
+        cnts_range = fit_cnts_range(l_cnts_ls, r_cnts_ls)
 
     emos_arr = concatenate_colums(l_emos_arr, r_emos_arr)
-    cnts_arr = concatenate_colums(l_cnts_arr, r_cnts_arr)
+    cnts_arr = preprocess_cnts(concatenate_colums(l_cnts_ls, r_cnts_ls),
+                               cnts_range)
     return append_cnts_to_emos(emos_arr, cnts_arr)
 
 def build_label_arr(l_len, r_len):
@@ -47,12 +115,15 @@ def build_label_arr(l_len, r_len):
     r_label_arr = generate_labels(r_len, left=False)
     return concatenate_colums(l_label_arr, r_label_arr)
 
-def build_tags_str_arr(l_tags_ls, r_tags_ls):
-    """ Preprocesses the input lists which are read from a CSV-file and
-    concatenates the results, i.e., one string with Hashtags per PLD. """
-    l_tag_str_arr = preprocess_tags(l_tags_ls)
-    r_tag_str_arr = preprocess_tags(r_tags_ls)
-    return concatenate_colums(l_tag_str_arr, r_tag_str_arr)
+def normalize_counts(tags_counts, tags_offsets):
+    """ Divides the counts of token ids 'tags_counts' by the total count of
+    their sample, whose token ids are enclosed by 'tags_offsets'. The weighted
+    sum of a sample's token vectors then equals the mean over all occurrences
+    of its tokens. Returns a float tensor. """
+    lens = tags_offsets[1:] - tags_offsets[:-1]
+    sample_idx = torch.repeat_interleave(torch.arange(len(lens)), lens)
+    totals = torch.zeros(len(lens)).index_add_(0, sample_idx, tags_counts)
+    return tags_counts / totals[sample_idx]
 
 def split_dataset(pld_dataset, batch_size=43, val_batches=2, verbose=False):
     """ Randomly splits 'pld_dataset' into training and validation sets. Takes
@@ -61,4 +132,6 @@ def split_dataset(pld_dataset, batch_size=43, val_batches=2, verbose=False):
     trn_len = len(pld_dataset) - val_len
     assert val_len < trn_len
     print_log(f"{trn_len} trn-samples, {val_len} val-samples", verbose)
-    return random_split(pld_dataset, [trn_len, val_len])
+    indices = torch.randperm(len(pld_dataset))
+    return pld_dataset.subset(indices[:trn_len]), \
+        pld_dataset.subset(indices[trn_len:])
@@ -0,0 +1,205 @@
+"""
+Scores the results of a classifier for the PLDs of referenced URLs against
+gold PLDs in one process and linear time instead of running 'Eval.java'.
+Calculates the accuracy like 'Eval.java', the confusion matrix, precision and
+recall per class on the gold PLDs with predictions and a calibration curve
+over bins of confidences.
+
+Example call:
+python -m result_scorer '../resources/gold_left.csv' '../resources/gold_right.csv' '../../../output_data/left.csv' '../../../output_data/right.csv' -b 10 -v
+"""
+
+import itertools
+import json
+import numpy as np
+import sys
+from argparse import ArgumentParser
+
+from data_file_handler import read_results_from_csv
+from helpers import print_log
+
+CLASS_NAMES = ('left', 'right')
+
+# Joins
+
+def count_eval_outcomes(gold_l, gold_r, plds_l, plds_r):
+    """ Counts true and false positives and negatives exactly like 'Eval.java'
+    for the gold PLDs 'gold_l' and 'gold_r' and the predicted PLDs 'plds_l'
+    and 'plds_r', whose duplicates count repeatedly. Tests membership in sets
+    instead of lists. Returns a dict. """
+    gold_l, gold_r = set(gold_l), set(gold_r)
+    set_l, set_r = set(plds_l), set(plds_r)
+    return {'tp': sum(pld in gold_l for pld in plds_l)
+                  + sum(pld in gold_r for pld in plds_r),
+            'fp': sum(pld not in gold_l for pld in plds_l)
+                  + sum(pld not in gold_r for pld in plds_r),
+            'tn': len(gold_r - set_l) + len(gold_l - set_r),
+            'fn': len(gold_r - set_r) + len(gold_l - set_l)}
+
+def join_predictions(gold_l, gold_r, plds_l, plds_r, confs_l, confs_r):
+    """ Joins the predicted PLDs 'plds_l' and 'plds_r' and their confidences
+    'confs_l' and 'confs_r' with the gold PLDs 'gold_l' and 'gold_r' via
+    dicts. Later entries of a PLD replace earlier ones. Returns np.arrays with
+    the gold class, predicted class and confidence of each gold PLD with a
+    prediction, and the numbers of gold PLDs without prediction and of
+    predicted PLDs without gold class. """
+    pred_arr = np.concatenate((np.zeros(len(plds_l), dtype=np.int64),
+                               np.ones(len(plds_r), dtype=np.int64)))
+    conf_arr = np.concatenate((confs_l, confs_r))
+    rows = {pld: i for i, pld in enumerate(itertools.chain(plds_l, plds_r))}
+    gold = dict.fromkeys(gold_l, 0)
+    gold.update(dict.fromkeys(gold_r, 1))
+
+    gold_rows = np.fromiter((rows.get(pld, -1) for pld in gold),
+                            dtype=np.int64, count=len(gold))
+    true_arr = np.fromiter(gold.values(), dtype=np.int64, count=len(gold))
+    found = gold_rows >= 0
+    num_unlabeled = sum(pld not in gold for pld in rows)
+    return (true_arr[found], pred_arr[gold_rows[found]],
+            conf_arr[gold_rows[found]], len(gold) - int(found.sum()),
+            num_unlabeled)
+
+# Metrics
+
+def calc_eval_accuracy(outcomes):
+    """ Calculates the accuracy from the dict 'outcomes' in single precision
+    like 'Eval.java'. """
+    total = outcomes['tp'] + outcomes['tn'] + outcomes['fp'] + outcomes['fn']
+    return float(np.float32(outcomes['tp'] + outcomes['tn'])
+                 / np.float32(total))
+
+def calc_confusion_matrix(true_arr, pred_arr, num_classes=2):
+    """ Counts the samples per gold class from 'true_arr' (rows) and predicted
+    class from 'pred_arr' (columns). Returns a np.array. """
+    return np.bincount(true_arr * num_classes + pred_arr,
+                       minlength=num_classes**2).reshape(num_classes,
+                                                         num_classes)
+
+def calc_precision_recall(confusion):
+    """ Calculates precision and recall per class from the matrix 'confusion'.
+    Both are NaN for classes without predictions or gold samples. Returns
+    them as np.arrays. """
+    hits = np.diag(confusion).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return hits / confusion.sum(axis=0), hits / confusion.sum(axis=1)
+
+def calc_calibration(true_arr, pred_arr, conf_arr, bins=10, num_classes=2):
+    """ Divides the confidences from 'conf_arr' between 1 / 'num_classes' and
+    1 into 'bins' bins of equal width. Returns a dict with the lower bound,
+    number of samples, mean confidence and accuracy of each bin as np.arrays,
+    whose mean and accuracy are NaN for empty bins, and the expected
+    calibration error, i.e., their mean absolute difference weighted by the
+    number of samples, which is NaN without samples. """
+    edges = np.linspace(1.0 / num_classes, 1.0, bins + 1)
+    bin_arr = np.clip(np.searchsorted(edges, conf_arr, side='right') - 1, 0,
+                      bins - 1)
+    counts = np.bincount(bin_arr, minlength=bins)
+    conf_sums = np.bincount(bin_arr, weights=conf_arr, minlength=bins)
+    hit_sums = np.bincount(bin_arr, weights=(true_arr == pred_arr),
+                           minlength=bins)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_confs, accs = conf_sums / counts, hit_sums / counts
+    ece = np.sum(np.abs(hit_sums - conf_sums)) / len(conf_arr) \
+        if len(conf_arr) > 0 else np.nan
+    return {'lower': edges[:-1], 'count': counts, 'confidence': mean_confs,
+            'accuracy': accs, 'ece': float(ece)}
+
+def score_results(gold_l, gold_r, plds_l, plds_r, confs_l, confs_r,
+                  bins=10):
+    """ Scores the predicted PLDs 'plds_l' and 'plds_r' with confidences
+    'confs_l' and 'confs_r' against the gold PLDs 'gold_l' and 'gold_r'.
+    Returns a dict with all metrics, see 'print_report'. """
+    outcomes = count_eval_outcomes(gold_l, gold_r, plds_l, plds_r)
+    true_arr, pred_arr, conf_arr, num_missing, num_unlabeled = \
+        join_predictions(gold_l, gold_r, plds_l, plds_r, confs_l, confs_r)
+    confusion = calc_confusion_matrix(true_arr, pred_arr, len(CLASS_NAMES))
+    precision, recall = calc_precision_recall(confusion)
+    calibration = calc_calibration(true_arr, pred_arr, conf_arr, bins,
+                                   len(CLASS_NAMES))
+    return {'eval_accuracy': calc_eval_accuracy(outcomes),
+            'eval_outcomes': outcomes, 'joined': len(true_arr),
+            'missing': num_missing, 'unlabeled': num_unlabeled,
+            'accuracy': float(np.trace(confusion)) / len(true_arr)
+                        if len(true_arr) > 0 else np.nan,
+            'confusion': confusion.tolist(),
+            'precision': dict(zip(CLASS_NAMES, precision.tolist())),
+            'recall': dict(zip(CLASS_NAMES, recall.tolist())),
+            'calibration': {key: value.tolist() if key != 'ece' else value
+                            for key, value in calibration.items()}}
+
+def score_result_files(gold_l_path, gold_r_path, res_l_path, res_r_path,
+                       bins=10):
+    """ Scores the results from the CSV-files referred to by 'res_l_path' and
+    'res_r_path' against the gold PLDs from 'gold_l_path' and 'gold_r_path'
+    with 'bins' calibration bins, see 'score_results'. """
+    gold_l, _ = read_results_from_csv(gold_l_path)
+    gold_r, _ = read_results_from_csv(gold_r_path)
+    plds_l, confs_l = read_results_from_csv(res_l_path)
+    plds_r, confs_r = read_results_from_csv(res_r_path)
+    return score_results(gold_l, gold_r, plds_l, plds_r, confs_l, confs_r,
+                         bins)
+
+def print_report(report):
+    """ Prints the metrics from the dict 'report' by 'score_results'. """
+    print(f"Accuracy (Eval.java): {np.float32(report['eval_accuracy'])!s}")
+    print(f"Joined {report['joined']} gold PLDs with predictions, "
+          f"{report['missing']} without prediction, {report['unlabeled']} "
+          f"predicted PLDs without gold class.")
+    print(f"Accuracy (joined): {report['accuracy']:.4f}")
+    print(f"{'gold/pred':>10s}" + ''.join(f"{name:>8s}"
+                                          for name in CLASS_NAMES))
+    for name, row in zip(CLASS_NAMES, report['confusion']):
+        print(f"{name:>10s}" + ''.join(f"{cnt:8d}" for cnt in row))
+    for name in CLASS_NAMES:
+        print(f"{name:>10s}: precision {report['precision'][name]:.4f}, "
+              f"recall {report['recall'][name]:.4f}")
+    calibration = report['calibration']
+    for lower, count, confidence, accuracy in zip(calibration['lower'],
+                                                  calibration['count'],
+                                                  calibration['confidence'],
+                                                  calibration['accuracy']):
+        print(f"confidence >= {lower:.3f}: {count:7d} PLDs, mean confidence "
+              f"{confidence:.4f}, accuracy {accuracy:.4f}")
+    print(f"Expected calibration error: {calibration['ece']:.4f}")
+
+# Main
+
+def parse_arguments(args):
+    """ Creates an ArgumentParser with help messages. """
+    info =  """ Scoring of the results of a classifier for PLD media bias
+            classification against gold PLDs. Uses CSV-files generated by
+            'evaluation.py'. """
+    parser = ArgumentParser(description=info)
+    parser.add_argument('gold_l',
+                        help="specify relative path to left gold PLDs")
+    parser.add_argument('gold_r',
+                        help="specify relative path to right gold PLDs")
+    parser.add_argument('res_l', help="specify relative path to left results")
+    parser.add_argument('res_r', help="specify relative path to right results")
+    parser.add_argument('-b', '--bins', type=int, default=10, metavar='N',
+                        help="specify number of calibration bins")
+    parser.add_argument('-o', '--out', default=None, metavar='PATH',
+                        help="specify JSON-file for all metrics")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help="activate output")
+
+    if len(args) < 1:  # show help, if no arguments are given
+        parser.print_help(sys.stderr)
+        sys.exit()
+    return parser.parse_args(args)
+
+def main(args):
+    parsed_args = parse_arguments(args)
+    assert parsed_args.bins > 0
+
+    report = score_result_files(parsed_args.gold_l, parsed_args.gold_r,
+                                parsed_args.res_l, parsed_args.res_r,
+                                parsed_args.bins)
+    print_report(report)
+    if parsed_args.out is not None:
+        with open(parsed_args.out, 'w') as file:
+            json.dump(report, file, indent=2)
+        print_log(f"Metrics saved to '{parsed_args.out}'.", parsed_args.verbose)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,109 @@
+"""
+Load test for 'scoring_server.py'. Sends raw rows from a CSV-file with tweets
+from concurrent threads and reports throughput and latencies of the client and
+the counters of the server.
+
+Example call:
+python -m scoring_client '../../../input_data/test_tweets.csv' -n 1000 -t 8
+"""
+
+import json
+import numpy as np
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+
+from data_file_handler import iter_tweets_from_csv
+
+# Client
+
+def post_records(url, records):
+    """ Sends 'records' to the scoring server at 'url' and returns the results
+    and the latency of the request in s. """
+    body = json.dumps({'records': records}).encode('utf-8')
+    request = Request(f"{url}/score", data=body,
+                      headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    with urlopen(request) as response:
+        results = json.loads(response.read())['results']
+    return results, time.perf_counter() - start
+
+def read_records(rel_path, num):
+    """ Reads up to 'num' raw rows from the CSV-file referred to by
+    'rel_path' and returns them as list of dicts. """
+    records = []
+    for chunk, _ in iter_tweets_from_csv(rel_path, min(num, 1000)):
+        pld_ls, cnts_ls, emos_pos_ls, emos_neg_ls, tags_ls, _ = chunk
+        records += [{'pld': pld, 'tweet_count': cnts, 'emos_pos': emos_pos,
+                     'emos_neg': emos_neg, 'tags': tags}
+                    for pld, cnts, emos_pos, emos_neg, tags
+                    in zip(pld_ls, cnts_ls, emos_pos_ls, emos_neg_ls, tags_ls)]
+        if len(records) >= num:
+            break
+    return records[:num]
+
+def run_load_test(url, records, num_requests, num_threads, request_size):
+    """ Sends 'num_requests' requests with 'request_size' records each from
+    'num_threads' threads. Records are taken from 'records' cyclically.
+    Returns the wall time in s and the latencies per request. """
+    batches = [[records[(i * request_size + j) % len(records)]
+                for j in range(request_size)] for i in range(num_requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        latencies = [latency for _, latency
+                     in executor.map(lambda b: post_records(url, b), batches)]
+    return time.perf_counter() - start, np.array(latencies)
+
+def read_stats(url):
+    """ Returns the counters of the scoring server at 'url'. """
+    with urlopen(f"{url}/stats") as response:
+        return json.loads(response.read())
+
+# Main
+
+def parse_arguments(args):
+    """ Creates an ArgumentParser with help messages. """
+    info =  """ Load test for the scoring server for PLD media bias
+            classification. Uses tweets from CSV-files generated by
+            'data_retriever.py'. """
+    parser = ArgumentParser(description=info)
+    parser.add_argument('data', help="specify relative path to test data")
+    parser.add_argument('-n', '--num', type=int, default=1000, metavar='N',
+                        help="specify number of requests")
+    parser.add_argument('-r', '--records', type=int, default=1, metavar='N',
+                        help="specify number of records per request")
+    parser.add_argument('-t', '--threads', type=int, default=8, metavar='N',
+                        help="specify number of concurrent clients")
+    parser.add_argument('-u', '--url', default='http://127.0.0.1:8080',
+                        help="specify URL of the scoring server")
+
+    if len(args) < 1:  # show help, if no arguments are given
+        parser.print_help(sys.stderr)
+        sys.exit()
+    return parser.parse_args(args)
+
+def main(args):
+    parsed_args = parse_arguments(args)
+    assert parsed_args.num > 0
+    assert parsed_args.records > 0
+    assert parsed_args.threads > 0
+
+    records = read_records(parsed_args.data,
+                           parsed_args.num * parsed_args.records)
+    wall_time, latencies = run_load_test(parsed_args.url, records,
+                                         parsed_args.num, parsed_args.threads,
+                                         parsed_args.records)
+    latencies *= 1000.0 # in ms
+    print(f"{parsed_args.num} requests in {wall_time:.2f}s: "
+          f"{parsed_args.num / wall_time:.1f} requests/s, "
+          f"{parsed_args.num * parsed_args.records / wall_time:.1f} records/s")
+    print(f"latency: mean={np.mean(latencies):.1f}ms, "
+          f"p50={np.percentile(latencies, 50):.1f}ms, "
+          f"p95={np.percentile(latencies, 95):.1f}ms, "
+          f"p99={np.percentile(latencies, 99):.1f}ms")
+    print(f"server: {json.dumps(read_stats(parsed_args.url))}")
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
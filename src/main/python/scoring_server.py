@@ -0,0 +1,287 @@
+"""
+Serves a trained classifier via a local HTTP API. The classifier and its tokens
+stay loaded, and concurrent requests are coalesced into micro-batches.
+
+POST /score expects {"records": [...]} with either raw rows as fetched by
+'data_retriever.py' ({"pld", "tweet_count", "emos_pos", "emos_neg", "tags"}) or
+feature records ({"pld", "emos": [5 floats], "tags": [tokens]}). It returns
+{"results": [{"pld", "class", "confidence"}, ...]}. GET /stats returns
+throughput and latency counters.
+
+Example call:
+python -m scoring_server 'leaning_guesser' -p 8080 -v
+"""
+
+import json
+import numpy as np
+import sys
+import threading
+import time
+import torch
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Queue
+from torchtext.data.utils import get_tokenizer
+
+from data_file_handler import read_model_from_files
+from data_preprocessor import append_cnts_to_emos, collapse_tag_ids, \
+                              preprocess_cnts, preprocess_emos, preprocess_tags
+from helpers import print_log
+from pld_dataset import PLDDataset
+
+# Scoring
+
+class ScoringStats(object):
+    """ Thread-safe throughput and latency counters of a scoring server. """
+
+    def __init__(self, window=10000):
+        """ Keeps the latencies of the last 'window' requests. """
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.latencies = deque(maxlen=window)
+        self.num_requests, self.num_records, self.num_batches = 0, 0, 0
+        self.num_errors = 0
+
+    def record_batch(self):
+        with self.lock:
+            self.num_batches += 1
+
+    def record_error(self):
+        with self.lock:
+            self.num_errors += 1
+
+    def record_request(self, num_records, latency):
+        with self.lock:
+            self.num_requests += 1
+            self.num_records += num_records
+            self.latencies.append(latency)
+
+    def to_dict(self):
+        """ Returns all counters and derived metrics as dict. """
+        with self.lock:
+            uptime = time.perf_counter() - self.start
+            latencies = np.array(self.latencies) * 1000.0 # in ms
+            stats = {'uptime_s': uptime, 'requests': self.num_requests,
+                     'records': self.num_records, 'batches': self.num_batches,
+                     'errors': self.num_errors,
+                     'records_per_s': self.num_records / uptime,
+                     'records_per_batch':
+                        self.num_records / max(self.num_batches, 1)}
+        if len(latencies) > 0:
+            p50, p95, p99 = np.percentile(latencies, (50, 95, 99))
+            stats.update({'latency_mean_ms': float(np.mean(latencies)),
+                          'latency_p50_ms': float(p50),
+                          'latency_p95_ms': float(p95),
+                          'latency_p99_ms': float(p99)})
+        return stats
+
+class MicroBatcher(object):
+    """ Scores requests from concurrent threads with one forward pass per
+    micro-batch. A micro-batch is closed when it holds 'max_batch' records or
+    when its first request has waited 'max_wait' seconds. """
+
+    def __init__(self, classifier, max_batch=256, max_wait=0.005):
+        self.classifier = classifier.eval()
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.stats = ScoringStats()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def process(self, requests):
+        """ Scores all records from 'requests' at once and resolves their
+        futures with tuples (classes, confidences). """
+        emos_arr = np.concatenate([emos for emos, _, _ in requests])
+        tags_ids, tags_counts, tags_offsets = collapse_tag_ids(
+            ids for _, ids_ls, _ in requests for ids in ids_ls)
+        label_arr = np.full(len(emos_arr), fill_value=-1, dtype=int)
+        _, emos, tags, offsets, weights = PLDDataset(label_arr, emos_arr,
+                                                     tags_ids, tags_offsets,
+                                                     tags_counts)[:]
+
+        with torch.no_grad():
+            predictions = self.classifier(emos, tags, offsets, weights,
+                                          probs=True)
+        confidences, classes = torch.max(predictions, dim=1)
+        self.stats.record_batch()
+
+        start = 0
+        for emos, _, future in requests:
+            stop = start + len(emos)
+            future.set_result((classes[start:stop].tolist(),
+                               confidences[start:stop].tolist()))
+            start = stop
+
+    def run(self):
+        """ Collects requests from the queue into micro-batches forever. """
+        while True:
+            requests = [self.queue.get()]
+            num_records = len(requests[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while num_records < self.max_batch:
+                try:
+                    timeout = max(deadline - time.perf_counter(), 0.0)
+                    requests.append(self.queue.get(timeout=timeout))
+                    num_records += len(requests[-1][0])
+                except Empty:
+                    break
+
+            try:
+                self.process(requests)
+            except Exception as error:
+                for _, _, future in requests:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def score(self, emos_arr, tags_ids_ls):
+        """ Scores the records given by the emotion features 'emos_arr' and the
+        token ids 'tags_ids_ls' and blocks until their micro-batch is done.
+        Returns a list of classes and a list of confidences. Re-raises and
+        counts errors of the micro-batch. """
+        start = time.perf_counter()
+        future = Future()
+        self.queue.put((emos_arr, tags_ids_ls, future))
+        try:
+            classes, confidences = future.result()
+        except Exception:
+            self.stats.record_error()
+            raise
+        self.stats.record_request(len(emos_arr), time.perf_counter() - start)
+        return classes, confidences
+
+def encode_records(records, stoi, tokenizer, cnts_range=None):
+    """ Transforms raw rows or feature records from 'records' into an array
+    with emotion features and a list of token ids per record. Counters from
+    raw rows are normalized with the tuple (min, max) 'cnts_range' from
+    training, so that each record's features are independent of its request.
+    Old models without it normalize across the raw rows of one request. """
+    emos_arr = np.zeros((len(records), 5))
+    tags_ids_ls = [None] * len(records)
+    raw_idx = [i for i, record in enumerate(records) if 'emos' not in record]
+
+    for i, record in enumerate(records):
+        if 'emos' in record:
+            assert len(record['emos']) == 5
+            emos_arr[i] = record['emos']
+            tags_ids_ls[i] = [stoi.get(token, 0) for token in record['tags']]
+
+    if len(raw_idx) > 0:
+        raw_records = [records[i] for i in raw_idx]
+        emos_arr[raw_idx] = append_cnts_to_emos(
+            preprocess_emos([record['emos_pos'] for record in raw_records],
+                            [record['emos_neg'] for record in raw_records]),
+            preprocess_cnts([record['tweet_count'] for record in raw_records],
+                            cnts_range))
+        tags_str_arr = preprocess_tags([record['tags']
+                                        for record in raw_records])
+        for i, tags_str in zip(raw_idx, tags_str_arr):
+            tags_ids_ls[i] = [stoi.get(token, 0)
+                              for token in tokenizer(tags_str)]
+
+    return emos_arr, [np.array(ids, dtype=np.int64) for ids in tags_ids_ls]
+
+# Server
+
+class ScoringServer(ThreadingHTTPServer):
+    """ HTTP server with one thread per connection and a listen backlog which
+    suffices for many concurrent clients. """
+    daemon_threads = True
+    request_queue_size = 128
+
+def build_handler(batcher, stoi, tokenizer, cnts_range=None, verbose=False):
+    """ Builds a request handler class, which scores records with 'batcher'
+    after encoding them with 'stoi', 'tokenizer' and 'cnts_range'. """
+
+    class ScoringHandler(BaseHTTPRequestHandler):
+        """ Handles requests to '/score' and '/stats'. """
+
+        def do_GET(self):
+            if self.path != '/stats':
+                self.send_error(404)
+                return
+            self.send_json(batcher.stats.to_dict())
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers['Content-Length'])
+                records = json.loads(self.rfile.read(length))['records']
+                assert len(records) > 0
+                emos_arr, tags_ids_ls = encode_records(records, stoi, tokenizer,
+                                                       cnts_range)
+            except (AssertionError, KeyError, TypeError, ValueError) as error:
+                self.send_error(400, explain=repr(error))
+                return
+
+            try:
+                classes, confidences = batcher.score(emos_arr, tags_ids_ls)
+            except Exception as error: # e.g., failed forward pass
+                self.send_error(500, explain=repr(error))
+                return
+            self.send_json({'results': [
+                {'pld': record.get('pld'), 'class': cls, 'confidence': cnf}
+                for record, cls, cnf in zip(records, classes, confidences)]})
+
+        def log_message(self, format, *args):
+            print_log(f"{self.address_string()} {format % args}", verbose)
+
+        def send_json(self, obj):
+            """ Sends 'obj' as JSON-encoded body with status 200. """
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return ScoringHandler
+
+# Main
+
+def parse_arguments(args):
+    """ Creates an ArgumentParser with help messages. """
+    info =  """ Scoring server for a classifier for PLD media bias
+            classification. Keeps the classifier loaded and answers requests
+            via HTTP. """
+    parser = ArgumentParser(description=info)
+    parser.add_argument('cls', help="specify relative path to classifier")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="specify address to listen on")
+    parser.add_argument('-m', '--max-batch', type=int, default=256,
+                        metavar='N', help="specify records per micro-batch")
+    parser.add_argument('-p', '--port', type=int, default=8080, metavar='N',
+                        help="specify port to listen on")
+    parser.add_argument('-t', '--max-wait', type=float, default=5.0,
+                        metavar='MS', help="specify latency budget in ms")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help="activate output")
+
+    if len(args) < 1:  # show help, if no arguments are given
+        parser.print_help(sys.stderr)
+        sys.exit()
+    return parser.parse_args(args)
+
+def main(args):
+    parsed_args = parse_arguments(args)
+    assert parsed_args.max_batch > 0
+    assert parsed_args.max_wait >= 0.0
+
+    classifier, stoi, cnts_range = read_model_from_files(parsed_args.cls)
+    batcher = MicroBatcher(classifier, parsed_args.max_batch,
+                           parsed_args.max_wait / 1000.0)
+    handler = build_handler(batcher, stoi, get_tokenizer('basic_english'),
+                            cnts_range, parsed_args.verbose)
+    server = ScoringServer((parsed_args.host, parsed_args.port), handler)
+    print_log(f"Serving '{parsed_args.cls}' on {parsed_args.host}:"
+              f"{parsed_args.port}.", parsed_args.verbose)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
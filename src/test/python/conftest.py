@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the modules of 'src/main/python' import each other without a package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'main',
+                                'python'))
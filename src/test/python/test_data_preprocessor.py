@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+from collections import Counter
+
+from benchmark import preprocess_emos_loop
+from data_preprocessor import collapse_tag_ids, count_tokens, \
+                              count_tokens_pruned, preprocess_emos
+
+def generate_signed_emos_strs(num, scores, rng, nan_share=0.0):
+    """ Generates '+'-separated strings with up to 2 * 'scores' emotion scores
+    each like 'generate_emos_strs', but with negative scores and a share
+    'nan_share' of NaN scores. """
+    lens = rng.integers(1, 2 * scores + 1, size=num)
+    return ['+'.join('nan' if rng.random() < nan_share else f"{emo:.6f}"
+                     for emo in rng.uniform(-1.0, 1.0, length))
+            for length in lens]
+
+def test_preprocess_emos_equals_loop():
+    rng = np.random.default_rng(0)
+    emos_pos = generate_signed_emos_strs(200, 10, rng, nan_share=0.05)
+    emos_neg = generate_signed_emos_strs(200, 10, rng, nan_share=0.05)
+    expected = preprocess_emos_loop(emos_pos, emos_neg)
+    assert np.isnan(expected).any() and (expected < 0).any()
+
+    np.testing.assert_allclose(preprocess_emos(emos_pos, emos_neg), expected,
+                               rtol=1e-12, atol=1e-12, equal_nan=True)
+
+def test_preprocess_emos_single_scores():
+    emos = preprocess_emos(['0.5', '-0.25', 'nan'], ['1.0', '0.0', '-1.0'])
+    np.testing.assert_array_equal(emos, [[0.5, 1.0, 0.0, 0.0],
+                                         [-0.25, 0.0, 0.0, 0.0],
+                                         [np.nan, -1.0, np.nan, 0.0]])
+
+def test_preprocess_emos_nan_stays_within_its_pld():
+    emos = preprocess_emos(['0.1+0.3', 'nan+nan', '-0.2+0.2'],
+                           ['0.0', '0.5+nan', '0.4'])
+    np.testing.assert_allclose(emos, [[0.2, 0.0, 0.1, 0.0],
+                                      [np.nan, np.nan, np.nan, np.nan],
+                                      [0.0, 0.4, 0.2, 0.0]],
+                               rtol=1e-12, atol=1e-12)
+
+def test_preprocess_emos_many_scores_next_to_single_ones():
+    rng = np.random.default_rng(0)
+    many = '+'.join(f"{emo:.6f}" for emo in rng.uniform(-1.0, 1.0, 100000))
+    emos_pos, emos_neg = ['0.25', many, '-0.75'], [many, '0.5', '0.125']
+
+    np.testing.assert_allclose(preprocess_emos(emos_pos, emos_neg),
+                               preprocess_emos_loop(emos_pos, emos_neg),
+                               rtol=1e-9, atol=1e-12)
+
+def test_preprocess_emos_large_scores():
+    emos_pos, emos_neg = ['1e150+-1e150', '3e150'], ['-2e150+2e150+2e150', '1']
+
+    np.testing.assert_allclose(preprocess_emos(emos_pos, emos_neg),
+                               preprocess_emos_loop(emos_pos, emos_neg),
+                               rtol=1e-12)
+
+def generate_token_streams(rng, vocab_size=2000):
+    """ Generates a left and a right stream of collapsed Zipf-distributed
+    token ids, which share tokens, like the feature stores provide them. """
+    tokens = np.array([f"tag{i}" for i in range(vocab_size)])
+    streams = []
+    for _ in range(2):
+        tag_ids_ls = [(rng.zipf(1.5, size=int(rng.integers(0, 30))) - 1)
+                      % vocab_size for _ in range(300)]
+        tag_ids, tag_counts, _ = collapse_tag_ids(tag_ids_ls)
+        streams.append((tokens, tag_ids, tag_counts))
+    return streams
+
+@pytest.mark.parametrize('width', [64, 1<<16])
+def test_count_tokens_pruned_keeps_exact_counts_of_frequent_tokens(width):
+    streams = generate_token_streams(np.random.default_rng(0))
+    exact = sum((count_tokens(*stream) for stream in streams), Counter())
+    pruned = count_tokens_pruned(streams, min_freq=3, width=width,
+                                 chunk_size=97)
+
+    assert all(pruned[token] == exact[token] for token in pruned)
+    assert {token for token, cnt in pruned.items() if cnt >= 3} \
+        == {token for token, cnt in exact.items() if cnt >= 3}
+    if width > 64: # few collisions, so rare tokens are pruned
+        occurring = [token for token, cnt in exact.items() if cnt > 0]
+        assert len(pruned) < len(occurring) / 2
+
+def test_count_tokens_pruned_without_counts_and_min_freq():
+    tokens = np.array(['a', 'b', 'c'])
+    streams = [(tokens, np.array([0, 1, 0, 2, 0]), None),
+               (tokens, np.array([1, 1]), np.array([2, 5]))]
+
+    assert count_tokens_pruned(streams, chunk_size=2) \
+        == Counter({'a': 3, 'b': 8, 'c': 1})
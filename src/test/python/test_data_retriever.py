@@ -0,0 +1,154 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.parse import parse_qs
+
+import pytest
+
+from data_file_handler import ResponseCache
+from data_retriever import SPARQL_URL, SPARQLClient, query_hash, \
+                           retrieve_batch, retrieve_tweets_concurrently
+
+class StandInEndpoint(ThreadingHTTPServer):
+    """ Local stand-in for the SPARQL-endpoint, which answers each query with
+    one row per PLD from its VALUES-block and counts opened connections.
+    Fails with the status from 'fail' and waits 'delay' seconds for batches of
+    more than one PLD. """
+
+    daemon_threads = True
+
+    def __init__(self, idle_timeout=None):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.idle_timeout = idle_timeout
+        self.fail = None
+        self.delay = None
+        self.connections = 0
+        self.queries = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/sparql"
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keeps connections alive
+
+    def setup(self):
+        self.timeout = self.server.idle_timeout
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        query = parse_qs(body.decode('utf-8'))['query'][0]
+        plds = re.findall(r'"([^"]+)"',
+                          re.search(r'VALUES \?pld \{(.*?)\}', query).group(1))
+        with self.server.lock:
+            self.server.queries += 1
+        if len(plds) > 1 and self.server.delay is not None:
+            time.sleep(self.server.delay)
+        if len(plds) > 1 and self.server.fail is not None:
+            self.send_response(self.server.fail)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        rows = [{'pld': {'type': 'literal', 'value': pld},
+                 'tweet_count': {'type': 'literal', 'value': '1'}}
+                for pld in plds]
+        data = json.dumps({'head': {'vars': ['pld', 'tweet_count']},
+                           'results': {'bindings': rows}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/sparql-results+json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def endpoint(request):
+    server = StandInEndpoint(getattr(request, 'param', None))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_retrieval_reuses_one_connection_per_thread(endpoint):
+    pld_list = [f"pld{i}.com" for i in range(40)]
+    results = list(retrieve_tweets_concurrently(pld_list, workers=3,
+                                                batch_size=2,
+                                                url=endpoint.url, timeout=5))
+
+    assert [pld for pld, _ in results] == pld_list
+    assert all(tweets['results']['bindings'][0]['pld']['value'] == pld
+               for pld, tweets in results)
+    assert endpoint.queries == 20
+    assert endpoint.connections <= 3
+
+@pytest.mark.parametrize('endpoint', [0.2], indirect=True)
+def test_client_reopens_connection_closed_while_idle(endpoint):
+    client = SPARQLClient(endpoint.url, timeout=5)
+    query = 'SELECT * WHERE { VALUES ?pld { "a.com" } }'
+    assert client.query(query)['results']['bindings'][0]['pld']['value'] \
+        == 'a.com'
+    time.sleep(0.5) # the endpoint closes the idle connection
+    assert client.query(query)['results']['bindings'][0]['pld']['value'] \
+        == 'a.com'
+    client.close()
+    assert endpoint.connections == 2
+
+@pytest.mark.parametrize('status', [413, 414, 500])
+def test_batch_is_split_if_too_large(endpoint, status):
+    endpoint.fail = status
+    plds = [f"pld{i}.com" for i in range(4)]
+    client = SPARQLClient(endpoint.url, timeout=5)
+    tweets = retrieve_batch(plds, client, retries=0)
+    client.close()
+
+    assert [t['results']['bindings'][0]['pld']['value'] for t in tweets] \
+        == plds
+    assert endpoint.queries == 7 # 1 + 2 halves + 4 single PLDs
+
+def test_batch_is_split_on_timeout(endpoint):
+    endpoint.delay = 0.5
+    client = SPARQLClient(endpoint.url, timeout=0.2)
+    tweets = retrieve_batch(['a.com', 'b.com'], client, retries=0)
+    client.close()
+
+    assert len(tweets) == 2
+    assert endpoint.queries == 3
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_batch_is_not_split_if_endpoint_is_unavailable(endpoint, status):
+    endpoint.fail = status
+    client = SPARQLClient(endpoint.url, timeout=5)
+    with pytest.raises(HTTPError) as error:
+        retrieve_batch([f"pld{i}.com" for i in range(8)], client, retries=1)
+    client.close()
+
+    assert error.value.code == status
+    assert endpoint.queries == 2 # one retry, no halves
+
+def test_batch_is_not_split_if_endpoint_is_unreachable():
+    server = StandInEndpoint()
+    url = server.url
+    server.server_close() # nothing listens on the port anymore
+    client = SPARQLClient(url, timeout=5)
+    with pytest.raises(ConnectionError):
+        retrieve_batch(['a.com', 'b.com'], client, retries=0)
+
+def test_cached_responses_are_not_shared_between_endpoints(endpoint,
+                                                            tmp_path):
+    cache_path = str(tmp_path / 'cache.sqlite')
+    cache = ResponseCache(cache_path, query_hash(endpoint.url))
+    cache.put('a.com', retrieve_batch(['a.com'], SPARQLClient(endpoint.url)))
+    cache.close()
+
+    assert 'a.com' in ResponseCache(cache_path, query_hash(endpoint.url))
+    assert 'a.com' not in ResponseCache(cache_path, query_hash(SPARQL_URL))
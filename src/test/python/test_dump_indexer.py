@@ -0,0 +1,88 @@
+import gzip
+import os
+
+import pytest
+
+from benchmark import generate_dump_files
+from data_file_handler import DumpIndex
+from dump_indexer import ONYX, RDF_TYPE, RDFS_LABEL, SCHEMA, SIOC, SIOC_T, \
+                         WNA, build_dump_index, is_index_valid
+
+BASE = 'http://data.gesis.org/tweetscov19'
+
+def tweet_triples(name, url, emo_pos, emo_neg, labels=()):
+    """ Returns the N-Triples of the tweet 'name', which cites 'url', has the
+    emotion intensities 'emo_pos' and 'emo_neg' and mentions Hashtags with
+    'labels' in their order. """
+    tweet = f"<{BASE}/{name}>"
+    lines = [f"{tweet} <{RDF_TYPE}> <{SIOC}Post> .",
+             f"{tweet} <{SCHEMA}citation> <{url}> .",
+             f"{tweet} <{ONYX}hasEmotionSet> _:es_{name} .",
+             f"_:es_{name} <{RDF_TYPE}> <{ONYX}EmotionSet> ."]
+    for cat, emo in (('positive', emo_pos), ('negative', emo_neg)):
+        if emo is not None:
+            lines += [f"_:es_{name} <{ONYX}hasEmotion> _:{cat}_{name} .",
+                      f"_:{cat}_{name} <{ONYX}hasEmotionCategory> "
+                      f"<{WNA}{cat}-emotion> .",
+                      f"_:{cat}_{name} <{ONYX}hasEmotionIntensity> \"{emo}\" ."]
+    for label in labels:
+        tag = f"<{BASE}/{label.encode('ascii', 'ignore').decode()}>"
+        lines += [f"{tweet} <{SCHEMA}mentions> {tag} .",
+                  f"{tag} <{RDF_TYPE}> <{SIOC_T}Tag> .",
+                  f"{tag} <{RDFS_LABEL}> \"{label}\" ."]
+    return lines
+
+def write_dump(rel_path, lines):
+    opener = gzip.open if rel_path.endswith('.gz') else open
+    with opener(rel_path, 'wt', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+
+def read_values(index_path, plds):
+    """ Returns the aggregated values per PLD from the index at 'index_path'.
+    """
+    index = DumpIndex(index_path)
+    values = {pld: [binding[var]['value'] for binding
+                    in tweets['results']['bindings'] for var in DumpIndex.VARS]
+              for pld, tweets in index.iter_tweets(plds)}
+    index.close()
+    return values
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_index_equals_generated_plds(tmp_path, jobs):
+    dump_paths, _, rows = generate_dump_files(str(tmp_path), 60, 3, 5, 50, 0)
+    index_path = str(tmp_path / 'index.sqlite')
+    build_dump_index(index_path, dump_paths, jobs)
+
+    assert is_index_valid(index_path, dump_paths)
+    assert list(read_values(index_path, [row[0] for row in rows]).values()) \
+        == rows
+
+def test_aggregates_follow_the_order_of_the_dumps(tmp_path):
+    # 'b' occurs before 'a', and the Hashtags of 'b' are written in reverse
+    first = tweet_triples('b', 'https://www.x.com/1', '0.9', '-0.1',
+                          ['Alpha', 'Caf\\u00E9', 'Zeta'])
+    second = tweet_triples('a', 'http://x.com/2', '0.2', '-0.8', ['Beta']) \
+        + tweet_triples('c', 'https://y.org', '0.5', None, ['Zeta']) \
+        + tweet_triples('d', 'https://x.com', '0.3', '-0.3', ['Zeta', 'Beta'])
+    dump_paths = [str(tmp_path / 'first.nt.gz'), str(tmp_path / 'second.nt')]
+    write_dump(dump_paths[0], first[::-1]) # triples of a tweet in any order
+    write_dump(dump_paths[1], second)
+    index_path = str(tmp_path / 'index.sqlite')
+    build_dump_index(index_path, dump_paths)
+
+    assert read_values(index_path, ['y.org', 'x.com']) == {
+        'y.org': [], # no negative emotion
+        'x.com': ['x.com', '3', '0.9+0.2+0.3', '-0.1+-0.8+-0.3',
+                  'Zeta+Café+Alpha+Beta+Zeta+Beta',
+                  f"{BASE}/b+{BASE}/a+{BASE}/d"]}
+
+def test_index_is_invalid_after_a_dump_changed(tmp_path):
+    dump_path = str(tmp_path / 'dump.nt')
+    write_dump(dump_path, tweet_triples('a', 'https://x.com', '0.1', '-0.1'))
+    index_path = str(tmp_path / 'index.sqlite')
+    build_dump_index(index_path, [dump_path])
+    assert is_index_valid(index_path, [dump_path])
+
+    write_dump(dump_path, tweet_triples('a', 'https://x.com', '0.2', '-0.1'))
+    os.utime(dump_path, ns=(1, 1))
+    assert not is_index_valid(index_path, [dump_path])
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('torchtext')
+
+from benchmark import generate_tweets_csv
+from feature_store import FEATURE_NAMES, build_feature_store, \
+                          find_shard_ranges, load_feature_store, \
+                          merge_shards, preprocess_shard
+
+@pytest.fixture
+def tweets_path(tmp_path):
+    rel_path = str(tmp_path / 'tweets.csv')
+    generate_tweets_csv(rel_path, 500, tweets=10, vocab_size=300, seed=1)
+    return rel_path
+
+def load_copy(rel_path, chunk_size, jobs):
+    """ Rebuilds the feature store of 'rel_path' and returns copies of its
+    arrays. """
+    build_feature_store(rel_path, chunk_size, jobs=jobs)
+    return {name: np.array(arr)
+            for name, arr in load_feature_store(rel_path, chunk_size).items()}
+
+@pytest.mark.parametrize('jobs', [2, 3, 7])
+def test_sharded_store_equals_single_process_store(tweets_path, jobs):
+    expected = load_copy(tweets_path, 37, 1)
+    assert len(find_shard_ranges(tweets_path, jobs)) > 1
+    actual = load_copy(tweets_path, 37, jobs)
+
+    for name in FEATURE_NAMES:
+        assert actual[name].dtype == expected[name].dtype, name
+        np.testing.assert_array_equal(actual[name], expected[name], name)
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_store_of_file_without_rows(tmp_path, jobs):
+    rel_path = str(tmp_path / 'empty.csv')
+    generate_tweets_csv(rel_path, 0)
+    store = load_copy(rel_path, 37, jobs)
+
+    assert store['emos'].shape == (0, 4)
+    np.testing.assert_array_equal(store['tag_offsets'], [0])
+    for name in ('plds', 'cnts', 'tag_ids', 'tag_counts', 'tokens',
+                 'fingerprints'):
+        assert store[name].shape == (0,), name
+    for name in ('cnts', 'tag_ids', 'tag_counts', 'tag_offsets'):
+        assert store[name].dtype == np.int64, name
+
+def test_merged_shards_without_rows_are_skipped(tmp_path, tweets_path):
+    empty_path = str(tmp_path / 'empty.csv')
+    generate_tweets_csv(empty_path, 0)
+    empty, full = preprocess_shard(empty_path), preprocess_shard(tweets_path)
+    merged = merge_shards([empty, full, empty])
+
+    for name in FEATURE_NAMES:
+        assert merged[name].dtype == full[name].dtype, name
+        np.testing.assert_array_equal(merged[name], full[name], name)
@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+from collections import Counter
+
+torch = pytest.importorskip('torch')
+
+from data_preprocessor import collapse_tag_ids, count_tokens
+from pld_classifier import build_classifier
+from pld_dataset import normalize_counts
+
+def generate_tag_ids_ls(num, tags, vocab_size, rng):
+    """ Generates 'num' samples with up to 2 * 'tags' Zipf-distributed token
+    ids each, including empty samples, like 'benchmark_bag'. """
+    return [(rng.zipf(1.3, size=int(rng.integers(0, 2 * tags + 1))) - 1)
+            % vocab_size for _ in range(num)]
+
+def generate_weight(rng, vocab_size=500, emb_dim=300):
+    """ Generates an embedding weight, whose row 0 is zero like the vector of
+    '<unk>' in a vocab. """
+    weight = torch.as_tensor(rng.standard_normal((vocab_size, emb_dim)),
+                             dtype=torch.float32)
+    weight[0] = 0.0
+    return weight
+
+def to_raw_bags(tag_ids_ls):
+    """ Returns the concatenated token ids and offsets of 'tag_ids_ls'. """
+    raw_ids = torch.as_tensor(np.concatenate(tag_ids_ls), dtype=torch.int64)
+    raw_offsets = torch.as_tensor(np.cumsum([0] + [len(tag_ids) for tag_ids
+                                                   in tag_ids_ls[:-1]]))
+    return raw_ids, raw_offsets
+
+def to_weighted_bags(tag_ids, tag_counts, tag_offsets):
+    """ Returns the collapsed token ids 'tag_ids', the offsets of the samples
+    from 'tag_offsets' and the weights normalized from 'tag_counts'. """
+    tag_offsets = torch.as_tensor(tag_offsets)
+    weights = normalize_counts(torch.as_tensor(tag_counts, dtype=torch.float32),
+                               tag_offsets)
+    return torch.as_tensor(tag_ids), tag_offsets[:-1], weights
+
+def embed_weighted(weight, tag_ids, tag_counts, tag_offsets):
+    """ Embeds collapsed token ids like a PLDClassifier with 'weight'. """
+    classifier = build_classifier(weight)
+    tag_ids, offsets, weights = to_weighted_bags(tag_ids, tag_counts,
+                                                 tag_offsets)
+    with torch.no_grad():
+        return classifier.emb(tag_ids, offsets, per_sample_weights=weights)
+
+def test_collapse_tag_ids_keeps_counts():
+    rng = np.random.default_rng(0)
+    tag_ids_ls = generate_tag_ids_ls(300, 20, 500, rng)
+    tag_ids, tag_counts, tag_offsets = collapse_tag_ids(tag_ids_ls)
+
+    assert len(tag_offsets) == len(tag_ids_ls) + 1
+    for i, raw_ids in enumerate(tag_ids_ls):
+        start, end = tag_offsets[i], tag_offsets[i + 1]
+        assert dict(zip(tag_ids[start:end].tolist(),
+                        tag_counts[start:end].tolist())) \
+            == Counter(raw_ids.tolist())
+
+def test_count_tokens_with_counts_equals_raw_counts():
+    rng = np.random.default_rng(0)
+    tag_ids_ls = generate_tag_ids_ls(300, 20, 500, rng)
+    tokens = np.array([f"tag{i}" for i in range(500)])
+    tag_ids, tag_counts, _ = collapse_tag_ids(tag_ids_ls)
+
+    assert count_tokens(tokens, tag_ids, tag_counts) \
+        == count_tokens(tokens, np.concatenate(tag_ids_ls))
+
+def test_weighted_bag_equals_mean_over_occurrences():
+    rng = np.random.default_rng(0)
+    tag_ids_ls = generate_tag_ids_ls(300, 20, 500, rng)
+    assert any(len(tag_ids) == 0 for tag_ids in tag_ids_ls)
+    weight = generate_weight(rng)
+    emb_mean = torch.nn.EmbeddingBag.from_pretrained(weight, mode='mean')
+
+    feats = embed_weighted(weight, *collapse_tag_ids(tag_ids_ls))
+    with torch.no_grad():
+        feats_ref = emb_mean(*to_raw_bags(tag_ids_ls))
+    torch.testing.assert_close(feats, feats_ref, rtol=1e-4, atol=1e-5)
+
+def test_weighted_bag_of_unknown_tags():
+    weight = generate_weight(np.random.default_rng(0))
+    feats = embed_weighted(weight, *collapse_tag_ids([[0, 0, 0], [0],
+                                                      [3, 0, 3]]))
+
+    torch.testing.assert_close(feats[0], torch.zeros(300))
+    torch.testing.assert_close(feats[1], torch.zeros(300))
+    torch.testing.assert_close(feats[2], weight[3] * 2 / 3)
+
+def test_weighted_bag_of_a_single_token():
+    weight = generate_weight(np.random.default_rng(0))
+    feats = embed_weighted(weight, *collapse_tag_ids([[5], [5, 5, 5, 5]]))
+
+    torch.testing.assert_close(feats, weight[[5, 5]], rtol=0.0, atol=0.0)
+
+def test_weighted_bag_with_a_large_count():
+    weight = generate_weight(np.random.default_rng(0))
+    feats = embed_weighted(weight, [1, 2], [10**7, 1], [0, 2])
+
+    expected = (weight[1].double() * 10**7 + weight[2].double()) / (10**7 + 1)
+    torch.testing.assert_close(feats[0], expected.float(), rtol=1e-5,
+                               atol=1e-6)
+
+def test_classifier_with_weights_equals_raw_token_ids():
+    rng = np.random.default_rng(0)
+    tag_ids_ls = generate_tag_ids_ls(300, 20, 500, rng)
+    classifier = build_classifier(generate_weight(rng)).eval()
+    emos = torch.as_tensor(rng.standard_normal((len(tag_ids_ls), 5)),
+                           dtype=torch.float32)
+
+    with torch.no_grad():
+        probs = classifier(emos,
+                           *to_weighted_bags(*collapse_tag_ids(tag_ids_ls)),
+                           probs=True)
+        probs_ref = classifier(emos, *to_raw_bags(tag_ids_ls), probs=True)
+    torch.testing.assert_close(probs, probs_ref, rtol=1e-4, atol=1e-5)
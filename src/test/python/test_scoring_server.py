@@ -0,0 +1,57 @@
+import json
+import threading
+from http.client import HTTPConnection
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('torchtext')
+
+from pld_classifier import build_classifier
+from scoring_server import MicroBatcher, ScoringServer, build_handler
+
+@pytest.fixture
+def server():
+    weight = torch.randn(4, 8, generator=torch.Generator().manual_seed(0))
+    batcher = MicroBatcher(build_classifier(weight, {'emb_dim': 8}),
+                           max_wait=0.0)
+    stoi = {'covid': 1, 'vote': 2, 'broken': 100} # 100 exceeds the embedding
+    handler = build_handler(batcher, stoi, str.split)
+    server = ScoringServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def request(server, method, path, body=None):
+    """ Sends one request to 'server' and returns its status and body. """
+    connection = HTTPConnection(*server.server_address, timeout=5)
+    connection.request(method, path, body=body and json.dumps(body))
+    response = connection.getresponse()
+    status, data = response.status, response.read()
+    connection.close()
+    return status, data
+
+def feature_record(pld, tags):
+    return {'pld': pld, 'emos': [0.1, 0.2, 0.3, 0.4, 0.5], 'tags': tags}
+
+def test_failed_batch_is_answered_with_server_error(server):
+    status, _ = request(server, 'POST', '/score',
+                        {'records': [feature_record('a.com', ['broken'])]})
+    assert status == 500
+
+    status, data = request(server, 'POST', '/score',
+                           {'records': [feature_record('b.com', ['covid']),
+                                        feature_record('c.com', ['x'])]})
+    assert status == 200
+    assert [result['pld'] for result in json.loads(data)['results']] \
+        == ['b.com', 'c.com']
+
+    status, data = request(server, 'GET', '/stats')
+    stats = json.loads(data)
+    assert (stats['requests'], stats['errors']) == (1, 1)
+
+def test_malformed_request_is_answered_with_client_error(server):
+    status, _ = request(server, 'POST', '/score', {'records': []})
+    assert status == 400